@@ -1,31 +1,68 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import configparser
+import errno
+import hashlib
+import importlib
 import os
 import re
+import sys
 import time
 from datetime import datetime
 import threading
-import subprocess
-import zipfile
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import heapq
+import itertools
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from enum import Enum
-import uuid
 
-import requests
-from bs4 import BeautifulSoup
-import argparse
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin
 from loguru import logger
 import os
 from pathlib import Path
-from PIL import Image
 import os
 
 _PARSER = False
 
 
+class _LazyModule:
+    """首次访问属性时才导入的模块，使命令行、守护进程客户端和GUI启动时不必加载用不到的依赖"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # import_module带有导入锁，多个线程同时首次访问也只导入一次
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+requests = _LazyModule('requests')
+bs4 = _LazyModule('bs4')
+Image = _LazyModule('PIL.Image')
+configparser = _LazyModule('configparser')
+sqlite3 = _LazyModule('sqlite3')
+futures = _LazyModule('concurrent.futures')
+HEAVY_MODULES = (requests, bs4, Image, sqlite3, futures)
+
+
+def preload_modules():
+    """在后台线程中提前导入下载用到的模块（GUI显示窗口后调用），第一个任务开始时不必再等待导入"""
+    def _load():
+        for module in HEAVY_MODULES:
+            try:
+                module._load()
+            except ImportError as e:
+                logger.warning(f"预加载模块失败: {e}")
+    threading.Thread(target=_load, daemon=True).start()
+
+
 class TaskStatus(Enum):
     """任务状态枚举"""
     WAITING = "等待中"
@@ -56,6 +93,18 @@ class DownloadTask:
         self.worker_thread = None
         self.is_paused = False
         self.is_cancelled = False
+        self.is_suspended = False  # 挂起的任务下载器已结束，恢复时需要重新启动
+        
+        # 调度信息（由DownloadManager设置）
+        self.priority = 0
+        self.deadline = None  # 截止时间戳
+        self.group = None  # 所属批量文件
+        self.group_rank = 0  # 在所属批量文件中的序号
+        self.order = 0  # 添加顺序
+        self.session = None  # 共享的HTTP会话（守护进程模式由DownloadManager设置）
+        self.metadata_client = None  # DownloadManager的元数据客户端（启用元数据API时）
+        self.catalog = None  # DownloadManager的本地库目录（启用时）
+        self.total_size = None  # 画廊总大小（字节，来自元数据），用于估算需要的磁盘空间
         
         # 创建线程锁
         self.lock = threading.Lock()
@@ -67,16 +116,25 @@ class DownloadTask:
     def start(self):
         """开始任务"""
         should_start = False
+        resume_in_place = False
         with self.lock:
             if self.status in [TaskStatus.WAITING, TaskStatus.PAUSED]:
+                # 暂停的工作线程仍在等待恢复，直接唤醒，无需重新获取画廊信息
+                resume_in_place = (self.status == TaskStatus.PAUSED and not self.is_suspended
+                                   and self.downloader is not None
+                                   and self.worker_thread is not None and self.worker_thread.is_alive())
                 self.status = TaskStatus.RUNNING
                 self.is_paused = False
                 self.is_cancelled = False
+                self.is_suspended = False
+                if resume_in_place:
+                    self.downloader.resume()
                 should_start = True
 
         if should_start:
-            self.worker_thread = threading.Thread(target=self._run_download, daemon=True)
-            self.worker_thread.start()
+            if not resume_in_place:
+                self.worker_thread = threading.Thread(target=self._run_download, daemon=True)
+                self.worker_thread.start()
             
             if self.status_callback:
                 self.status_callback(self.task_id, TaskStatus.RUNNING.value, "开始下载...")
@@ -102,6 +160,35 @@ class DownloadTask:
         
         return False
     
+    def suspend(self, message):
+        """
+        挂起任务（如配额用尽）：状态改为暂停，但不阻塞下载器，
+        下载器会把剩余图片标记为pending后自行结束，之后可通过start()恢复
+        """
+        with self.lock:
+            if self.status != TaskStatus.RUNNING:
+                return False
+            self.is_paused = True
+            self.is_suspended = True
+            self.status = TaskStatus.PAUSED
+            self.message = message
+
+        if self.status_callback:
+            self.status_callback(self.task_id, TaskStatus.PAUSED.value, message)
+        return True
+
+    def fail(self, message):
+        """将未运行的任务标记为失败（如画廊超过磁盘容量，无法开始下载）"""
+        with self.lock:
+            if self.status not in [TaskStatus.WAITING, TaskStatus.PAUSED]:
+                return False
+            self.status = TaskStatus.FAILED
+            self.message = message
+
+        if self.status_callback:
+            self.status_callback(self.task_id, TaskStatus.FAILED.value, message)
+        return True
+
     def cancel(self):
         """取消任务"""
         should_cancel = False
@@ -123,16 +210,42 @@ class DownloadTask:
     def _run_download(self):
         """运行下载任务"""
         try:
-            self.downloader = EHentaiDownloader(
+            # process模式下画廊在子进程中下载，代理对象提供相同的控制接口
+            downloader_class = EHentaiDownloader
+            extra_args = {}
+            if self.config.get('download', 'execution_mode', 'thread') == 'process':
+                downloader_class = ProcessDownloader
+            else:
+                if self.session is not None:
+                    extra_args['session'] = self.session
+                if self.metadata_client is not None:
+                    extra_args['metadata_client'] = self.metadata_client
+                if self.catalog is not None:
+                    extra_args['catalog'] = self.catalog
+            downloader = downloader_class(
                 self.url, 
                 self.config,
                 progress_callback=self._on_progress,
-                status_callback=self._on_status
+                status_callback=self._on_status,
+                **extra_args
             )
+            with self.lock:
+                self.downloader = downloader
+                # 下载器创建前收到的暂停/取消请求
+                if self.is_cancelled:
+                    downloader.cancel()
+                elif self.is_paused and not self.is_suspended:
+                    downloader.pause()
             
             success = self.downloader.download_gallery()
             
             with self.lock:
+                # 任务已被重新启动，由新的工作线程负责状态
+                if threading.current_thread() is not self.worker_thread:
+                    return
+                # 挂起的任务保持暂停状态，等待恢复
+                if self.is_paused and not self.is_cancelled:
+                    return
                 if self.is_cancelled:
                     self.status = TaskStatus.CANCELLED
                 elif success:
@@ -188,6 +301,156 @@ class DownloadTask:
             self.last_status_callback_time = current_time
 
 
+class ProcessDownloader:
+    """
+    在独立子进程中运行EHentaiDownloader的代理
+    进度、状态和日志通过管道转发回主进程，暂停/恢复/取消/线程数调整通过管道发送给子进程，
+    接口与EHentaiDownloader一致，DownloadTask无需区分运行模式
+    """
+
+    def __init__(self, gallery_url, config, progress_callback=None, status_callback=None):
+        import multiprocessing
+        self.gallery_url = gallery_url
+        self.config = config
+        self.progress_callback = progress_callback
+        self.status_callback = status_callback
+        self.output_dir = None
+        self.pending_count = 0
+        self.is_cancelled = False
+        self.send_lock = threading.Lock()
+        # 使用spawn启动子进程，避免在多线程进程中fork
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_run_gallery_process,
+                                       args=(gallery_url, config.config_file, config.config, child_conn),
+                                       daemon=True)
+        self.child_conn = child_conn
+
+    def _send(self, *message):
+        with self.send_lock:
+            try:
+                self.conn.send(message)
+            except (OSError, EOFError):
+                pass
+
+    def pause(self):
+        self._send('pause')
+
+    def resume(self):
+        self._send('resume')
+
+    def cancel(self):
+        self.is_cancelled = True
+        self._send('cancel')
+
+    def set_max_workers(self, max_workers):
+        self._send('max_workers', max_workers)
+
+    def _on_quota_exceeded(self, resume_at):
+        """主进程中的配额暂停同步到子进程"""
+        self._send('quota', resume_at - time.time())
+
+    def _on_disk_low(self, path):
+        """主进程中的空间不足暂停同步到子进程"""
+        self._send('disk', path)
+
+    def download_gallery(self):
+        """启动子进程并转发消息，直到子进程结束"""
+        self.process.start()
+        self.child_conn.close()
+        QUOTA_GUARD.add_listener(self._on_quota_exceeded)
+        DISK_BUDGET.add_listener(self._on_disk_low)
+        success = False
+        try:
+            while True:
+                try:
+                    message = self.conn.recv()
+                except (EOFError, OSError):
+                    logger.error(f"下载进程意外退出: {self.gallery_url}")
+                    break
+                kind = message[0]
+                if kind == 'progress':
+                    if self.progress_callback:
+                        self.progress_callback(*message[1:])
+                elif kind == 'status':
+                    self.output_dir = message[2] or self.output_dir
+                    if self.status_callback:
+                        self.status_callback(message[1])
+                elif kind == 'log':
+                    logger.log(message[1], message[2])
+                elif kind == 'quota':
+                    # 子进程检测到配额用尽，在主进程中触发全局暂停
+                    QUOTA_GUARD.trigger(message[1])
+                elif kind == 'disk':
+                    DISK_BUDGET.trigger(message[1])
+                elif kind == 'images':
+                    # 子进程下载的图片大小计入主进程的平均值，用于估算之后的画廊
+                    DISK_BUDGET.record_image(message[1], message[2])
+                elif kind == 'done':
+                    _, success, self.output_dir, self.pending_count = message
+                    break
+        finally:
+            QUOTA_GUARD.remove_listener(self._on_quota_exceeded)
+            DISK_BUDGET.remove_listener(self._on_disk_low)
+            self.process.join()
+            self.conn.close()
+        return success
+
+
+def _run_gallery_process(gallery_url, config_file, config_data, conn):
+    """子进程入口：下载一个画廊，并通过管道与主进程通信"""
+    config = Config(config_file)
+    config.config = config_data
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                pass
+
+    # 日志转发到主进程，由主进程统一输出（GUI日志、日志文件）
+    logger.remove()
+    logger.add(lambda message: send('log', message.record['level'].name, message.record['message']), level='INFO')
+    QUOTA_GUARD.add_listener(lambda resume_at: send('quota', resume_at - time.time()))
+    DISK_BUDGET.add_listener(lambda path: send('disk', path))
+
+    downloader = EHentaiDownloader(
+        gallery_url, config,
+        progress_callback=lambda current, total, message: send('progress', current, total, message),
+        status_callback=lambda status: send('status', status, downloader.output_dir)
+    )
+
+    def control_loop():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # 主进程已退出
+                downloader.cancel()
+                return
+            kind = message[0]
+            if kind == 'pause':
+                downloader.pause()
+            elif kind == 'resume':
+                downloader.resume()
+            elif kind == 'cancel':
+                downloader.cancel()
+            elif kind == 'max_workers':
+                downloader.set_max_workers(message[1])
+            elif kind == 'quota':
+                QUOTA_GUARD.trigger(message[1])
+            elif kind == 'disk':
+                DISK_BUDGET.trigger(message[1])
+
+    threading.Thread(target=control_loop, daemon=True).start()
+    success = downloader.download_gallery()
+    send('images', DISK_BUDGET.image_bytes, DISK_BUDGET.image_count)
+    send('done', success, downloader.output_dir, downloader.pending_count)
+    conn.close()
+
+
 class Config:
     """配置管理类"""
     def __init__(self, config_file='config.json'):
@@ -197,9 +460,18 @@ class Config:
                 'output_dir': './download',
                 'delay': 1.0,
                 'max_workers': 3,
+                'max_workers_cap': 16,  # 运行中可调大的单画廊线程数上限
+                'execution_mode': 'thread',  # thread: 画廊在线程中运行; process: 每个画廊在独立子进程中运行
                 'max_concurrent': 3,
                 'timeout': 30,
-                'retry_count': 3
+                'retry_count': 3,
+                'submit_window': 2,  # 每个下载线程最多排队的图片数
+                'verify_hash': True,  # 使用/s/链接中的SHA-1前缀校验图片
+                'server_failover': True,  # 图片服务器失败时通过重载键切换服务器
+                'chunk_size': 262144,  # 图片数据每次读写的字节数
+                'preallocate': False,  # 按Content-Length预先分配图片文件空间（支持posix_fallocate的系统）
+                'fsync': 'none',  # none: 不主动落盘; each: 每张图片落盘; batch: 每fsync_batch张及画廊结束时落盘
+                'fsync_batch': 32
             },
             'compression': {
                 'enabled': False,
@@ -213,9 +485,130 @@ class Config:
             'conversion': {
                 'webp_to_jpg': True,
                 'jpg_quality': 95
+            },
+            'storage': {
+                'backend': 'loose'  # loose: 每张图片一个文件; pack: 追加写入单个打包文件; sqlite: SQLite数据库
+            },
+            'dedup': {
+                'enabled': False,
+                'store_dir': './download/.store',  # 内容寻址存储目录
+                'link_mode': 'hardlink'  # hardlink, copy
+            },
+            'quota': {
+                'backoff_seconds': 3600,  # 检测到配额用尽后暂停的时间（秒）
+                'placeholder_sha1': []  # 额外的配额占位图SHA-1列表
+            },
+            'disk': {
+                'enabled': True,  # 启动画廊前按估算大小检查并预留磁盘空间
+                'min_free_mb': 1024,  # 输出目录所在磁盘始终保留的剩余空间（MB），低于此值时暂停下载
+                'default_image_kb': 512,  # 尚未下载过图片时估算使用的平均图片大小（KB）
+                'check_interval': 60  # 空间不足暂停后重新检查剩余空间的间隔（秒）
+            },
+            'circuit_breaker': {
+                'enabled': True,  # 按图片服务器熔断
+                'window_seconds': 60,  # 失败率统计的滚动窗口（秒）
+                'failure_rate': 0.5,  # 触发熔断的失败率
+                'min_samples': 3,  # 窗口内最少请求数
+                'open_seconds': 60  # 熔断持续时间（秒）
+            },
+            'hedging': {
+                'enabled': False,  # 图片响应过慢时向其他服务器发出对冲请求
+                'percentile': 95,  # 以首字节耗时的该百分位作为对冲截止时间
+                'multiplier': 1.0,
+                'min_deadline': 1.0,  # 最短截止时间（秒）
+                'min_samples': 20,  # 样本不足时不进行对冲
+                'budget_percent': 5  # 对冲请求占全部请求的上限百分比
+            },
+            'scheduler': {
+                'policy': 'fifo',  # fifo/shortest/fair/deadline
+                'default_priority': 0  # 新任务的默认优先级，数值越大越先下载
+            },
+            'metadata': {
+                'enabled': False,  # 使用gdata API获取标题和页数
+                'api_url': 'https://api.e-hentai.org/api.php',
+                'cache_file': './download/.metadata_cache.json',
+                'cache_ttl': 86400,  # 缓存有效期（秒）
+                'batch_size': 25  # 每次请求的画廊数量（API上限25）
+            },
+            'http_cache': {
+                'enabled': False,  # 缓存画廊页面和图片页面，过期后用ETag/Last-Modified重新验证
+                'cache_dir': './download/.http_cache',
+                'max_size_mb': 256,  # 缓存总大小上限，超出时淘汰最久未使用的
+                'ttl': {
+                    'gallery': 3600,  # 画廊页面及索引页（秒）
+                    'image_page': 3600  # 图片页面（其中的图片链接会过期，不宜过长）
+                }
+            },
+            'queue': {
+                'lease_seconds': 120,  # 领取画廊后的租约时长，节点失联超过此时间后其他节点可重新领取
+                'max_attempts': 3,  # 每个画廊最多尝试次数
+                'poll_interval': 5  # 队列为空时的轮询间隔（秒）
+            },
+            'daemon': {
+                'host': '127.0.0.1',  # 控制接口监听地址，默认只接受本机连接
+                'port': 8765,
+                'token': '',  # 非空时请求需携带X-Auth-Token头
+                'gui_remote': False  # GUI连接守护进程而不是在本进程中下载
+            },
+            'sync': {
+                'stop_after_known': 5,  # 连续遇到多少个已知画廊后停止翻页
+                'max_pages': 50,  # 每次同步最多抓取的列表页数
+                'cookies': {}  # 收藏夹等需要登录的列表使用的Cookie，如ipb_member_id、ipb_pass_hash
+            },
+            'catalog': {
+                'enabled': False,  # 使用本地库目录跳过已完整下载的画廊（不发起网络请求）
+                'db_path': './download/.library.db'
+            },
+            'link_cache': {
+                'enabled': True,  # 缓存画廊的图片页面链接列表，继续下载时无需重新抓取索引页
+                'cache_dir': './download/.link_cache',
+                'ttl': 604800,  # 有效期（秒）
+                'max_entries': 1000  # 最多缓存的画廊数，超出时淘汰最久未使用的
+            },
+            'update': {
+                'reuse_previous': True,  # 从旧版本画廊目录复用未变化的图片
+                'follow_newer': False  # 发现更新版本时自动下载最新版本
+            },
+            'profiling': {
+                'enabled': False,
+                'mode': 'sampling',  # sampling, cprofile
+                'top_n': 20,
+                'interval': 0.005,  # 采样间隔（秒）
+                # --startup-benchmark的导入耗时预算（毫秒）
+                'import_budget_ms': {'ehentai_downloader': 150, 'ehentai_downloader_gui': 250}
             }
         }
-        self.config = self.load_config()
+        self.file_config = self.load_config()  # 配置文件中的值（与默认配置合并后）
+        self.config = copy.deepcopy(self.file_config)
+        self.overrides = {}  # 通过set()修改、与配置文件不同且尚未保存的值（命令行参数、界面上的修改）
+        self.mtime = self._get_mtime()
+
+    def _get_mtime(self):
+        """配置文件的修改时间，文件不存在时为None"""
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+
+    def file_changed(self):
+        """配置文件是否在上次加载或保存后被外部修改"""
+        mtime = self._get_mtime()
+        return mtime is not None and mtime != self.mtime
+
+    def reload_if_changed(self):
+        """
+        配置文件被外部修改时重新加载，通过set()修改且尚未保存的值保留
+        :return: 是否重新加载
+        """
+        if not self.file_changed():
+            return False
+        self.mtime = self._get_mtime()
+        self.file_config = self.load_config()
+        self.config = copy.deepcopy(self.file_config)
+        for section, values in self.overrides.items():
+            self.config.setdefault(section, {}).update(values)
+        logger.info(f"配置文件已变化，重新加载: {self.config_file}")
+        return True
 
     def load_config(self):
         """加载配置文件"""
@@ -227,11 +620,11 @@ class Config:
                 return self.merge_config(self.default_config, config)
             except Exception as e:
                 logger.warning(f"加载配置文件失败: {e}，使用默认配置")
-        return self.default_config.copy()
+        return copy.deepcopy(self.default_config)
 
     def merge_config(self, default, user):
-        """合并配置"""
-        result = default.copy()
+        """合并配置（不修改默认配置）"""
+        result = copy.deepcopy(default)
         for key, value in user.items():
             if isinstance(value, dict) and key in result:
                 result[key] = self.merge_config(result[key], value)
@@ -244,6 +637,9 @@ class Config:
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(self.config, f, indent=2, ensure_ascii=False)
+            self.mtime = self._get_mtime()
+            self.file_config = copy.deepcopy(self.config)
+            self.overrides = {}
             logger.info(f"配置已保存: {self.config_file}")
         except Exception as e:
             logger.error(f"保存配置文件失败: {e}")
@@ -253,10 +649,14 @@ class Config:
         return self.config.get(section, {}).get(key, default)
 
     def set(self, section, key, value):
-        """设置配置值"""
+        """设置配置值（与配置文件不同的值记为覆盖值，重新加载配置文件时保留）"""
         if section not in self.config:
             self.config[section] = {}
         self.config[section][key] = value
+        if self.file_config.get(section, {}).get(key) == value:
+            self.overrides.get(section, {}).pop(key, None)
+        else:
+            self.overrides.setdefault(section, {})[key] = value
 
 
 class CompressionManager:
@@ -292,6 +692,37 @@ class CompressionManager:
             logger.error(f"压缩失败: {e}")
             return False
 
+    def compress_gallery(self, gallery_dir):
+        """
+        压缩画廊目录，压缩包中始终是图片文件
+        打包（pack）和SQLite存储的画廊先通过存储层导出为图片文件夹再压缩，阅读器可直接打开
+        """
+        storage = open_gallery_storage(gallery_dir)
+        backend = storage.backend
+        storage.close()
+        if backend == 'loose':
+            return self.compress_directory(gallery_dir)
+
+        import shutil
+        import tempfile
+        format_type = self.config.get('compression', 'format', 'zip')
+        # 导出目录放在画廊目录旁，与压缩包在同一磁盘上
+        staging_dir = tempfile.mkdtemp(prefix='.export_', dir=os.path.dirname(os.path.abspath(gallery_dir)))
+        try:
+            export_dir = export_gallery(gallery_dir, os.path.join(staging_dir, os.path.basename(gallery_dir)), 'folder')
+            if not self.compress_directory(export_dir, f"{gallery_dir}.{format_type}"):
+                return False
+        except Exception as e:
+            logger.error(f"压缩失败: {e}")
+            return False
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        # compress_directory只删除了导出目录，按设置删除原画廊目录
+        if self.config.get('compression', 'delete_original'):
+            shutil.rmtree(gallery_dir)
+            logger.info(f"已删除原文件夹: {gallery_dir}")
+        return True
+
     def _compress_with_7zip(self, source_dir, output_path, tool_path, 
                            format_type, compression_level, password):
         """使用7zip压缩"""
@@ -304,6 +735,7 @@ class CompressionManager:
 
         logger.info(f"开始压缩: {source_dir} -> {output_path}")
         
+        import subprocess
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
                                  stderr=subprocess.PIPE, text=True)
         
@@ -333,6 +765,7 @@ class CompressionManager:
         """使用内置zipfile压缩"""
         logger.info(f"使用内置方法压缩: {source_dir} -> {output_path}")
         
+        import zipfile
         with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for root, dirs, files in os.walk(source_dir):
                 for file in files:
@@ -353,6 +786,201 @@ class CompressionManager:
         return True
 
 
+class RunProfiler:
+    """
+    下载运行性能分析器
+    sampling模式在后台线程中定时采样已登记线程的调用栈，覆盖所有下载线程；
+    cprofile模式对画廊线程及每次图片下载分别使用cProfile，最后合并统计；
+    无法同时启用多个cProfile时（Python 3.12+），工作线程退回采样方式。
+    """
+    def __init__(self, mode='sampling', top_n=20, interval=0.005):
+        self.mode = mode if mode in ('sampling', 'cprofile') else 'sampling'
+        self.top_n = top_n
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.elapsed = 0
+
+        # cProfile模式
+        self._main_profile = None
+        self._profiles = []
+        self._cprofile_fallback = False  # 工作线程是否已退回采样方式
+
+        # 采样模式
+        self._thread_ids = {}  # 线程id -> 进入分析范围的嵌套层数
+        self._sampler_thread = None
+        self._stop_event = threading.Event()
+        self._sample_count = 0
+        self._self_counts = {}  # 函数 -> 位于栈顶的采样数
+        self._cum_counts = {}  # 函数 -> 出现在栈中的采样数
+        self._stacks = {}  # 折叠调用栈 -> 采样数
+
+    def start(self):
+        """开始分析（在画廊下载线程中调用）"""
+        self.start_time = time.time()
+        if self.mode == 'cprofile':
+            import cProfile
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+        else:
+            self._enter_thread()
+            self._start_sampler()
+
+    def stop(self):
+        """停止分析"""
+        self.elapsed = time.time() - self.start_time if self.start_time else 0
+        if self.mode == 'cprofile':
+            if self._main_profile:
+                self._main_profile.disable()
+        else:
+            self._exit_thread()
+        self._stop_event.set()
+        if self._sampler_thread:
+            self._sampler_thread.join()
+
+    def _start_sampler(self):
+        """启动采样线程（已启动时忽略）"""
+        with self.lock:
+            if self._sampler_thread:
+                return
+            self._sampler_thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler_thread.start()
+
+    def _enter_thread(self):
+        """登记当前线程，仅在分析范围内的线程才会被采样"""
+        ident = threading.get_ident()
+        with self.lock:
+            self._thread_ids[ident] = self._thread_ids.get(ident, 0) + 1
+
+    def _exit_thread(self):
+        """注销当前线程，线程池线程离开分析范围后不再被采样"""
+        ident = threading.get_ident()
+        with self.lock:
+            depth = self._thread_ids.get(ident, 0) - 1
+            if depth > 0:
+                self._thread_ids[ident] = depth
+            else:
+                self._thread_ids.pop(ident, None)
+
+    @contextmanager
+    def thread_scope(self):
+        """在下载工作线程中包裹一次图片下载，使其计入分析结果"""
+        if self.mode == 'cprofile':
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Python 3.12+ 同一时间只允许一个cProfile处于激活状态，工作线程改为采样
+                if not self._cprofile_fallback:
+                    self._cprofile_fallback = True
+                    logger.warning(f"工作线程无法启用cProfile ({e})，改用采样方式分析工作线程")
+                profile = None
+            if profile:
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    with self.lock:
+                        self._profiles.append(profile)
+                return
+            self._start_sampler()
+
+        self._enter_thread()
+        try:
+            yield
+        finally:
+            self._exit_thread()
+
+    def _sample_loop(self):
+        """采样线程主循环"""
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            with self.lock:
+                thread_ids = set(self._thread_ids)
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or ident not in thread_ids:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self._sample_count += 1
+                self._self_counts[stack[0]] = self._self_counts.get(stack[0], 0) + 1
+                for func in set(stack):
+                    self._cum_counts[func] = self._cum_counts.get(func, 0) + 1
+                collapsed = ';'.join(reversed(stack))
+                self._stacks[collapsed] = self._stacks.get(collapsed, 0) + 1
+
+    def summary(self):
+        """生成热点函数摘要文本"""
+        if self.mode == 'cprofile':
+            import io
+            import pstats
+            profiles = ([self._main_profile] if self._main_profile else []) + self._profiles
+            if not profiles:
+                text = "没有采集到分析数据"
+            else:
+                stream = io.StringIO()
+                stats = pstats.Stats(*profiles, stream=stream)
+                stats.sort_stats('cumulative').print_stats(self.top_n)
+                text = stream.getvalue()
+            if self._sample_count:
+                text += "\n工作线程采样结果:\n" + self._sample_summary()
+            return text
+        return self._sample_summary()
+
+    def _sample_summary(self):
+        """生成采样数据的热点函数摘要"""
+        if not self._sample_count:
+            return "没有采集到采样数据"
+        lines = [f"采样数: {self._sample_count}, 耗时: {self.elapsed:.1f}秒, 间隔: {self.interval}秒",
+                 f"{'self%':>7} {'cum%':>7}  函数"]
+        hot = sorted(self._self_counts.items(), key=lambda item: item[1], reverse=True)[:self.top_n]
+        for func, count in hot:
+            self_pct = count * 100.0 / self._sample_count
+            cum_pct = self._cum_counts.get(func, 0) * 100.0 / self._sample_count
+            lines.append(f"{self_pct:6.1f}% {cum_pct:6.1f}%  {func}")
+        return '\n'.join(lines)
+
+    def save(self, output_dir):
+        """
+        保存分析结果并在日志中输出热点摘要
+        :param output_dir: 输出目录（与task_info.ini相同）
+        :return: 统计文件路径
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        summary = self.summary()
+
+        if self.mode == 'cprofile':
+            import pstats
+            profiles = ([self._main_profile] if self._main_profile else []) + self._profiles
+            stats_path = os.path.join(output_dir, f'profile_{timestamp}.prof')
+            if profiles:
+                pstats.Stats(*profiles).dump_stats(stats_path)
+            if self._stacks:
+                self._save_stacks(os.path.join(output_dir, f'profile_{timestamp}.txt'), summary)
+        else:
+            # 折叠栈格式，可直接用于火焰图工具
+            stats_path = os.path.join(output_dir, f'profile_{timestamp}.txt')
+            self._save_stacks(stats_path, summary)
+
+        logger.info(f"性能分析热点函数 (前 {self.top_n} 个):\n{summary}")
+        logger.info(f"性能分析结果已保存到: {stats_path}")
+        return stats_path
+
+    def _save_stacks(self, path, summary):
+        """以折叠栈格式保存采样数据"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(summary + '\n\n')
+            for stack, count in sorted(self._stacks.items(), key=lambda item: item[1], reverse=True):
+                f.write(f"{stack} {count}\n")
+
+
 def webp_to_jpg(input_path, output_path=None, quality=95):
     """
     将WebP图像转换为JPG格式
@@ -390,12 +1018,12 @@ def safe_path(original_path: str) -> str:
     # 使用 pathlib 解析路径
     path_obj = Path(original_path)
 
-    # 处理驱动器（如 C:）
-    drive = f"{path_obj.drive}\\"
-    parts = list(path_obj.parts[1:] if drive else path_obj.parts)
+    # 处理路径锚点（如 C:\\ 或 /），相对路径没有锚点
+    anchor = path_obj.anchor
+    parts = list(path_obj.parts[1:] if anchor else path_obj.parts)
 
     # 清理每个路径部分
-    sanitized_parts = [drive] if drive else []
+    sanitized_parts = [anchor] if anchor else []
     for part in parts:
         sanitized_part = sanitize_path_component(part)
         sanitized_parts.append(sanitized_part)
@@ -404,38 +1032,2057 @@ def safe_path(original_path: str) -> str:
     return os.path.join(*sanitized_parts)
 
 
-class DownloadManager:
-    """下载管理器，统一管理所有下载任务"""
-    def __init__(self, config=None):
-        self.config = config or Config()
-        self.tasks = {}  # task_id -> DownloadTask
-        self.active_tasks = set()  # 正在运行的任务ID
-        self.max_concurrent = self.config.get('download', 'max_concurrent', 3)
+IMAGE_PAGE_PATTERN = re.compile(r'/s/([0-9a-f]{10})/(\d+)-(\d+)')
+
+
+def parse_image_page_url(image_page_url):
+    """
+    解析图片页面URL
+    /s/<token>/<gid>-<page> 中的token为原图SHA-1的前10位
+    :return: (token, gid, page)，无法解析时返回 (None, None, None)
+    """
+    match = IMAGE_PAGE_PATTERN.search(image_page_url)
+    if not match:
+        return None, None, None
+    return match.group(1), match.group(2), match.group(3)
+
+
+class ImageStatusTable:
+    """
+    紧凑的图片状态表
+    按页码保存状态码（bytearray）和哈希token（每页10字节），失败信息单独稀疏保存；
+    提供与 dict[图片页面URL] = 状态字符串 相同的读写接口；
+    URL的协议和域名取自第一个记录的URL，无法按此还原的URL单独保存，保证读出的URL与写入时一致
+    """
+    STATUS_CODES = {'success': 1, 'skipped': 2, 'failed': 3, 'pending': 4}
+    STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+    TOKEN_SIZE = 10
+
+    def __init__(self):
+        self.gid = None
+        self.base_url = None  # 协议和域名，如 https://e-hentai.org
+        self.codes = bytearray()
+        self.tokens = bytearray()
+        self.messages = {}  # 页码 -> 完整状态字符串（仅带附加信息的失败状态）
+        self.extra = {}  # 无法解析的URL -> 状态字符串
+
+    def _ensure_size(self, page):
+        if page >= len(self.codes):
+            grow = page + 1 - len(self.codes)
+            self.codes.extend(bytes(grow))
+            self.tokens.extend(bytes(grow * self.TOKEN_SIZE))
+
+    def __setitem__(self, image_page_url, status):
+        token, gid, page = parse_image_page_url(image_page_url)
+        if token and self.gid is None:
+            parsed = urlparse(image_page_url)
+            self.gid = gid
+            self.base_url = f"{parsed.scheme}://{parsed.netloc}"
+        if not token or gid != self.gid or self._url(int(page), token) != image_page_url:
+            self.extra[image_page_url] = status
+            return
+        page = int(page)
+        self._ensure_size(page)
+        name = status.split(':')[0]
+        self.codes[page] = self.STATUS_CODES.get(name, self.STATUS_CODES['failed'])
+        offset = page * self.TOKEN_SIZE
+        self.tokens[offset:offset + self.TOKEN_SIZE] = token.encode('ascii')
+        if status != name or name not in self.STATUS_CODES:
+            self.messages[page] = status
+        else:
+            self.messages.pop(page, None)
+
+    def _url(self, page, token=None):
+        if token is None:
+            offset = page * self.TOKEN_SIZE
+            token = self.tokens[offset:offset + self.TOKEN_SIZE].decode('ascii')
+        return f"{self.base_url}/s/{token}/{self.gid}-{page}"
+
+    def get_page(self, page):
+        """获取指定页码的状态字符串，未记录时返回None"""
+        if page >= len(self.codes) or not self.codes[page]:
+            return None
+        return self.messages.get(page) or self.STATUS_NAMES[self.codes[page]]
+
+    def items(self):
+        """按页码顺序遍历 (图片页面URL, 状态字符串)"""
+        for page, code in enumerate(self.codes):
+            if code:
+                yield self._url(page), self.messages.get(page) or self.STATUS_NAMES[code]
+        yield from self.extra.items()
+
+    def __len__(self):
+        return sum(1 for code in self.codes if code) + len(self.extra)
+
+
+def _file_sha1(path):
+    """计算文件的SHA1"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _verify_image_file(storage, name, expected_token):
+    """
+    校验单个图片
+    :param expected_token: 图片页面URL中的哈希token，WebP转换后的图片为转换时记录的完整SHA1
+    :return: ok（哈希一致）、unverifiable（哈希不一致但图片完整，如缩放图或没有转换记录的JPG）、corrupt
+    """
+    with storage.open(name) as f:
+        sha1 = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+        if sha1.hexdigest().startswith(expected_token):
+            return 'ok'
+        f.seek(0)
+        try:
+            with Image.open(f) as img:
+                img.load()
+            return 'unverifiable'
+        except Exception:
+            return 'corrupt'
+
+
+def write_task_info(task_info, ini_path):
+    """
+    写入任务信息INI文件：先写临时文件再替换，磁盘已满等写入失败时保留原文件，不会留下不完整的INI
+    """
+    tmp_path = ini_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            task_info.write(f)
+        os.replace(tmp_path, ini_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def verify_gallery(gallery_dir, max_workers=8):
+    """
+    并行校验已下载画廊目录中的图片
+    损坏的图片会被移除（散文件重命名为 *.corrupt），并在task_info.ini中标记为失败，以便通过INI继续下载
+
+    :param gallery_dir: 画廊目录（包含task_info.ini）
+    :param max_workers: 并行校验线程数
+    :return: 结果统计字典，失败时返回None
+    """
+    ini_path = os.path.join(gallery_dir, 'task_info.ini')
+    if not os.path.exists(ini_path):
+        logger.error(f"INI文件不存在: {ini_path}")
+        return None
+
+    task_info = configparser.ConfigParser()
+    task_info.read(ini_path, encoding='utf-8')
+    if 'ImageStatus' not in task_info:
+        logger.error("INI文件格式错误: 缺少ImageStatus部分")
+        return None
+
+    # WebP转换后的图片与token不再一致，改用转换时记录的哈希校验
+    converted_hashes = dict(task_info['ConvertedHashes']) if 'ConvertedHashes' in task_info else {}
+
+    # 收集需要校验的图片
+    storage = open_gallery_storage(gallery_dir)
+    to_verify = []
+    missing = []
+    for img_index, value in task_info['ImageStatus'].items():
+        url = value.split(' | ')[0]
+        token, _, _ = parse_image_page_url(url)
+        if not token:
+            continue
+        name = storage.find(img_index)
+        if name:
+            to_verify.append((img_index, url, converted_hashes.get(img_index, token), name))
+        else:
+            missing.append(url)
+
+    logger.info(f"开始校验 {len(to_verify)} 张图片: {gallery_dir}")
+    results = {'ok': 0, 'unverifiable': 0, 'corrupt': 0, 'missing': len(missing)}
+    corrupt_items = []
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_item = {executor.submit(_verify_image_file, storage, name, token): (img_index, url, token, name)
+                          for img_index, url, token, name in to_verify}
+        for future in futures.as_completed(future_to_item):
+            img_index, url, token, name = future_to_item[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"校验图片 {img_index} 失败: {e}")
+                result = 'corrupt'
+            results[result] += 1
+            if result == 'corrupt':
+                corrupt_items.append((img_index, url, name))
+
+    # 移除损坏的图片，使其可以被重新下载
+    for img_index, url, name in corrupt_items:
+        logger.warning(f"图片 {img_index} 校验失败: {name}")
+        storage.remove(name)
+        task_info['ImageStatus'][img_index] = f"{url} | failed: 校验失败"
+    storage.close()
+
+    if corrupt_items:
+        # 损坏的图片从已下载计入失败，保持继续下载时的统计正确
+        if 'Gallery' in task_info:
+            gallery = task_info['Gallery']
+            gallery['Downloaded'] = str(max(0, int(gallery.get('Downloaded', '0')) - len(corrupt_items)))
+            gallery['Failed'] = str(int(gallery.get('Failed', '0')) + len(corrupt_items))
+        if 'FailedLinks' not in task_info:
+            task_info['FailedLinks'] = {}
+        failed_links = set(task_info['FailedLinks'].values())
+        for _, url, _ in corrupt_items:
+            if url not in failed_links:
+                task_info['FailedLinks'][f'Link{len(task_info["FailedLinks"]) + 1}'] = url
+        write_task_info(task_info, ini_path)
+
+    logger.info(f"校验完成! 正常: {results['ok']}张, 无法校验: {results['unverifiable']}张, "
+                f"损坏: {results['corrupt']}张, 缺失: {results['missing']}张")
+    return results
+
+
+GALLERY_URL_PATTERN = re.compile(r'/g/(\d+)/([0-9a-f]+)')
+
+
+def parse_gallery_url(gallery_url):
+    """
+    解析画廊URL
+    :return: (gid, token)，无法解析时返回 (None, None)
+    """
+    match = GALLERY_URL_PATTERN.search(gallery_url or '')
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+# task_info.ini路径 -> (修改时间, gid)，查找旧版本画廊时只解析新增或修改过的INI
+_ini_gid_cache = {}
+_ini_gid_lock = threading.Lock()
+
+
+def _read_ini_gid(ini_path, mtime):
+    """读取task_info.ini中画廊的gid（按修改时间缓存）"""
+    with _ini_gid_lock:
+        cached = _ini_gid_cache.get(ini_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    task_info = configparser.ConfigParser()
+    try:
+        task_info.read(ini_path, encoding='utf-8')
+    except configparser.Error:
+        return None
+    gid = parse_gallery_url(task_info['Gallery'].get('URL'))[0] if 'Gallery' in task_info else None
+    with _ini_gid_lock:
+        _ini_gid_cache[ini_path] = (mtime, gid)
+    return gid
+
+
+def find_local_gallery_dir(base_dir, gid, catalog=None):
+    """
+    在输出目录中查找指定gid的已下载画廊目录
+    :param catalog: 本地库目录，启用时先按gid查询
+    :return: 画廊目录路径，未找到时返回None
+    """
+    if not gid or not os.path.isdir(base_dir):
+        return None
+    if catalog:
+        entry = catalog.lookup(gid)
+        if entry and entry['path'] and os.path.exists(os.path.join(entry['path'], 'task_info.ini')):
+            return entry['path']
+    for entry in os.scandir(base_dir):
+        if not entry.is_dir():
+            continue
+        ini_path = os.path.join(entry.path, 'task_info.ini')
+        try:
+            mtime = os.path.getmtime(ini_path)
+        except OSError:
+            continue
+        if _read_ini_gid(ini_path, mtime) == gid:
+            return entry.path
+    return None
+
+
+def load_gallery_token_map(gallery_dir, storage):
+    """
+    读取已下载画廊中图片的哈希token与图片名的对应关系（任意存储方式）
+    :param storage: 该画廊的图片存储
+    :return: dict token -> 图片名
+    """
+    ini_path = os.path.join(gallery_dir, 'task_info.ini')
+    task_info = configparser.ConfigParser()
+    task_info.read(ini_path, encoding='utf-8')
+    token_map = {}
+    if 'ImageStatus' not in task_info:
+        return token_map
+    for img_index, value in task_info['ImageStatus'].items():
+        token, _, _ = parse_image_page_url(value.split(' | ')[0])
+        if not token:
+            continue
+        name = storage.find(img_index)
+        if name:
+            token_map[token] = name
+    return token_map
+
+
+class MetadataClient:
+    """
+    画廊元数据客户端
+    通过gdata API批量获取标题、页数等信息，并缓存在本地JSON文件中
+    """
+    # 同一缓存文件在进程内共享
+    _caches = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, config):
+        self.api_url = config.get('metadata', 'api_url', 'https://api.e-hentai.org/api.php')
+        self.cache_file = config.get('metadata', 'cache_file', './download/.metadata_cache.json')
+        self.cache_ttl = config.get('metadata', 'cache_ttl', 86400)
+        self.batch_size = min(config.get('metadata', 'batch_size', 25), 25)
+        self.timeout = config.get('download', 'timeout', 30)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Referer': 'https://e-hentai.org/'
+        })
+
+        with self._cache_lock:
+            if self.cache_file not in self._caches:
+                self._caches[self.cache_file] = self._load_cache()
+            self.cache = self._caches[self.cache_file]
+
+    def _load_cache(self):
+        """加载缓存文件"""
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"加载元数据缓存失败: {e}")
+        return {}
+
+    def _save_cache(self):
+        """保存缓存文件（调用方需持有锁）"""
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = self.cache_file + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_file)
+        except Exception as e:
+            logger.warning(f"保存元数据缓存失败: {e}")
+
+    def get_cached(self, gallery_url):
+        """
+        只从缓存获取元数据，不发起网络请求
+        :return: 元数据字典，未缓存或已过期时返回None
+        """
+        gid, _ = parse_gallery_url(gallery_url)
+        if not gid:
+            return None
+        with self._cache_lock:
+            entry = self.cache.get(gid)
+        if entry and time.time() - entry.get('fetched_at', 0) < self.cache_ttl:
+            return entry
+        return None
+
+    def get(self, gallery_url):
+        """获取单个画廊的元数据（优先使用缓存）"""
+        return self.fetch_many([gallery_url]).get(gallery_url)
+
+    def fetch_many(self, gallery_urls):
+        """
+        批量获取画廊元数据
+        :param gallery_urls: 画廊URL列表
+        :return: dict 画廊URL -> 元数据字典（获取失败的URL不包含在内）
+        """
+        result = {}
+        to_fetch = {}  # gid -> (token, [urls])
+        for url in gallery_urls:
+            cached = self.get_cached(url)
+            if cached:
+                result[url] = cached
+                continue
+            gid, token = parse_gallery_url(url)
+            if gid:
+                to_fetch.setdefault(gid, (token, []))[1].append(url)
+
+        gids = list(to_fetch)
+        for start in range(0, len(gids), self.batch_size):
+            batch = gids[start:start + self.batch_size]
+            payload = {
+                'method': 'gdata',
+                'gidlist': [[int(gid), to_fetch[gid][0]] for gid in batch],
+                'namespace': 1
+            }
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                gmetadata = response.json().get('gmetadata', [])
+            except Exception as e:
+                logger.warning(f"获取画廊元数据失败: {e}")
+                continue
+
+            import html
+            fetched_at = time.time()
+            with self._cache_lock:
+                for item in gmetadata:
+                    if 'error' in item:
+                        continue
+                    gid = str(item.get('gid'))
+                    entry = {
+                        'gid': gid,
+                        'token': item.get('token'),
+                        'title': html.unescape(item.get('title', '')),
+                        'filecount': int(item.get('filecount', 0)),
+                        'filesize': int(item.get('filesize', 0)),
+                        'fetched_at': fetched_at
+                    }
+                    self.cache[gid] = entry
+                    for url in to_fetch.get(gid, (None, []))[1]:
+                        result[url] = entry
+                self._save_cache()
+            logger.info(f"已通过API获取 {len(gmetadata)} 个画廊的元数据")
+        return result
+
+
+class LinkListCache:
+    """
+    画廊图片页面链接列表缓存
+    每个画廊一个JSON文件（以gid命名），记录链接列表、标题、页数和抓取时间；
+    文件修改时间作为最近使用时间，超出数量上限时按LRU淘汰
+    """
+    # 同一缓存目录在进程内共享一个实例，条目数只统计一次
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, config):
+        self.cache_dir = config.get('link_cache', 'cache_dir', './download/.link_cache')
+        self._configure(config)
         self.lock = threading.Lock()
-        
-        # 回调函数
-        self.task_added_callback = None
-        self.task_updated_callback = None
-        self.task_removed_callback = None
-        
-    def set_max_concurrent(self, max_concurrent):
-        """设置最大并发数"""
+        self.entry_count = None  # 首次写入时统计
+
+    def _configure(self, config):
+        self.ttl = config.get('link_cache', 'ttl', 604800)
+        self.max_entries = config.get('link_cache', 'max_entries', 1000)
+
+    @classmethod
+    def shared(cls, config):
+        """获取配置中缓存目录的进程内共享实例（有效期和数量上限按当前配置更新）"""
+        key = os.path.abspath(config.get('link_cache', 'cache_dir', './download/.link_cache'))
+        with cls._instances_lock:
+            cache = cls._instances.get(key)
+            if cache is None:
+                cache = cls._instances[key] = cls(config)
+            else:
+                cache._configure(config)
+        return cache
+
+    def _entry_path(self, gid):
+        return os.path.join(self.cache_dir, f"{gid}.json")
+
+    def get(self, gid, page_count=None):
+        """
+        获取缓存的链接列表
+        :param page_count: 画廊当前页数，与缓存不一致时视为失效
+        :return: 缓存条目字典，未缓存、过期或失效时返回None
+        """
+        path = self._entry_path(gid)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('fetched_at', 0) >= self.ttl:
+            self.invalidate(gid)
+            return None
+        if page_count is not None and entry.get('page_count') != page_count:
+            logger.info(f"画廊页数已变化（{entry.get('page_count')} -> {page_count}），链接缓存失效")
+            self.invalidate(gid)
+            return None
+
+        # 更新最近使用时间
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, gid, title, links, page_count):
+        """
+        保存链接列表，并淘汰超出上限的旧条目
+        :param page_count: 画廊页数，与链接数不一致（列表不完整）时不缓存
+        """
+        if page_count is None or len(links) != page_count:
+            return
+        entry = {
+            'gid': gid,
+            'title': title,
+            'page_count': page_count,
+            'links': links,
+            'fetched_at': time.time()
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._entry_path(gid)
+            existed = os.path.exists(path)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"保存链接缓存失败: {e}")
+            return
         with self.lock:
-            self.max_concurrent = max_concurrent
-            self.config.set('download', 'max_concurrent', max_concurrent)
-            self._start_waiting_tasks_unlocked()
-    
-    def set_callbacks(self, task_added=None, task_updated=None, task_removed=None):
-        """设置回调函数"""
-        self.task_added_callback = task_added
-        self.task_updated_callback = task_updated
-        self.task_removed_callback = task_removed
-    
-    def add_task(self, url, progress_callback=None, status_callback=None):
-        """添加下载任务"""
-        task_id = str(uuid.uuid4())[:8]
-        
+            if self.entry_count is None:
+                self.entry_count = self._count_entries()
+            elif not existed:
+                self.entry_count += 1
+            if self.entry_count > self.max_entries:
+                self._evict()
+
+    def invalidate(self, gid):
+        """删除画廊的缓存条目"""
+        try:
+            os.remove(self._entry_path(gid))
+        except OSError:
+            return
+        with self.lock:
+            if self.entry_count is not None:
+                self.entry_count = max(0, self.entry_count - 1)
+
+    def _count_entries(self):
+        """统计缓存目录中的条目数"""
+        try:
+            return sum(1 for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json'))
+        except OSError:
+            return 0
+
+    def _evict(self):
+        """按最近使用时间淘汰条目，直到条目数降到上限的90%（调用方需持有锁）"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return
+        self.entry_count = len(entries)
+        target = int(self.max_entries * 0.9)
+        if self.entry_count <= target:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:self.entry_count - target]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.entry_count -= 1
+
+
+class LibraryCatalog:
+    """
+    本地画廊库目录（SQLite）
+    记录每个已下载画廊的gid、token、标题、路径、页数、完成状态和压缩包路径，
+    由task_info.ini增量扫描建立，下载完成时更新，用于在任何网络请求之前跳过已完成的画廊
+    """
+
+    def __init__(self, config):
+        self.db_path = config.get('catalog', 'db_path', './download/.library.db')
+        self.archive_formats = ['zip', '7z', 'rar']
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS galleries (
+                    gid INTEGER PRIMARY KEY,
+                    token TEXT,
+                    title TEXT,
+                    url TEXT,
+                    path TEXT,
+                    page_count INTEGER,
+                    downloaded INTEGER,
+                    failed INTEGER,
+                    pending INTEGER,
+                    complete INTEGER,
+                    archive_path TEXT,
+                    ini_mtime REAL,
+                    updated_at REAL,
+                    dir_mtime REAL
+                )''')
+            # 旧版本的库目录没有dir_mtime列
+            columns = {row['name'] for row in self.conn.execute('PRAGMA table_info(galleries)')}
+            if 'dir_mtime' not in columns:
+                self.conn.execute('ALTER TABLE galleries ADD COLUMN dir_mtime REAL')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_galleries_path ON galleries(path)')
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, gid):
+        """按gid查询画廊记录"""
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM galleries WHERE gid = ?', (int(gid),)).fetchone()
+        return dict(row) if row else None
+
+    def find_complete(self, gallery_url):
+        """
+        查询已完整下载的画廊（只读本地文件，不发起网络请求）
+        :return: 画廊记录，未下载、未完成或文件已丢失时返回None
+        """
+        gid, _ = parse_gallery_url(gallery_url)
+        entry = self.lookup(gid) if gid else None
+        if not entry or not entry['complete']:
+            return None
+        if entry['path'] and os.path.isdir(entry['path']):
+            # 画廊目录的修改时间与记录时相同说明其中的文件没有增删，不必逐个统计图片
+            dir_mtime = os.path.getmtime(entry['path'])
+            if dir_mtime == entry['dir_mtime']:
+                return entry
+            if count_gallery_images(entry['path']) >= entry['page_count']:
+                with self.lock, self.conn:
+                    self.conn.execute('UPDATE galleries SET dir_mtime = ? WHERE gid = ?', (dir_mtime, entry['gid']))
+                return entry
+        # 原文件夹已在压缩后删除时以压缩包为准
+        if entry['archive_path'] and os.path.exists(entry['archive_path']):
+            return entry
+        return None
+
+    def record_ini(self, ini_path):
+        """
+        根据task_info.ini更新画廊记录
+        :return: 是否成功记录
+        """
+        task_info = configparser.ConfigParser()
+        try:
+            task_info.read(ini_path, encoding='utf-8')
+        except configparser.Error as e:
+            logger.warning(f"无法解析 {ini_path}: {e}")
+            return False
+        if 'Gallery' not in task_info:
+            return False
+        gallery = task_info['Gallery']
+        gid, token = parse_gallery_url(gallery.get('URL', ''))
+        if not gid:
+            return False
+
+        def count(key):
+            value = gallery.get(key, '0')
+            return int(value) if value.lstrip('-').isdigit() else 0
+
+        path = os.path.dirname(os.path.abspath(ini_path))
+        total = count('TotalImages')
+        complete = (total > 0 and count('Failed') <= 0 and count('Pending') <= 0
+                    and count('Downloaded') + count('Skipped') >= total)
+        archive_path = next((f"{path}.{fmt}" for fmt in self.archive_formats
+                             if os.path.exists(f"{path}.{fmt}")), None)
+        # 只有完整的画廊在查询时需要目录修改时间
+        dir_mtime = os.path.getmtime(path) if complete else None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO galleries (gid, token, title, url, path, page_count, downloaded, failed, '
+                'pending, complete, archive_path, ini_mtime, updated_at, dir_mtime) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (int(gid), token, gallery.get('Title', ''), gallery.get('URL', ''), path, total,
+                 count('Downloaded'), count('Failed'), count('Pending'), int(complete), archive_path,
+                 os.path.getmtime(ini_path), time.time(), dir_mtime))
+        return True
+
+    def record_archive(self, gallery_dir, archive_path):
+        """记录画廊的压缩包路径"""
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE galleries SET archive_path = ?, updated_at = ? WHERE path = ?',
+                              (archive_path, time.time(), os.path.abspath(gallery_dir)))
+
+    def scan(self, base_dir):
+        """
+        增量扫描输出目录下的task_info.ini，只解析新增或修改过的文件
+        :return: (扫描的画廊数, 更新的画廊数)
+        """
+        if not os.path.isdir(base_dir):
+            return 0, 0
+        with self.lock:
+            known = {row['path']: row['ini_mtime'] for row in
+                     self.conn.execute('SELECT path, ini_mtime FROM galleries')}
+        scanned = updated = 0
+        for entry in os.scandir(base_dir):
+            if not entry.is_dir():
+                continue
+            ini_path = os.path.join(entry.path, 'task_info.ini')
+            try:
+                mtime = os.path.getmtime(ini_path)
+            except OSError:
+                continue
+            scanned += 1
+            if known.get(os.path.abspath(entry.path)) == mtime:
+                continue
+            if self.record_ini(ini_path):
+                updated += 1
+        logger.info(f"库目录扫描完成: {scanned} 个画廊，更新 {updated} 个")
+        return scanned, updated
+
+
+class HttpCache:
+    """
+    磁盘HTTP响应缓存
+    按URL类别（画廊页面、图片页面）设置有效期，过期后携带ETag/Last-Modified条件请求重新验证；
+    每个条目由<sha1>.json（响应信息）和<sha1>.body（响应内容）组成，总大小超出上限时按LRU淘汰
+    """
+    # 同一缓存目录在进程内共享一个实例，总大小只统计一次，容量上限对所有下载器共同生效
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, config):
+        self.cache_dir = config.get('http_cache', 'cache_dir', './download/.http_cache')
+        self._configure(config)
+        self.lock = threading.Lock()
+        self.total_size = None  # 首次写入时统计
+        self.hits = 0
+        self.revalidated = 0
+
+    def _configure(self, config):
+        self.max_size = config.get('http_cache', 'max_size_mb', 256) * 1024 * 1024
+        self.ttls = config.get('http_cache', 'ttl', {'gallery': 3600, 'image_page': 3600})
+
+    @classmethod
+    def shared(cls, config):
+        """获取配置中缓存目录的进程内共享实例（有效期和容量上限按当前配置更新）"""
+        key = os.path.abspath(config.get('http_cache', 'cache_dir', './download/.http_cache'))
+        with cls._instances_lock:
+            cache = cls._instances.get(key)
+            if cache is None:
+                cache = cls._instances[key] = cls(config)
+            else:
+                cache._configure(config)
+        return cache
+
+    def get_ttl(self, url):
+        """
+        获取URL类别对应的有效期
+        :return: 有效期（秒），不缓存的URL返回None
+        """
+        parsed = urlparse(url)
+        if IMAGE_PAGE_PATTERN.search(parsed.path):
+            # 带重载键的请求用于切换图片服务器，每次都需要新的响应
+            return None if parsed.query else self.ttls.get('image_page')
+        if GALLERY_URL_PATTERN.search(parsed.path):
+            return self.ttls.get('gallery')
+        return None
+
+    def _entry_paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + '.json', base + '.body'
+
+    def lookup(self, url):
+        """
+        查找缓存条目
+        :return: (响应信息, 响应内容)，未缓存时返回None
+        """
+        meta_path, body_path = self._entry_paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        # 更新最近使用时间
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return meta, body
+
+    def is_fresh(self, url, meta):
+        """缓存条目是否仍在有效期内"""
+        ttl = self.get_ttl(url)
+        return ttl is not None and time.time() - meta.get('stored_at', 0) < ttl
+
+    def store(self, url, response):
+        """保存响应"""
+        meta = {
+            'url': url,
+            'headers': {key: value for key, value in response.headers.items()
+                        if key.lower() in ('etag', 'last-modified', 'content-type')},
+            'encoding': response.encoding,
+            'stored_at': time.time()
+        }
+        body = response.content
+        meta_path, body_path = self._entry_paths(url)
+        try:
+            os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+            old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+            # 临时文件名带线程id，多个线程同时保存同一URL时不会写入同一个临时文件
+            suffix = f'.{threading.get_ident()}.tmp'
+            with open(body_path + suffix, 'wb') as f:
+                f.write(body)
+            os.replace(body_path + suffix, body_path)
+            with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(meta_path + suffix, meta_path)
+        except OSError as e:
+            logger.warning(f"保存HTTP缓存失败: {e}")
+            return
+        with self.lock:
+            if self.total_size is None:
+                self.total_size = self._scan_size()
+            else:
+                self.total_size += len(body) - old_size
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def refresh(self, url, meta):
+        """条件请求返回304时更新缓存时间"""
+        meta['stored_at'] = time.time()
+        meta_path, _ = self._entry_paths(url)
+        # 与store()相同，先写临时文件再替换，并发的lookup不会读到写了一半的文件
+        suffix = f'.{threading.get_ident()}.tmp'
+        try:
+            with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(meta_path + suffix, meta_path)
+        except OSError:
+            pass
+
+    def invalidate(self, url):
+        """删除URL的缓存条目"""
+        _, body_path = self._entry_paths(url)
+        try:
+            size = os.path.getsize(body_path)
+        except OSError:
+            size = 0
+        for path in self._entry_paths(url):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self.lock:
+            if self.total_size is not None:
+                self.total_size = max(0, self.total_size - size)
+
+    def _scan_size(self):
+        """统计缓存目录中响应内容的总大小"""
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.body'):
+                    total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def _evict(self):
+        """按最近使用时间淘汰条目，直到总大小降到上限的90%（调用方需持有锁）"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    meta_path = os.path.join(root, name)
+                    body_path = meta_path[:-len('.json')] + '.body'
+                    try:
+                        entries.append((os.path.getmtime(meta_path), meta_path, body_path,
+                                        os.path.getsize(body_path)))
+                    except OSError:
+                        continue
+        entries.sort()
+        target = self.max_size * 0.9
+        for _, meta_path, body_path, size in entries:
+            if self.total_size <= target:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.total_size -= size
+
+
+class CachingSession:
+    """
+    带HTTP响应缓存的会话，只缓存画廊页面和图片页面的GET请求，图片数据（stream）不经过缓存
+    包装而不是继承requests.Session，模块导入时不必加载requests
+    """
+
+    def __init__(self, http_cache=None):
+        self.session = requests.Session()
+        self.http_cache = http_cache
+
+    def __getattr__(self, name):
+        # headers、cookies、mount等直接使用内部会话
+        return getattr(self.session, name)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def request(self, method, url, *args, **kwargs):
+        cache = self.http_cache
+        if (cache is None or method.upper() != 'GET' or kwargs.get('stream')
+                or cache.get_ttl(url) is None):
+            return self.session.request(method, url, *args, **kwargs)
+
+        cached = cache.lookup(url)
+        if cached and cache.is_fresh(url, cached[0]):
+            with cache.lock:
+                cache.hits += 1
+            return self._build_response(url, *cached)
+
+        # 缓存已过期：携带验证器发起条件请求
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached:
+            cached_headers = {key.lower(): value for key, value in cached[0]['headers'].items()}
+            if 'etag' in cached_headers:
+                headers['If-None-Match'] = cached_headers['etag']
+            if 'last-modified' in cached_headers:
+                headers['If-Modified-Since'] = cached_headers['last-modified']
+        response = self.session.request(method, url, *args, headers=headers, **kwargs)
+
+        if response.status_code == 304 and cached:
+            with cache.lock:
+                cache.revalidated += 1
+            cache.refresh(url, cached[0])
+            return self._build_response(url, *cached)
+        if response.status_code == 200:
+            cache.store(url, response)
+        return response
+
+    def invalidate(self, url):
+        """使URL的缓存失效（如图片页面中的图片链接已不可用）"""
+        if self.http_cache:
+            self.http_cache.invalidate(url)
+
+    @staticmethod
+    def _build_response(url, meta, body):
+        """由缓存条目构造响应对象"""
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers.update(meta['headers'])
+        response.encoding = meta.get('encoding')
+        response._content = body
+        response.from_cache = True
+        return response
+
+
+class CircuitOpenError(IOError):
+    """图片服务器处于熔断状态"""
+
+
+class DownloadCancelled(Exception):
+    """下载已取消"""
+
+
+class DownloadPaused(Exception):
+    """下载已暂停（正在传输的图片被中断，恢复后重新下载）"""
+
+
+class QuotaExceededError(Exception):
+    """图片配额已用尽（站点返回509占位图）"""
+
+
+class QuotaGuard:
+    """
+    全局图片配额状态
+    任一下载器检测到509占位图后触发，在恢复时间之前所有下载器都不再请求图片
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paused_until = 0
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """添加配额用尽监听器 listener(resume_at)"""
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """移除配额用尽监听器"""
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def trigger(self, backoff_seconds):
+        """
+        触发配额暂停
+        :return: 本次是否新触发（已处于暂停状态时返回False）
+        """
+        with self.lock:
+            if time.time() < self.paused_until:
+                return False
+            self.paused_until = time.time() + backoff_seconds
+            resume_at = self.paused_until
+            listeners = list(self.listeners)
+        logger.warning(f"检测到图片配额已用尽，暂停所有下载，{datetime.fromtimestamp(resume_at).strftime('%H:%M:%S')} 后恢复")
+        for listener in listeners:
+            try:
+                listener(resume_at)
+            except Exception as e:
+                logger.error(f"配额暂停回调失败: {e}")
+        return True
+
+    def is_active(self):
+        """是否处于配额暂停状态"""
+        return time.time() < self.paused_until
+
+    def remaining(self):
+        """距离恢复的剩余秒数"""
+        return max(0, self.paused_until - time.time())
+
+    def clear(self):
+        """手动解除配额暂停"""
+        with self.lock:
+            self.paused_until = 0
+
+
+# 进程内共享的配额状态
+QUOTA_GUARD = QuotaGuard()
+
+
+def is_quota_placeholder_url(image_link):
+    """图片链接是否为配额用尽占位图（/509.gif、/509s.gif）"""
+    path = urlparse(image_link or '').path
+    return os.path.basename(path) in ('509.gif', '509s.gif')
+
+
+class DiskSpaceLowError(Exception):
+    """输出目录所在磁盘剩余空间不足"""
+
+
+def is_disk_full_error(error):
+    """是否为磁盘已满（或超出磁盘配额）导致的写入错误"""
+    return isinstance(error, OSError) and error.errno in (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC))
+
+
+def _existing_path(path):
+    """路径尚未创建时返回最近的已存在上级目录"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def free_disk_space(path):
+    """路径所在磁盘的剩余空间（字节）"""
+    import shutil
+    return shutil.disk_usage(_existing_path(path)).free
+
+
+def format_size(size):
+    """字节数格式化为易读的大小"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+class DiskBudget:
+    """
+    磁盘空间预算
+    DownloadManager启动画廊前按估算大小（元数据中的画廊大小，或页数×已观测的平均图片大小）预留空间，
+    同一磁盘上所有运行中画廊的剩余预留加上新画廊的估算不超过剩余空间减去保留下限时才启动；
+    下载器写入图片前检查剩余空间，低于下限或写入时磁盘已满时触发全局暂停，直到空间恢复
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.min_free = 1024 * 1024 * 1024
+        self.default_image_size = 512 * 1024
+        self.reservations = {}  # key -> [磁盘设备号, 页数, 已完成页数, 画廊总大小或None]
+        self.image_bytes = 0
+        self.image_count = 0
+        self.low_path = None  # 触发空间不足暂停的路径，未暂停时为None
+        self.listeners = []
+
+    def configure(self, config):
+        """从配置更新预算参数"""
+        with self.lock:
+            self.enabled = config.get('disk', 'enabled', True)
+            self.min_free = int(config.get('disk', 'min_free_mb', 1024)) * 1024 * 1024
+            self.default_image_size = int(config.get('disk', 'default_image_kb', 512)) * 1024
+
+    def add_listener(self, listener):
+        """添加空间不足监听器 listener(path)"""
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """移除空间不足监听器"""
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def record_image(self, size, count=1):
+        """记录已下载图片的大小（count张共size字节），用于估算画廊大小"""
+        with self.lock:
+            self.image_bytes += size
+            self.image_count += count
+
+    def average_image_size(self):
+        """已观测的平均图片大小，还没有下载过图片时使用配置的默认值"""
+        with self.lock:
+            return self._average_unlocked()
+
+    def _average_unlocked(self):
+        if self.image_count:
+            return self.image_bytes / self.image_count
+        return self.default_image_size
+
+    def _estimate_unlocked(self, pages, done, total_size):
+        remaining = max(0, pages - done)
+        if total_size and pages:
+            return total_size * remaining / pages
+        return remaining * self._average_unlocked()
+
+    def estimate(self, pages, done=0, total_size=None):
+        """估算画廊剩余图片需要的空间（字节）"""
+        with self.lock:
+            return self._estimate_unlocked(pages, done, total_size)
+
+    def _reserved_unlocked(self, device, exclude=None):
+        return sum(self._estimate_unlocked(*entry[1:]) for key, entry in self.reservations.items()
+                   if entry[0] == device and key != exclude)
+
+    @staticmethod
+    def probe(path):
+        """
+        读取路径所在磁盘的状态（涉及文件系统调用，调用方不应持有其他锁）
+        :return: (磁盘设备号, 剩余空间, 总容量)
+        """
+        import shutil
+        path = _existing_path(path)
+        usage = shutil.disk_usage(path)
+        return os.stat(path).st_dev, usage.free, usage.total
+
+    def capacity(self, disk):
+        """磁盘清空后最多可用于下载的空间（总容量减去保留下限），超过它的画廊永远无法下载"""
+        return disk[2] - self.min_free
+
+    def reserve(self, key, disk, pages, done=0, total_size=None):
+        """
+        为画廊预留空间
+        :param disk: probe()返回的磁盘状态
+        :return: (是否预留成功, 需要的空间, 可用空间)；可用空间已扣除其他画廊的预留和保留下限
+        """
+        device, free, _ = disk
+        with self.lock:
+            needed = self._estimate_unlocked(pages, done, total_size)
+            if not self.enabled:
+                return True, needed, free
+            available = free - self._reserved_unlocked(device, exclude=key) - self.min_free
+            if needed > available:
+                return False, needed, max(0, available)
+            self.reservations[key] = [device, pages, done, total_size]
+            return True, needed, available
+
+    def update(self, key, pages, done):
+        """下载过程中更新画廊的页数和进度，预留空间随剩余图片减少"""
+        with self.lock:
+            entry = self.reservations.get(key)
+            if entry:
+                entry[1], entry[2] = pages, done
+
+    def release(self, key):
+        """释放画廊的预留空间"""
+        with self.lock:
+            self.reservations.pop(key, None)
+
+    def reserved(self, path):
+        """路径所在磁盘上所有画廊剩余的预留空间之和"""
+        device = os.stat(_existing_path(path)).st_dev
+        with self.lock:
+            return self._reserved_unlocked(device)
+
+    def has_space(self, path, needed=0):
+        """写入needed字节后剩余空间是否仍不低于保留下限"""
+        if not self.enabled:
+            return True
+        return free_disk_space(path) - needed >= self.min_free
+
+    def trigger(self, path):
+        """
+        触发空间不足暂停
+        :return: 本次是否新触发（已处于暂停状态时返回False）
+        """
+        with self.lock:
+            if self.low_path:
+                return False
+            self.low_path = path
+            listeners = list(self.listeners)
+        logger.warning(f"磁盘剩余空间不足（{format_size(free_disk_space(path))}，保留 {format_size(self.min_free)}）：{path}，暂停下载")
+        for listener in listeners:
+            try:
+                listener(path)
+            except Exception as e:
+                logger.error(f"空间不足暂停回调失败: {e}")
+        return True
+
+    def is_low(self):
+        """是否处于空间不足暂停状态"""
+        return self.low_path is not None
+
+    def clear(self):
+        """空间恢复后解除暂停"""
+        with self.lock:
+            self.low_path = None
+
+    def wait_for_space(self, path, check_interval=60, needed=0):
+        """
+        剩余空间不足时等待空间恢复（顺序批量下载和共享队列节点使用）
+        :param needed: 接下来要下载的画廊估算大小
+        """
+        path = self.low_path or path
+        if not self.is_low() and self.has_space(path, needed):
+            return
+        self.trigger(path)
+        logger.info(f"等待释放磁盘空间（预计需要 {format_size(needed)}），每 {check_interval} 秒检查一次: {path}")
+        while not self.has_space(path, needed):
+            time.sleep(check_interval)
+        self.clear()
+        logger.info(f"磁盘空间已恢复（{format_size(free_disk_space(path))}），继续下载")
+
+
+# 进程内共享的磁盘空间预算
+DISK_BUDGET = DiskBudget()
+
+
+class HostStats:
+    """
+    图片服务器（H@H节点）健康表
+    在所有下载器之间共享，记录每个主机滚动时间窗口内的成功/失败情况和耗时，
+    并按失败率维护熔断状态：closed（正常）、open（熔断）、half_open（冷却结束，允许一次探测请求）
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window_seconds=60, max_failure_rate=0.5, min_samples=3, open_seconds=60):
+        self.window_seconds = window_seconds  # 滚动窗口长度
+        self.max_failure_rate = max_failure_rate
+        self.min_samples = min_samples
+        self.open_seconds = open_seconds  # 熔断持续时间
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def configure(self, config):
+        """从配置更新熔断参数"""
+        with self.lock:
+            self.enabled = config.get('circuit_breaker', 'enabled', True)
+            self.window_seconds = config.get('circuit_breaker', 'window_seconds', 60)
+            self.max_failure_rate = config.get('circuit_breaker', 'failure_rate', 0.5)
+            self.min_samples = config.get('circuit_breaker', 'min_samples', 3)
+            self.open_seconds = config.get('circuit_breaker', 'open_seconds', 60)
+
+    def _entry(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {'results': deque(), 'success': 0, 'failure': 0, 'total_time': 0.0,
+                                'state': self.CLOSED, 'opened_at': 0, 'probing': None}
+        return self.hosts[host]
+
+    def _recent(self, entry, now):
+        """清理滚动窗口外的记录，返回窗口内的结果（记录按时间顺序追加，只需从头部移除）"""
+        cutoff = now - self.window_seconds
+        results = entry['results']
+        while results and results[0][0] < cutoff:
+            results.popleft()
+        return results
+
+    def _failure_rate(self, results):
+        if not results:
+            return 0.0
+        return sum(1 for _, ok in results if not ok) / len(results)
+
+    def _set_state(self, host, entry, state, now):
+        if entry['state'] != state:
+            logger.info(f"图片服务器 {host} 状态: {entry['state']} -> {state}")
+        entry['state'] = state
+        entry['probing'] = None
+        if state == self.OPEN:
+            entry['opened_at'] = now
+        elif state == self.CLOSED:
+            entry['results'].clear()
+
+    def allow_request(self, host):
+        """
+        是否允许向该主机发起请求
+        熔断冷却结束后只放行一个探测请求
+        """
+        if not self.enabled:
+            return True
+        now = time.time()
+        with self.lock:
+            entry = self._entry(host)
+            if entry['state'] == self.OPEN:
+                if now - entry['opened_at'] < self.open_seconds:
+                    return False
+                self._set_state(host, entry, self.HALF_OPEN, now)
+            if entry['state'] == self.HALF_OPEN:
+                if entry['probing']:
+                    return False
+                entry['probing'] = threading.get_ident()  # 发起探测的线程
+            return True
+
+    def release_probe(self, host):
+        """
+        当前线程的探测请求结束（无论结果如何）后释放探测标记
+        探测被暂停/取消中断或对冲请求由其他主机返回时没有记录结果，主机保持half_open，下一个请求可以再次探测
+        """
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry and entry['probing'] == threading.get_ident():
+                entry['probing'] = None
+
+    def get_state(self, host):
+        """获取主机的熔断状态"""
+        with self.lock:
+            entry = self.hosts.get(host)
+            return entry['state'] if entry else self.CLOSED
+
+    def record_success(self, host, elapsed):
+        """记录一次成功请求"""
+        now = time.time()
+        with self.lock:
+            entry = self._entry(host)
+            entry['results'].append((now, True))
+            self._recent(entry, now)
+            entry['success'] += 1
+            entry['total_time'] += elapsed
+            if entry['state'] != self.CLOSED:
+                self._set_state(host, entry, self.CLOSED, now)
+
+    def record_failure(self, host):
+        """记录一次失败请求"""
+        now = time.time()
+        with self.lock:
+            entry = self._entry(host)
+            entry['results'].append((now, False))
+            entry['failure'] += 1
+            if entry['state'] == self.HALF_OPEN:
+                self._set_state(host, entry, self.OPEN, now)
+                return
+            results = self._recent(entry, now)
+            if (self.enabled and entry['state'] == self.CLOSED and len(results) >= self.min_samples
+                    and self._failure_rate(results) >= self.max_failure_rate):
+                self._set_state(host, entry, self.OPEN, now)
+
+    def failure_rate(self, host):
+        """滚动窗口内的失败率"""
+        with self.lock:
+            entry = self.hosts.get(host)
+            if not entry:
+                return 0.0
+            return self._failure_rate(self._recent(entry, time.time()))
+
+    def snapshot(self):
+        """获取所有主机的健康信息"""
+        now = time.time()
+        with self.lock:
+            return {
+                host: {
+                    'state': entry['state'],
+                    'success': entry['success'],
+                    'failure': entry['failure'],
+                    'failure_rate': self._failure_rate(self._recent(entry, now)),
+                    'avg_time': entry['total_time'] / entry['success'] if entry['success'] else 0.0
+                }
+                for host, entry in self.hosts.items()
+            }
+
+
+# 进程内共享的图片服务器统计
+HOST_STATS = HostStats()
+
+
+def preallocate_file(f, size):
+    """按预期大小预先分配文件空间，减少碎片；不支持的系统或文件系统上不做处理，空间不足时抛出OSError"""
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if is_disk_full_error(e):
+            raise
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+    根据图片响应首字节耗时的百分位计算截止时间，并限制对冲请求所占的比例
+    """
+    def __init__(self, config, max_samples=200):
+        self.percentile = config.get('hedging', 'percentile', 95)
+        self.multiplier = config.get('hedging', 'multiplier', 1.0)
+        self.min_deadline = config.get('hedging', 'min_deadline', 1.0)
+        self.min_samples = config.get('hedging', 'min_samples', 20)
+        self.budget_percent = config.get('hedging', 'budget_percent', 5)
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.samples = []
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record_request(self):
+        """记录一次图片请求"""
+        with self.lock:
+            self.requests += 1
+
+    def record_ttfb(self, elapsed):
+        """记录一次首字节耗时"""
+        with self.lock:
+            self.samples.append(elapsed)
+            if len(self.samples) > self.max_samples:
+                self.samples.pop(0)
+
+    def deadline(self):
+        """当前对冲截止时间（秒），样本不足时返回None"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_deadline, ordered[index] * self.multiplier)
+
+    def try_acquire(self):
+        """在预算范围内申请一次对冲请求"""
+        with self.lock:
+            if (self.hedges + 1) * 100 > self.requests * self.budget_percent:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        """记录一次对冲请求先于原请求返回"""
+        with self.lock:
+            self.hedge_wins += 1
+
+
+class WorkerLimiter:
+    """并发数上限可在运行时调整的限制器，调小后超出上限的线程在开始下一张图片前等待"""
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def set_limit(self, limit):
+        """调整上限，调大时立即唤醒等待中的线程"""
+        with self.condition:
+            self.limit = max(1, int(limit))
+            self.condition.notify_all()
+
+    def acquire(self, is_cancelled=lambda: False):
+        """
+        获取一个并发槽位
+        :return: 被取消时返回False
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                if is_cancelled():
+                    return False
+                self.condition.wait()
+            self.active += 1
+            return True
+
+    def release(self):
+        """释放并发槽位"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def wake_all(self):
+        """唤醒所有等待中的线程（用于取消）"""
+        with self.condition:
+            self.condition.notify_all()
+
+
+class DedupStore:
+    """
+    跨画廊的内容寻址去重存储
+    以/s/链接中的哈希token为键保存已校验的图片，命中时硬链接到画廊目录而不重新下载
+    """
+    def __init__(self, config):
+        self.store_dir = config.get('dedup', 'store_dir', './download/.store')
+        self.link_mode = config.get('dedup', 'link_mode', 'hardlink')
+
+    def _shard_dir(self, token):
+        """按token前两位分目录，避免单个目录文件过多"""
+        return os.path.join(self.store_dir, token[:2])
+
+    def lookup(self, token):
+        """查找token对应的文件，返回路径或None"""
+        # 按可能的扩展名逐个探测，不列出整个分片目录
+        base = os.path.join(self._shard_dir(token), token)
+        for extension in IMAGE_EXTENSIONS:
+            if os.path.exists(base + extension):
+                return base + extension
+        return None
+
+    def _link(self, source, target):
+        """硬链接文件，跨设备等失败时退回复制"""
+        if self.link_mode == 'hardlink':
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass
+        import shutil
+        shutil.copy2(source, target)
+
+    def link_into(self, token, storage, basename):
+        """
+        将存储中的图片链接（或复制）到画廊的图片存储
+        :return: 保存位置，未命中时返回None
+        """
+        source = self.lookup(token)
+        if not source:
+            return None
+        try:
+            return storage.import_file(source, basename + os.path.splitext(source)[1],
+                                       hardlink=self.link_mode == 'hardlink')
+        except OSError as e:
+            logger.warning(f"从去重存储链接图片失败: {e}")
+            return None
+
+    def add(self, token, file_path):
+        """将已下载并校验的图片加入存储"""
+        if self.lookup(token):
+            return
+        shard_dir = self._shard_dir(token)
+        os.makedirs(shard_dir, exist_ok=True)
+        target = os.path.join(shard_dir, token + os.path.splitext(file_path)[1])
+        try:
+            self._link(file_path, target)
+        except OSError as e:
+            logger.warning(f"加入去重存储失败: {e}")
+
+
+SCHEDULING_POLICIES = ('fifo', 'shortest', 'fair', 'deadline')
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.gif', '.webp')
+
+
+class LooseFileStorage:
+    """每张图片保存为画廊目录中的一个文件（默认方式）"""
+    backend = 'loose'
+
+    def __init__(self, gallery_dir):
+        self.gallery_dir = gallery_dir
+        self.staging_dir = gallery_dir  # 下载中的.part文件直接写在画廊目录
+        self.lock = threading.Lock()
+        self.unsynced = []  # 保存后尚未落盘的文件
+
+    def find(self, stem):
+        """查找已保存的图片（不含扩展名），返回文件名或None"""
+        for ext in IMAGE_EXTENSIONS:
+            if os.path.exists(os.path.join(self.gallery_dir, stem + ext)):
+                return stem + ext
+        return None
+
+    def commit(self, path):
+        """保存暂存目录中下载完成的图片，返回保存位置"""
+        with self.lock:
+            self.unsynced.append(path)
+        return path
+
+    def sync(self):
+        """将已保存的图片和目录项写入磁盘"""
+        with self.lock:
+            paths, self.unsynced = self.unsynced, []
+        for path in paths:
+            with open(path, 'r+b') as f:
+                os.fsync(f.fileno())
+        if paths and os.name != 'nt':
+            # 目录项也需要落盘，否则掉电后文件可能不可见（Windows不支持打开目录）
+            fd = os.open(self.gallery_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def import_file(self, source, name, hardlink=True):
+        """从旧版本画廊或去重存储导入图片，硬链接失败时退回复制"""
+        target = os.path.join(self.gallery_dir, name)
+        if hardlink:
+            try:
+                os.link(source, target)
+                return target
+            except OSError:
+                pass
+        import shutil
+        shutil.copy2(source, target)
+        return target
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.gallery_dir)
+                      if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+
+    def count(self):
+        return len(self.names())
+
+    def open(self, name):
+        return open(os.path.join(self.gallery_dir, name), 'rb')
+
+    def read(self, name):
+        with self.open(name) as f:
+            return f.read()
+
+    def remove(self, name):
+        """移除损坏的图片，文件重命名为*.corrupt保留"""
+        path = os.path.join(self.gallery_dir, name)
+        os.replace(path, path + '.corrupt')
+
+    def close(self):
+        pass
+
+
+class _IndexedStorage:
+    """
+    单文件存储的公共部分
+    图片名索引保存在内存中，存在性检查不访问文件系统；下载中的图片暂存在本地临时目录，
+    画廊目录中只有顺序追加写入
+    """
+
+    def __init__(self, gallery_dir):
+        self.gallery_dir = gallery_dir
+        self.lock = threading.Lock()
+        self.index = {}  # 文件名 -> 存储位置
+        self.stems = {}  # 不含扩展名的文件名 -> 文件名
+        self._staging_dir = None
+
+    @property
+    def staging_dir(self):
+        with self.lock:
+            if self._staging_dir is None:
+                import tempfile
+                self._staging_dir = tempfile.mkdtemp(prefix='ehentai_staging_')
+            return self._staging_dir
+
+    def _remember(self, name, location):
+        self.index[name] = location
+        self.stems[os.path.splitext(name)[0]] = name
+
+    def _forget(self, name):
+        self.index.pop(name, None)
+        stem = os.path.splitext(name)[0]
+        if self.stems.get(stem) == name:
+            del self.stems[stem]
+
+    def find(self, stem):
+        return self.stems.get(stem)
+
+    def commit(self, path):
+        location = self.import_file(path, os.path.basename(path))
+        os.remove(path)
+        return location
+
+    def import_file(self, source, name, hardlink=True):
+        with open(source, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            # 重新下载的图片扩展名可能不同（如WebP转换），替换同名的旧图片
+            previous = self.stems.get(os.path.splitext(name)[0])
+            if previous and previous != name:
+                self._delete(previous)
+                self._forget(previous)
+            self._remember(name, self._write(name, data))
+        return f"{self.path}:{name}"
+
+    def names(self):
+        with self.lock:
+            return sorted(self.index)
+
+    def count(self):
+        return len(self.index)
+
+    def open(self, name):
+        import io
+        return io.BytesIO(self.read(name))
+
+    def read(self, name):
+        with self.lock:
+            location = self.index[name]
+            return self._read(location)
+
+    def remove(self, name):
+        with self.lock:
+            self._delete(name)
+            self._forget(name)
+
+    def sync(self):
+        """将已保存的图片写入磁盘"""
+
+    def close(self):
+        if self._staging_dir:
+            import shutil
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            self._staging_dir = None
+
+
+class PackFileStorage(_IndexedStorage):
+    """
+    画廊的所有图片追加写入images.pack，images.idx中每行记录一张图片的位置（JSON）
+    删除通过追加删除记录实现；打开时截掉写入中断留下的不完整索引行和没有索引的数据
+    """
+    backend = 'pack'
+    PACK_NAME = 'images.pack'
+    INDEX_NAME = 'images.idx'
+
+    def __init__(self, gallery_dir):
+        super().__init__(gallery_dir)
+        self.path = os.path.join(gallery_dir, self.PACK_NAME)
+        self.index_path = os.path.join(gallery_dir, self.INDEX_NAME)
+        self.pack_file = None
+        self.index_file = None
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        pack_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        with open(self.index_path, 'rb') as f:
+            content = f.read()
+        index_end = 0  # 有效索引的结尾位置
+        pack_end = 0  # 已索引数据的结尾位置
+        for line in content.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break  # 写入中断的最后一行
+            try:
+                record = json.loads(line)
+            except ValueError:
+                index_end += len(line)
+                continue
+            if not record.get('deleted'):
+                end = record['offset'] + record['size']
+                if end > pack_size:
+                    break  # 数据没有完整写入，之后的记录一并丢弃
+                pack_end = max(pack_end, end)
+            index_end += len(line)
+            if record.get('deleted'):
+                self._forget(record['name'])
+            else:
+                self._remember(record['name'], (record['offset'], record['size']))
+
+        # 截掉不完整的尾部，之后追加的记录和数据才能正确对齐
+        if index_end < len(content):
+            logger.warning(f"索引文件末尾不完整，已截断: {self.index_path}")
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(index_end)
+        if pack_end < pack_size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(pack_end)
+
+    def _append_index(self, record):
+        self.index_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.index_file.flush()
+
+    def _write(self, name, data):
+        if self.pack_file is None:
+            self.pack_file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'a', encoding='utf-8')
+        offset = self.pack_file.seek(0, os.SEEK_END)
+        self.pack_file.write(data)
+        self.pack_file.flush()
+        # 数据写入后再写索引，中断时最多留下没有索引的数据
+        self._append_index({'name': name, 'offset': offset, 'size': len(data)})
+        return offset, len(data)
+
+    def _read(self, location):
+        offset, size = location
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def sync(self):
+        with self.lock:
+            for f in (self.pack_file, self.index_file):
+                if f:
+                    os.fsync(f.fileno())
+
+    def _delete(self, name):
+        if self.index_file is None:
+            self.pack_file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'a', encoding='utf-8')
+        self._append_index({'name': name, 'deleted': True})
+
+    def close(self):
+        super().close()
+        with self.lock:
+            for f in (self.pack_file, self.index_file):
+                if f:
+                    f.close()
+            self.pack_file = self.index_file = None
+
+
+class SqliteBlobStorage(_IndexedStorage):
+    """画廊的所有图片保存在images.db的images表中，每张图片一个事务，提交时由SQLite落盘"""
+    backend = 'sqlite'
+    DB_NAME = 'images.db'
+
+    def __init__(self, gallery_dir):
+        super().__init__(gallery_dir)
+        self.path = os.path.join(gallery_dir, self.DB_NAME)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL)')
+        self.conn.commit()
+        for (name,) in self.conn.execute('SELECT name FROM images'):
+            self._remember(name, name)
+
+    def _write(self, name, data):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)', (name, data, len(data)))
+        return name
+
+    def _read(self, location):
+        row = self.conn.execute('SELECT data FROM images WHERE name = ?', (location,)).fetchone()
+        return bytes(row[0])
+
+    def _delete(self, name):
+        with self.conn:
+            self.conn.execute('DELETE FROM images WHERE name = ?', (name,))
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+STORAGE_BACKENDS = {
+    'loose': LooseFileStorage,
+    'pack': PackFileStorage,
+    'sqlite': SqliteBlobStorage
+}
+
+
+def open_gallery_storage(gallery_dir, backend='loose'):
+    """
+    打开画廊目录的图片存储
+    已有图片的画廊按目录中的文件识别存储方式，backend只用于新画廊
+    """
+    if os.path.exists(os.path.join(gallery_dir, PackFileStorage.INDEX_NAME)):
+        backend = 'pack'
+    elif os.path.exists(os.path.join(gallery_dir, SqliteBlobStorage.DB_NAME)):
+        backend = 'sqlite'
+    elif backend != 'loose' and os.path.isdir(gallery_dir) and any(
+            os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS for name in os.listdir(gallery_dir)):
+        backend = 'loose'
+    if backend not in STORAGE_BACKENDS:
+        logger.warning(f"未知的存储方式: {backend}，使用loose")
+        backend = 'loose'
+    return STORAGE_BACKENDS[backend](gallery_dir)
+
+
+def count_gallery_images(gallery_dir):
+    """统计画廊目录中已保存的图片数（任意存储方式）"""
+    storage = open_gallery_storage(gallery_dir)
+    try:
+        return storage.count()
+    finally:
+        storage.close()
+
+
+def export_gallery(gallery_dir, target=None, fmt='cbz'):
+    """
+    将画廊（任意存储方式）导出为图片文件夹或CBZ，task_info.ini一并导出
+    :param target: 导出路径，默认为画廊目录旁的同名.cbz或 *_export 文件夹
+    :return: 导出路径
+    """
+    gallery_dir = os.path.normpath(gallery_dir)
+    ini_path = os.path.join(gallery_dir, 'task_info.ini')
+    storage = open_gallery_storage(gallery_dir)
+    try:
+        names = storage.names()
+        if fmt == 'cbz':
+            import zipfile
+            target = target or gallery_dir + '.cbz'
+            # 图片已是压缩格式，不再压缩
+            with zipfile.ZipFile(target + '.tmp', 'w', zipfile.ZIP_STORED) as archive:
+                for name in names:
+                    archive.writestr(name, storage.read(name))
+                if os.path.exists(ini_path):
+                    archive.write(ini_path, 'task_info.ini')
+            os.replace(target + '.tmp', target)
+        elif fmt == 'folder':
+            import shutil
+            target = target or gallery_dir + '_export'
+            os.makedirs(target, exist_ok=True)
+            for name in names:
+                with open(os.path.join(target, name), 'wb') as f:
+                    f.write(storage.read(name))
+            if os.path.exists(ini_path):
+                shutil.copy2(ini_path, os.path.join(target, 'task_info.ini'))
+        else:
+            raise ValueError(f"未知的导出格式: {fmt}")
+    finally:
+        storage.close()
+    logger.info(f"已导出 {len(names)} 张图片: {target}")
+    return target
+
+
+def parse_deadline(value):
+    """解析截止时间（ISO格式的日期或日期时间），返回时间戳"""
+    return datetime.fromisoformat(value).timestamp()
+
+
+def schedule_key(policy, priority=0, total=0, deadline=None, group_rank=0):
+    """
+    计算调度排序键，越小越先下载；优先级高的任务总是排在优先级低的任务之前
+    :param policy: fifo按添加顺序，shortest页数少的画廊优先，fair各批量文件轮流，deadline截止时间早的优先
+    """
+    if policy == 'shortest':
+        secondary = total or float('inf')  # 页数未知的画廊排在最后
+    elif policy == 'fair':
+        secondary = group_rank
+    elif policy == 'deadline':
+        secondary = deadline if deadline is not None else float('inf')
+    else:
+        secondary = 0
+    return (-priority, secondary)
+
+
+def parse_batch_file(file_path):
+    """
+    读取批量下载文件，每行一个URL，URL后可附加调度注解，例如:
+        https://e-hentai.org/g/123456/abcdef1234/ priority=5 deadline=2026-10-20T18:00
+    :return: [{'url', 'priority', 'deadline', 'group'}]，group为文件名，用于公平调度
+    """
+    entries = []
+    group = os.path.basename(file_path)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split('#', 1)[0].split()
+            if not parts:
+                continue
+            entry = {'url': parts[0], 'priority': None, 'deadline': None, 'group': group}
+            for item in parts[1:]:
+                key, _, value = item.partition('=')
+                try:
+                    if key == 'priority':
+                        entry['priority'] = int(value)
+                    elif key == 'deadline':
+                        entry['deadline'] = parse_deadline(value)
+                    else:
+                        logger.warning(f"未知的调度注解: {item}")
+                except ValueError:
+                    logger.warning(f"无效的调度注解: {item}")
+            entries.append(entry)
+    return entries
+
+
+class DownloadManager:
+    """下载管理器，统一管理所有下载任务"""
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.tasks = {}  # task_id -> DownloadTask
+        self.active_tasks = set()  # 正在运行的任务ID
+        self.waiting_tasks = set()  # 等待启动的任务ID
+        self.max_concurrent = self.config.get('download', 'max_concurrent', 3)
+        self.lock = threading.Lock()
+        
+        # 就绪队列：(排序键, 序号, 任务ID)的最小堆
+        # 出队、取消等操作不在堆中查找删除，而是使条目失效，出堆时跳过
+        self.ready_queue = []
+        self.queue_entries = {}  # task_id -> 当前有效条目的序号
+        self.queue_seq = itertools.count()
+        
+        # 调度策略
+        self.policy = self.config.get('scheduler', 'policy', 'fifo')
+        self.task_order = itertools.count()
+        self.group_counts = {}  # 批量文件 -> 已添加的任务数，用于公平调度
+        self.metadata_client = None
+        self.catalog = None
+        self.shared_session = None  # 所有任务共用的HTTP会话（守护进程模式）
+        
+        # 因配额用尽而挂起的任务
+        self.quota_suspended_tasks = []
+        self.quota_resume_timer = None
+        QUOTA_GUARD.add_listener(self._on_quota_exceeded)
+        
+        # 磁盘空间：因空间不足而挂起的任务、正在等待空间的任务和待发送的状态通知
+        DISK_BUDGET.configure(self.config)
+        self.disk_suspended_tasks = []
+        self.disk_check_timer = None
+        self.disk_waiting_tasks = set()
+        self.disk_notices = []
+        self.disk_rejected = []  # 超过磁盘容量、需要标记为失败的任务
+        DISK_BUDGET.add_listener(self._on_disk_low)
+        
+        # 回调函数
+        self.task_added_callback = None
+        self.task_updated_callback = None
+        self.task_removed_callback = None
+        
+    def set_max_concurrent(self, max_concurrent):
+        """设置最大并发数"""
+        disk = self._probe_disk()
+        with self.lock:
+            self.max_concurrent = max_concurrent
+            self.config.set('download', 'max_concurrent', max_concurrent)
+            to_start = self._claim_ready_tasks_unlocked(disk)
+        self._start_claimed_tasks(to_start)
+    
+    def set_max_workers(self, max_workers):
+        """设置每个画廊的图片下载线程数，正在下载的画廊立即生效"""
+        with self.lock:
+            self.config.set('download', 'max_workers', max_workers)
+            # 暂停中的任务恢复后也按新的线程数下载
+            downloaders = [task.downloader for task in self.tasks.values() if task.downloader]
+        for downloader in downloaders:
+            downloader.set_max_workers(max_workers)
+
+    def reload_config(self):
+        """
+        配置文件被外部修改时重新加载，并将并发设置应用到运行中的任务
+        :return: 是否重新加载
+        """
+        if not self.config.reload_if_changed():
+            return False
+        self.set_max_concurrent(self.config.get('download', 'max_concurrent', 3))
+        self.set_max_workers(self.config.get('download', 'max_workers', 3))
+        policy = self.config.get('scheduler', 'policy', 'fifo')
+        if policy != self.policy and policy in SCHEDULING_POLICIES:
+            self.set_policy(policy)
+        return True
+
+    def set_callbacks(self, task_added=None, task_updated=None, task_removed=None):
+        """设置回调函数"""
+        self.task_added_callback = task_added
+        self.task_updated_callback = task_updated
+        self.task_removed_callback = task_removed
+    
+    def add_task(self, url, progress_callback=None, status_callback=None, priority=None, deadline=None, group=None):
+        """
+        添加下载任务
+        :param priority: 优先级，数值越大越先下载，默认使用scheduler.default_priority
+        :param deadline: 截止时间戳（deadline策略使用）
+        :param group: 所属批量文件（fair策略使用）
+        """
+        task_id = self._create_task(url, progress_callback, status_callback, priority, deadline, group)
+        
+        # 尝试立即开始任务
+        self._start_waiting_tasks()
+        
+        return task_id
+
+    def _create_task(self, url, progress_callback=None, status_callback=None, priority=None, deadline=None, group=None):
+        """创建任务并放入就绪队列，不启动任务"""
+        import uuid
+        task_id = str(uuid.uuid4())[:8]
+        
         def _progress_callback(task_id, current, total, message):
+            # 预留空间随下载进度减少；没有元数据时获取到页数后才有估算
+            if total:
+                DISK_BUDGET.update(task_id, total, current)
             if progress_callback:
                 progress_callback(task_id, current, total, message)
             if self.task_updated_callback:
@@ -448,12 +3095,13 @@ class DownloadManager:
                 self.task_updated_callback(task_id, None, None, message)
         
         def _completion_callback(task_id, status, success):
+            DISK_BUDGET.release(task_id)
+            disk = self._probe_disk()
             with self.lock:
-                if task_id in self.active_tasks:
-                    self.active_tasks.remove(task_id)
-                
-                # 尝试启动等待中的任务
-                self._start_waiting_tasks_unlocked()
+                self.active_tasks.discard(task_id)
+                # 让出的并发槽位分配给就绪队列中的任务
+                to_start = self._claim_ready_tasks_unlocked(disk)
+            self._start_claimed_tasks(to_start)
             
             if self.task_updated_callback:
                 self.task_updated_callback(task_id, None, None, status.value)
@@ -464,89 +3112,267 @@ class DownloadManager:
             status_callback=_status_callback,
             completion_callback=_completion_callback
         )
+        task.session = self.shared_session
+        
+        # 已有元数据时预先填充标题和页数
+        metadata_client = self._get_metadata_client()
+        task.metadata_client = metadata_client
+        metadata = metadata_client.get_cached(url) if metadata_client else None
+        if metadata:
+            task.title = metadata['title']
+            task.total_progress = metadata['filecount']
+            task.total_size = metadata.get('filesize') or None
+        
+        # 本地库目录中已完整下载的画廊直接标记为完成，不进入就绪队列
+        catalog = self._get_catalog()
+        task.catalog = catalog
+        entry = catalog.find_complete(url) if catalog else None
+        if entry:
+            task.status = TaskStatus.COMPLETED
+            task.title = entry['title']
+            task.output_dir = entry['path']
+            task.total_progress = task.current_progress = entry['page_count']
+            task.message = "画廊已下载完成，跳过"
+            with self.lock:
+                self.tasks[task_id] = task
+            if self.task_added_callback:
+                self.task_added_callback(task_id, url)
+            return task_id
+        
+        if priority is None:
+            priority = self.config.get('scheduler', 'default_priority', 0)
+        task.priority = priority
+        task.deadline = deadline
+        task.group = group
         
         with self.lock:
+            task.order = next(self.task_order)
+            task.group_rank = self.group_counts.get(group, 0)
+            self.group_counts[group] = task.group_rank + 1
             self.tasks[task_id] = task
+            self._enqueue_unlocked(task_id)
             
         if self.task_added_callback:
             self.task_added_callback(task_id, url)
-        
-        # 尝试立即开始任务
-        self._try_start_task(task_id)
-        
         return task_id
     
+    def add_tasks(self, entries, progress_callback=None, status_callback=None):
+        """
+        批量添加下载任务
+        启用元数据API时先批量获取所有画廊的元数据，使任务开始前就有标题和页数；
+        所有任务都进入就绪队列后才统一启动，调度策略能看到整批任务，而不是按文件顺序先启动前几个
+        :param entries: URL列表，或parse_batch_file()返回的带调度注解的条目
+        """
+        entries = [entry if isinstance(entry, dict) else {'url': entry} for entry in entries]
+        metadata_client = self._get_metadata_client()
+        if metadata_client:
+            metadata_client.fetch_many([entry['url'] for entry in entries])
+        task_ids = []
+        for entry in entries:
+            # 单个条目出错时跳过它，不影响同批的其他任务
+            try:
+                task_ids.append(self._create_task(entry['url'], progress_callback, status_callback,
+                                                  priority=entry.get('priority'), deadline=entry.get('deadline'),
+                                                  group=entry.get('group')))
+            except Exception as e:
+                logger.error(f"添加任务失败: {entry.get('url')} - {e}")
+        self._start_waiting_tasks()
+        return task_ids
+
+    def sync_listing(self, listing_url, max_pages=None):
+        """
+        增量同步画廊列表：抓取到本地库目录中已完整下载或任务列表中已有的画廊时停止，只为新画廊添加任务
+        :return: 新添加的任务ID列表
+        """
+        # 同步依赖库目录判断哪些画廊已下载，未启用库目录时也要打开
+        opened = self.catalog is not None
+        catalog = self._get_catalog(required=True)
+        if catalog is None:
+            logger.warning(f"无法打开本地库目录，不能判断已下载的画廊，跳过同步: {listing_url}")
+            return []
+        if opened and not self.config.get('catalog', 'enabled', False):
+            # 未启用库目录时下载完成的画廊不会写入库目录，同步前重新增量扫描输出目录
+            catalog.scan(self.config.get('download', 'output_dir', './download'))
+        with self.lock:
+            queued_gids = {parse_gallery_url(task.url)[0] for task in self.tasks.values()}
+
+        def is_known(url):
+            gid, _ = parse_gallery_url(url)
+            # 只有已完整下载的画廊才算已知，未完成或文件已丢失的记录不能作为同步的停止点
+            return gid in queued_gids or bool(catalog.find_complete(url))
+
+        new_urls = crawl_new_galleries(listing_url, self.config, is_known, max_pages)
+        logger.info(f"同步完成: {listing_url}，发现 {len(new_urls)} 个新画廊")
+        return self.add_tasks(new_urls)
+
+    def wait_all(self, poll_interval=1.0):
+        """等待所有等待中和运行中的任务结束（命令行模式使用）"""
+        while True:
+            with self.lock:
+                busy = bool(self.active_tasks or self.waiting_tasks or self.quota_suspended_tasks
+                            or self.disk_suspended_tasks)
+            if not busy and not QUOTA_GUARD.is_active():
+                return
+            time.sleep(poll_interval)
+
+    def set_policy(self, policy):
+        """设置调度策略，并按新策略重新排列就绪队列"""
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f"未知的调度策略: {policy}")
+        with self.lock:
+            self.policy = policy
+            self.config.set('scheduler', 'policy', policy)
+            waiting = list(self.waiting_tasks)
+            self.ready_queue = []
+            self.queue_entries = {}
+            for task_id in waiting:
+                self._enqueue_unlocked(task_id)
+
+    def set_task_priority(self, task_id, priority):
+        """设置任务优先级，等待中的任务立即按新优先级重新排队"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            task.priority = priority
+            if task_id in self.waiting_tasks:
+                self._enqueue_unlocked(task_id)
+        return True
+
+    def enable_shared_session(self):
+        """
+        之后添加的任务共用一个HTTP会话，连接池和HTTP缓存在任务之间保持（守护进程模式使用）
+        连接池按最大并发数和线程数上限放大，避免多个画廊同时下载时连接被丢弃
+        """
+        if self.shared_session is None:
+            http_cache = HttpCache.shared(self.config) if self.config.get('http_cache', 'enabled', False) else None
+            self.shared_session = CachingSession(http_cache)
+            pool_size = self.max_concurrent * self.config.get('download', 'max_workers_cap', 16)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.shared_session.mount('https://', adapter)
+            self.shared_session.mount('http://', adapter)
+        return self.shared_session
+
+    def _get_catalog(self, required=False):
+        """
+        获取本地库目录，首次使用时增量扫描输出目录
+        :param required: 未启用库目录时也打开（列表同步需要判断哪些画廊已下载）
+        :return: 本地库目录，未启用（且不是required）或打开失败时返回None
+        """
+        if not required and not self.config.get('catalog', 'enabled', False):
+            return None
+        if self.catalog is None:
+            try:
+                self.catalog = LibraryCatalog(self.config)
+                self.catalog.scan(self.config.get('download', 'output_dir', './download'))
+            except sqlite3.Error as e:
+                logger.warning(f"打开库目录失败: {e}")
+                return None
+        return self.catalog
+
+    def _get_metadata_client(self):
+        """获取元数据客户端，未启用元数据API时返回None"""
+        if not self.config.get('metadata', 'enabled', False):
+            return None
+        if self.metadata_client is None:
+            self.metadata_client = MetadataClient(self.config)
+        return self.metadata_client
+
     def start_task(self, task_id):
         """开始指定任务"""
         with self.lock:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                if task.status == TaskStatus.WAITING and len(self.active_tasks) < self.max_concurrent:
-                    if task.start():
-                        self.active_tasks.add(task_id)
-                        return True
-                elif task.status == TaskStatus.PAUSED:
-                    if task.start():
-                        self.active_tasks.add(task_id)
-                        return True
+            task = self.tasks.get(task_id)
+        if task is None:
+            return False
+        # 文件系统调用都在管理器锁之外进行
+        disk = self._probe_disk()
+        done = None
+        if task.output_dir and os.path.isdir(task.output_dir):
+            # 挂起任务的进度包含未下载（pending）的图片，按实际保存的图片数估算
+            try:
+                done = count_gallery_images(task.output_dir)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"统计已下载图片失败: {e}")
+        with self.lock:
+            if task.status == TaskStatus.WAITING:
+                if QUOTA_GUARD.is_active() or len(self.active_tasks) >= self.max_concurrent:
+                    return False
+                reserved = not DISK_BUDGET.is_low() and self._reserve_disk_unlocked(task_id, disk, done)
+                if reserved:
+                    self._dequeue_unlocked(task_id)
+                    self.active_tasks.add(task_id)
+            elif task.status == TaskStatus.PAUSED:
+                reserved = not DISK_BUDGET.is_low() and self._reserve_disk_unlocked(task_id, disk, done)
+                # 空间不足时恢复的任务在空间释放后自动启动
+                if reserved is False and task_id not in self.disk_suspended_tasks:
+                    self.disk_suspended_tasks.append(task_id)
+                    self._schedule_disk_check_unlocked()
+            else:
+                return False
+        if not reserved:
+            self._flush_disk_notices()
+            return False
+
+        # 任务的状态回调在管理器锁之外调用
+        if task.start():
+            with self.lock:
+                self.active_tasks.add(task_id)
+            return True
+        self._release_failed_start(task_id)
         return False
     
     def pause_task(self, task_id):
         """暂停指定任务"""
         with self.lock:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                if task.pause():
-                    if task_id in self.active_tasks:
-                        self.active_tasks.remove(task_id)
-                    # 尝试启动等待中的任务
-                    self._start_waiting_tasks_unlocked()
-                    return True
-        return False
+            task = self.tasks.get(task_id)
+        if task is None or not task.pause():
+            return False
+        DISK_BUDGET.release(task_id)
+        disk = self._probe_disk()
+        with self.lock:
+            self.active_tasks.discard(task_id)
+            # 尝试启动等待中的任务
+            to_start = self._claim_ready_tasks_unlocked(disk)
+        self._start_claimed_tasks(to_start)
+        return True
     
     def cancel_task(self, task_id):
         """取消指定任务"""
         with self.lock:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                if task.cancel():
-                    if task_id in self.active_tasks:
-                        self.active_tasks.remove(task_id)
-                    # 尝试启动等待中的任务
-                    self._start_waiting_tasks_unlocked()
-                    return True
-        return False
+            task = self.tasks.get(task_id)
+        if task is None or not task.cancel():
+            return False
+        DISK_BUDGET.release(task_id)
+        disk = self._probe_disk()
+        with self.lock:
+            self.active_tasks.discard(task_id)
+            self._dequeue_unlocked(task_id)
+            # 尝试启动等待中的任务
+            to_start = self._claim_ready_tasks_unlocked(disk)
+        self._start_claimed_tasks(to_start)
+        return True
     
     def remove_task(self, task_id):
         """删除指定任务"""
-        task_to_remove = None
-        should_callback = False
-        removed = False
-
+        disk = self._probe_disk()
         with self.lock:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                # 只能删除非运行状态的任务
-                if task.status not in [TaskStatus.RUNNING]:
-                    task_to_remove = task
-                    if task_id in self.active_tasks:
-                        self.active_tasks.remove(task_id)
-                    
-                    del self.tasks[task_id]
-                    should_callback = True
-                    self._start_waiting_tasks_unlocked()
-                    removed = True
-
-        if task_to_remove:
-            # Cancel the task outside the lock
-            if task_to_remove.status in [TaskStatus.WAITING, TaskStatus.PAUSED]:
-                task_to_remove.cancel()
-            
-            # Fire the callback outside the lock
-            if should_callback and self.task_removed_callback:
-                self.task_removed_callback(task_id)
-        
-        return removed
+            task = self.tasks.get(task_id)
+            # 只能删除非运行状态的任务
+            if task is None or task.status == TaskStatus.RUNNING:
+                return False
+            del self.tasks[task_id]
+            self.active_tasks.discard(task_id)
+            self._dequeue_unlocked(task_id)
+            to_start = self._claim_ready_tasks_unlocked(disk)
+
+        # 取消任务和回调都在锁之外进行
+        DISK_BUDGET.release(task_id)
+        if task.status in [TaskStatus.WAITING, TaskStatus.PAUSED]:
+            task.cancel()
+        if self.task_removed_callback:
+            self.task_removed_callback(task_id)
+        self._start_claimed_tasks(to_start)
+        return True
     
     def get_task_info(self, task_id):
         """获取任务信息"""
@@ -561,7 +3387,8 @@ class DownloadManager:
                     'total': task.total_progress,
                     'message': task.message,
                     'title': task.title,
-                    'output_dir': task.output_dir
+                    'output_dir': task.output_dir,
+                    'priority': task.priority
                 }
         return None
     
@@ -578,38 +3405,145 @@ class DownloadManager:
                     'total': task.total_progress,
                     'message': task.message,
                     'title': task.title,
-                    'output_dir': task.output_dir
+                    'output_dir': task.output_dir,
+                    'priority': task.priority
                 })
             return tasks_info
     
-    def _try_start_task(self, task_id):
-        """尝试启动任务"""
+    def _queue_key(self, task_id):
+        """就绪队列的排序键，越小越先启动"""
+        task = self.tasks[task_id]
+        return schedule_key(self.policy, task.priority, task.total_progress,
+                            task.deadline, task.group_rank) + (task.order,)
+
+    def _enqueue_unlocked(self, task_id):
+        """将任务放入就绪队列（已在队列中时按当前排序键重新排队）"""
+        seq = next(self.queue_seq)
+        self.queue_entries[task_id] = seq
+        self.waiting_tasks.add(task_id)
+        heapq.heappush(self.ready_queue, (self._queue_key(task_id), seq, task_id))
+
+    def _dequeue_unlocked(self, task_id):
+        """将任务移出就绪队列，堆中的条目随之失效"""
+        self.waiting_tasks.discard(task_id)
+        self.disk_waiting_tasks.discard(task_id)
+        self.queue_entries.pop(task_id, None)
+        # 失效条目过多时重建堆
+        if len(self.ready_queue) > 2 * len(self.queue_entries) + 64:
+            self.ready_queue = [entry for entry in self.ready_queue
+                                if self.queue_entries.get(entry[2]) == entry[1]]
+            heapq.heapify(self.ready_queue)
+
+    def _claim_ready_tasks_unlocked(self, disk=None):
+        """
+        按空闲的并发槽位从就绪队列中取出任务，并预先占用槽位
+        :param disk: 调用方在锁外通过_probe_disk()读取的磁盘状态
+        :return: 需要在锁外启动的任务列表
+        """
+        claimed = []
+        if QUOTA_GUARD.is_active() or DISK_BUDGET.is_low():
+            return claimed
+        while self.ready_queue and len(self.active_tasks) < self.max_concurrent:
+            _, seq, task_id = self.ready_queue[0]
+            if self.queue_entries.get(task_id) != seq:
+                heapq.heappop(self.ready_queue)
+                continue  # 已失效的条目
+            # 剩余空间不够下载队首画廊时暂停队列（不跳过，避免大画廊一直被小画廊插队），定期重新检查
+            reserved = self._reserve_disk_unlocked(task_id, disk)
+            if reserved is None:
+                continue  # 画廊超过磁盘容量，已移出队列
+            if not reserved:
+                break
+            heapq.heappop(self.ready_queue)
+            del self.queue_entries[task_id]
+            self.waiting_tasks.discard(task_id)
+            self.active_tasks.add(task_id)
+            claimed.append((task_id, self.tasks[task_id]))
+        return claimed
+
+    def _probe_disk(self):
+        """在管理器锁之外读取输出目录所在磁盘的状态，未启用或读取失败时返回None（不预留空间）"""
+        if not DISK_BUDGET.enabled:
+            return None
+        try:
+            return DISK_BUDGET.probe(self.config.get('download', 'output_dir', './download'))
+        except OSError as e:
+            logger.warning(f"检查磁盘空间失败: {e}")
+            return None
+
+    def _reserve_disk_unlocked(self, task_id, disk, done=None):
+        """
+        按估算大小为任务预留磁盘空间（只做计算，磁盘状态和已保存的图片数由调用方在锁外读取）
+        :param disk: _probe_disk()的结果
+        :param done: 已保存的图片数，默认为任务进度
+        :return: 是否预留成功；失败时记录等待原因并安排定期重新检查；
+                 画廊超过磁盘容量时移出就绪队列、等待在锁外标记为失败，返回None
+        """
+        if disk is None:
+            return True
+        task = self.tasks[task_id]
+        if done is None:
+            done = task.current_progress
+        ok, needed, available = DISK_BUDGET.reserve(task_id, disk, task.total_progress, done, task.total_size)
+        if ok:
+            self.disk_waiting_tasks.discard(task_id)
+            return True
+        capacity = DISK_BUDGET.capacity(disk)
+        if needed > capacity:
+            # 即使清空磁盘也放不下，等待只会让整个队列永远停住
+            self._dequeue_unlocked(task_id)
+            self.disk_rejected.append((task_id, f"画廊预计需要 {format_size(needed)}，超过磁盘可用容量 "
+                                                f"{format_size(max(0, capacity))}（总容量减去保留空间），无法下载"))
+            return None
+        message = f"磁盘空间不足: 预计需要 {format_size(needed)}，可用 {format_size(available)}，等待释放空间"
+        task.message = message
+        # 同一任务只通知一次，定期重新检查时不重复输出
+        if task_id not in self.disk_waiting_tasks:
+            self.disk_waiting_tasks.add(task_id)
+            self.disk_notices.append((task_id, message))
+        self._schedule_disk_check_unlocked()
+        return False
+
+    def _flush_disk_notices(self):
+        """在管理器锁之外发送等待磁盘空间的状态通知"""
         with self.lock:
-            self._try_start_task_unlocked(task_id)
-    
-    def _try_start_task_unlocked(self, task_id):
-        """尝试启动任务（不加锁版本）"""
-        if len(self.active_tasks) < self.max_concurrent:
-            if task_id in self.tasks:
-                task = self.tasks[task_id]
-                if task.status == TaskStatus.WAITING:
-                    if task.start():
-                        self.active_tasks.add(task_id)
-    
+            notices, self.disk_notices = self.disk_notices, []
+            rejected, self.disk_rejected = self.disk_rejected, []
+        for task_id, message in notices:
+            logger.warning(f"任务 {task_id} {message}")
+            if self.task_updated_callback:
+                self.task_updated_callback(task_id, None, None, message)
+        for task_id, message in rejected:
+            logger.error(f"任务 {task_id} {message}")
+            with self.lock:
+                task = self.tasks.get(task_id)
+            if task:
+                task.fail(message)
+
+    def _start_claimed_tasks(self, claimed):
+        """在管理器锁之外启动已占用槽位的任务"""
+        self._flush_disk_notices()
+        for task_id, task in claimed:
+            if not task.start():
+                self._release_failed_start(task_id)
+
+    def _release_failed_start(self, task_id):
+        """任务未能启动（如已被取消）时释放占用的槽位"""
+        disk = self._probe_disk()
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task.status != TaskStatus.RUNNING:
+                self.active_tasks.discard(task_id)
+                DISK_BUDGET.release(task_id)
+            to_start = self._claim_ready_tasks_unlocked(disk)
+        self._start_claimed_tasks(to_start)
+
     def _start_waiting_tasks(self):
         """启动等待中的任务"""
+        disk = self._probe_disk()
         with self.lock:
-            self._start_waiting_tasks_unlocked()
-    
-    def _start_waiting_tasks_unlocked(self):
-        """启动等待中的任务（不加锁版本）"""
-        waiting_tasks = [task_id for task_id, task in self.tasks.items() 
-                       if task.status == TaskStatus.WAITING]
-        
-        for task_id in waiting_tasks:
-            if len(self.active_tasks) >= self.max_concurrent:
-                break
-            self._try_start_task_unlocked(task_id)
+            to_start = self._claim_ready_tasks_unlocked(disk)
+        self._start_claimed_tasks(to_start)
         
     def start_single_download(self, url, progress_callback=None, status_callback=None):
         """开始单个下载任务（保持向后兼容）"""
@@ -624,6 +3558,110 @@ class DownloadManager:
         """从INI文件继续下载"""
         return resume_download_from_ini(ini_path, delay)
         
+    def _on_quota_exceeded(self, resume_at):
+        """配额用尽：挂起所有运行中的任务，并在恢复时间后重新启动"""
+        with self.lock:
+            running = [(task_id, self.tasks[task_id]) for task_id in self.active_tasks if task_id in self.tasks]
+
+        # 在管理器锁之外挂起任务，避免与任务完成回调互相等待
+        suspended = [task_id for task_id, task in running if task.suspend("图片配额已用尽，等待自动恢复")]
+        for task_id in suspended:
+            DISK_BUDGET.release(task_id)
+
+        with self.lock:
+            self.active_tasks.difference_update(suspended)
+            self.quota_suspended_tasks.extend(suspended)
+            if self.quota_resume_timer:
+                self.quota_resume_timer.cancel()
+            self.quota_resume_timer = threading.Timer(max(0, resume_at - time.time()), self._resume_after_quota)
+            self.quota_resume_timer.daemon = True
+            self.quota_resume_timer.start()
+        logger.warning(f"配额用尽，已挂起 {len(suspended)} 个任务")
+
+    def _resume_after_quota(self):
+        """配额恢复后重新启动被挂起的任务"""
+        if QUOTA_GUARD.is_active():
+            # 恢复前又一次触发了配额暂停，由新的定时器负责
+            return
+        with self.lock:
+            task_ids = self.quota_suspended_tasks
+            self.quota_suspended_tasks = []
+            self.quota_resume_timer = None
+        logger.info(f"配额暂停结束，恢复 {len(task_ids)} 个任务")
+        for task_id in task_ids:
+            self.start_task(task_id)
+        self._start_waiting_tasks()
+
+    def _on_disk_low(self, path):
+        """磁盘空间不足：挂起所有运行中的任务，定期检查剩余空间，恢复后重新启动"""
+        with self.lock:
+            running = [(task_id, self.tasks[task_id]) for task_id in self.active_tasks if task_id in self.tasks]
+
+        suspended = [task_id for task_id, task in running if task.suspend("磁盘空间不足，等待释放空间后自动恢复")]
+        for task_id in suspended:
+            DISK_BUDGET.release(task_id)
+
+        with self.lock:
+            self.active_tasks.difference_update(suspended)
+            self.disk_suspended_tasks.extend(suspended)
+            self._schedule_disk_check_unlocked()
+        logger.warning(f"磁盘空间不足，已挂起 {len(suspended)} 个任务")
+
+    def _schedule_disk_check_unlocked(self):
+        """安排重新检查磁盘空间（已安排时不重复）"""
+        if self.disk_check_timer is None:
+            self.disk_check_timer = threading.Timer(self.config.get('disk', 'check_interval', 60), self._check_disk_space)
+            self.disk_check_timer.daemon = True
+            self.disk_check_timer.start()
+
+    def _check_disk_space(self):
+        """定期检查：空间恢复后解除暂停，重新启动被挂起的任务和等待中的队首任务"""
+        with self.lock:
+            self.disk_check_timer = None
+        if DISK_BUDGET.is_low():
+            path = DISK_BUDGET.low_path
+            try:
+                recovered = DISK_BUDGET.has_space(path)
+            except OSError as e:
+                logger.warning(f"检查磁盘空间失败: {e}")
+                recovered = False
+            if not recovered:
+                with self.lock:
+                    self._schedule_disk_check_unlocked()
+                return
+            DISK_BUDGET.clear()
+            logger.info(f"磁盘空间已恢复（剩余 {format_size(free_disk_space(path))}），继续下载")
+
+        # 空间仍不够的任务由start_task()重新加入等待列表，已取消或删除的任务不再处理
+        with self.lock:
+            task_ids = self.disk_suspended_tasks
+            self.disk_suspended_tasks = []
+        for task_id in task_ids:
+            self.start_task(task_id)
+        self._start_waiting_tasks()
+        with self.lock:
+            if self.disk_suspended_tasks:
+                self._schedule_disk_check_unlocked()
+
+    def get_disk_status(self):
+        """获取输出目录所在磁盘的空间和预留情况"""
+        output_dir = self.config.get('download', 'output_dir', './download')
+        with self.lock:
+            suspended = len(self.disk_suspended_tasks)
+            waiting = [task_id for task_id in self.disk_waiting_tasks if task_id in self.tasks]
+        return {
+            'free': free_disk_space(output_dir),
+            'reserved': DISK_BUDGET.reserved(output_dir),
+            'min_free': DISK_BUDGET.min_free,
+            'low': DISK_BUDGET.is_low(),
+            'suspended': suspended,
+            'waiting': waiting
+        }
+
+    def get_host_stats(self):
+        """获取图片服务器健康表"""
+        return HOST_STATS.snapshot()
+
     def get_active_count(self):
         """获取活跃下载数量"""
         with self.lock:
@@ -637,18 +3675,59 @@ class DownloadManager:
             
             for task_id in finished_task_ids:
                 del self.tasks[task_id]
-                if self.task_removed_callback:
-                    self.task_removed_callback(task_id)
+
+        if self.task_removed_callback:
+            for task_id in finished_task_ids:
+                self.task_removed_callback(task_id)
+
+    def close(self, timeout=10):
+        """
+        关闭管理器（GUI退出、守护进程结束时调用）：取消未结束的任务并等待其工作线程结束，
+        移除注册在全局配额/磁盘预算上的监听器，停止定时器，关闭库目录和共用的HTTP会话
+        :param timeout: 等待工作线程结束的总时间（秒）
+        """
+        QUOTA_GUARD.remove_listener(self._on_quota_exceeded)
+        DISK_BUDGET.remove_listener(self._on_disk_low)
+        with self.lock:
+            tasks = list(self.tasks.values())
+            timers = [self.quota_resume_timer, self.disk_check_timer]
+            self.quota_resume_timer = self.disk_check_timer = None
+            self.quota_suspended_tasks = []
+            self.disk_suspended_tasks = []
+        for timer in timers:
+            if timer:
+                timer.cancel()
+
+        for task in tasks:
+            if task.status in [TaskStatus.WAITING, TaskStatus.RUNNING, TaskStatus.PAUSED]:
+                self.cancel_task(task.task_id)
+        deadline = time.time() + timeout
+        for task in tasks:
+            if task.worker_thread and task.worker_thread.is_alive():
+                task.worker_thread.join(max(0, deadline - time.time()))
+        if any(task.worker_thread and task.worker_thread.is_alive() for task in tasks):
+            # 仍在结束中的下载器可能还会写入库目录
+            logger.warning("部分任务未能及时结束，库目录保持打开")
+        elif self.catalog:
+            self.catalog.close()
+            self.catalog = None
+        if self.shared_session:
+            self.shared_session.close()
+            self.shared_session = None
 
 
 class EHentaiDownloader:
-    def __init__(self, gallery_url, config=None, progress_callback=None, status_callback=None):
+    def __init__(self, gallery_url, config=None, progress_callback=None, status_callback=None, session=None,
+                 metadata_client=None, catalog=None):
         """
         初始化下载器
         :param gallery_url: 画廊URL
         :param config: 配置对象
         :param progress_callback: 进度回调函数 callback(current, total, message)
         :param status_callback: 状态回调函数 callback(status)
+        :param session: 共用的HTTP会话，不指定时创建新会话
+        :param metadata_client: 共用的元数据客户端，不指定时在需要时创建
+        :param catalog: 共用的本地库目录，不指定时在需要时打开，下载结束后关闭
         """
         self.gallery_url = gallery_url
         self.config = config or Config()
@@ -657,47 +3736,128 @@ class EHentaiDownloader:
         
         self.output_dir = None
         self.delay = self.config.get('download', 'delay', 1)
-        self.session = requests.Session()
+        self.session = session or CachingSession(HttpCache.shared(self.config) if self.config.get('http_cache', 'enabled', False) else None)
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Referer': 'https://e-hentai.org/'
         })
-        # 添加图片状态跟踪
-        self.image_status = {}
+        # 添加图片状态跟踪（按页码索引的紧凑状态表）
+        self.image_status = ImageStatusTable()
+        self.hash_mismatches = {}  # 图片页面URL -> 校验失败次数
+        self.converted_hashes = {}  # 图片索引 -> WebP转换后JPG的SHA1（供校验使用）
+        self.lock = threading.Lock()
+        self.dedup_store = DedupStore(self.config) if self.config.get('dedup', 'enabled', False) else None
+        self.dedup_hits = 0
+        
+        # 对冲请求（启用时创建）
+        self.hedge_policy = HedgePolicy(self.config) if self.config.get('hedging', 'enabled', False) else None
+        # 执行图片页面和图片请求的线程池（首次请求时创建），工作线程在等待响应期间可被暂停/取消打断
+        self.request_executor = None
+        self.request_waiters = set()
+        
+        # 图片下载并发数，可在运行中通过set_max_workers()调整
+        self.worker_limiter = WorkerLimiter(self.config.get('download', 'max_workers', 3))
+        
+        # 画廊元数据（启用gdata API时）
+        self.metadata = None
+        self.metadata_client = metadata_client
+        self.catalog = catalog  # 本地库目录（未传入时首次使用时打开）
+        self.owns_catalog = False
+        self.catalog_failed = False
+        self.storage = None  # 画廊目录的图片存储（首次使用时打开）
+        self.unsynced_count = 0  # fsync为batch时，上次落盘后保存的图片数
+        
+        # 旧版本画廊中可复用的图片 token -> (旧版本画廊的图片存储, 图片名)
+        self.previous_files = {}
+        self.previous_storages = []
+        self.parent_url = None
+        self.newer_url = None
+        self.reused_count = 0
+        self.pending_count = 0
         self.compression_manager = CompressionManager(self.config)
         self.compression_manager.set_progress_callback(self._on_compression_progress)
+        HOST_STATS.configure(self.config)
+        DISK_BUDGET.configure(self.config)
         
         # 添加控制标志
         self.is_paused = False
         self.is_cancelled = False
         self.pause_event = threading.Event()
         self.pause_event.set()  # 初始为未暂停状态
+        self.interrupt_event = threading.Event()  # 暂停或取消时置位，用于打断等待和传输
+        self.active_responses = set()  # 已收到响应头、正在传输的图片响应
+
+        # 性能分析器（仅在启用profiling时创建）
+        self.profiler = None
 
     def pause(self):
-        """暂停下载"""
+        """暂停下载：中断正在传输的图片，工作线程在恢复前不再发起请求"""
         self.is_paused = True
         self.pause_event.clear()
+        self.interrupt_event.set()
+        self._abort_active_responses()
     
     def resume(self):
         """恢复下载"""
         self.is_paused = False
+        self.interrupt_event.clear()
         self.pause_event.set()
     
     def cancel(self):
-        """取消下载"""
+        """取消下载：中断正在传输的图片，未开始的图片不再下载"""
         self.is_cancelled = True
+        self.interrupt_event.set()
         self.pause_event.set()  # 确保不会卡在暂停状态
+        self.worker_limiter.wake_all()
+        self._abort_active_responses()
+
+    def set_max_workers(self, max_workers):
+        """调整图片下载并发数，对正在下载的画廊立即生效"""
+        self.worker_limiter.set_limit(max_workers)
+
+    def _abort_active_responses(self):
+        """关闭所有正在传输的响应，并唤醒等待响应的工作线程，使阻塞中的请求立即返回"""
+        import socket
+        with self.lock:
+            responses = list(self.active_responses)
+            waiters = list(self.request_waiters)
+        for waiter in waiters:
+            waiter.set()
+        for response in responses:
+            try:
+                connection = getattr(response.raw, '_connection', None)
+                sock = getattr(connection, 'sock', None)
+                if sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            try:
+                response.close()
+            except Exception:
+                pass
 
     def _check_pause_or_cancel(self):
-        """检查是否需要暂停或取消"""
+        """检查是否需要暂停或取消（暂停时阻塞直到恢复）"""
         if self.is_cancelled:
-            raise Exception("下载已取消")
+            raise DownloadCancelled("下载已取消")
         
         if self.is_paused:
             self.pause_event.wait()  # 等待恢复信号
             
         if self.is_cancelled:
-            raise Exception("下载已取消")
+            raise DownloadCancelled("下载已取消")
+
+    def _check_interrupted(self):
+        """检查传输是否需要中断（不阻塞）"""
+        if self.is_cancelled:
+            raise DownloadCancelled("下载已取消")
+        if self.is_paused:
+            raise DownloadPaused("下载已暂停")
+
+    def _sleep(self, seconds):
+        """可被暂停/取消打断的等待"""
+        self.interrupt_event.wait(seconds)
+        self._check_pause_or_cancel()
 
     def _on_compression_progress(self, message):
         """压缩进度回调"""
@@ -739,7 +3899,7 @@ class EHentaiDownloader:
         :param html: 内容警告页面的HTML内容
         :return: 实际的画廊URL，如果提取失败返回None
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = bs4.BeautifulSoup(html, 'html.parser')
 
         # 查找包含"View Gallery"文本的链接
         view_gallery_link = soup.find('a', string='View Gallery')
@@ -755,31 +3915,202 @@ class EHentaiDownloader:
         # 如果都没找到，返回None
         return None
 
+    def _fetch_gallery_html(self):
+        """
+        获取画廊页面，遇到内容警告页面时自动跳过，并将gallery_url更新为实际的画廊URL
+        :return: 画廊页面HTML
+        """
+        gallery_html = self.session.get(self.gallery_url).text
+
+        # 检查是否遇到内容警告页面
+        if self.is_content_warning_page(gallery_html):
+            self._update_status("检测到内容警告页面，正在自动跳过...")
+            logger.info("检测到内容警告页面，正在自动跳过...")
+            actual_gallery_url = self.get_actual_gallery_url(gallery_html)
+            if actual_gallery_url:
+                logger.info(f"获取到实际画廊URL: {actual_gallery_url}")
+                gallery_html = self.session.get(actual_gallery_url).text
+                # 更新URL为实际的画廊URL
+                self.gallery_url = actual_gallery_url
+            else:
+                raise Exception("无法从内容警告页面提取实际画廊URL")
+        return gallery_html
+
     def download_gallery(self):
         """
         下载整个画廊
         """
+        if not self.config.get('profiling', 'enabled', False):
+            try:
+                return self._download_gallery()
+            finally:
+                self.close_storage()
+
+        self.profiler = RunProfiler(
+            mode=self.config.get('profiling', 'mode', 'sampling'),
+            top_n=self.config.get('profiling', 'top_n', 20),
+            interval=self.config.get('profiling', 'interval', 0.005)
+        )
+        self.profiler.start()
+        try:
+            return self._download_gallery()
+        finally:
+            self.close_storage()
+            self.profiler.stop()
+            try:
+                self.profiler.save(self.output_dir or self.config.get('download', 'output_dir', './download'))
+            except Exception as e:
+                logger.error(f"保存性能分析结果失败: {e}")
+            self.profiler = None
+
+    def _resolve_output_dir(self, title):
+        """根据画廊标题确定输出目录"""
+        base_output_dir = self.config.get('download', 'output_dir', './download')
+        if not self.output_dir or self.output_dir.endswith(title):
+            self.output_dir = os.path.join(base_output_dir, title)
+        self.output_dir = safe_path(self.output_dir)
+        return self.output_dir
+
+    def _get_catalog(self):
+        """获取本地库目录，未启用或打开失败时返回None"""
+        if not self.config.get('catalog', 'enabled', False):
+            return None
+        if self.catalog is None and not self.catalog_failed:
+            try:
+                self.catalog = LibraryCatalog(self.config)
+                self.owns_catalog = True
+            except sqlite3.Error as e:
+                # 只对本下载器停用，不修改共享的配置
+                logger.warning(f"打开库目录失败: {e}")
+                self.catalog_failed = True
+        return self.catalog
+
+    def close_catalog(self):
+        """关闭本下载器自己打开的库目录（传入的共用库目录由调用方关闭）"""
+        if self.owns_catalog and self.catalog:
+            self.catalog.close()
+            self.catalog = None
+            self.owns_catalog = False
+
+    def _get_storage(self):
+        """获取当前画廊目录的图片存储，输出目录变化时重新打开"""
+        with self.lock:
+            if self.storage is None or self.storage.gallery_dir != self.output_dir:
+                if self.storage:
+                    self.storage.close()
+                self.storage = open_gallery_storage(self.output_dir, self.config.get('storage', 'backend', 'loose'))
+            return self.storage
+
+    def close_storage(self):
+        """关闭图片存储（压缩画廊目录前、下载结束时），按fsync策略先将剩余图片落盘"""
+        with self.lock:
+            storage, self.storage = self.storage, None
+            previous_storages, self.previous_storages = self.previous_storages, []
+            self.previous_files = {}
+        if storage:
+            if self.config.get('download', 'fsync', 'none') != 'none':
+                self._sync_storage(storage)
+            storage.close()
+        for previous_storage in previous_storages:
+            previous_storage.close()
+
+    def _sync_storage(self, storage):
+        try:
+            storage.sync()
+        except OSError as e:
+            logger.warning(f"图片落盘失败: {e}")
+
+    def _after_commit(self, storage):
+        """图片保存后按fsync策略落盘"""
+        policy = self.config.get('download', 'fsync', 'none')
+        if policy == 'each':
+            self._sync_storage(storage)
+        elif policy == 'batch':
+            with self.lock:
+                self.unsynced_count += 1
+                due = self.unsynced_count >= self.config.get('download', 'fsync_batch', 32)
+                if due:
+                    self.unsynced_count = 0
+            if due:
+                self._sync_storage(storage)
+
+    def _is_gallery_complete(self, title, total_images):
+        """
+        根据本地task_info.ini和图片文件判断画廊是否已完整下载
+        """
+        output_dir = self._resolve_output_dir(title)
+        ini_path = os.path.join(output_dir, 'task_info.ini')
+        if not os.path.exists(ini_path):
+            return False
+        task_info = configparser.ConfigParser()
+        task_info.read(ini_path, encoding='utf-8')
+        if 'Gallery' not in task_info:
+            return False
+        gallery = task_info['Gallery']
+        if gallery.get('TotalImages') != str(total_images) or gallery.get('Failed', '0') != '0':
+            return False
+        return count_gallery_images(output_dir) >= total_images
+
+    def _profile_scope(self):
+        """工作线程的性能分析上下文"""
+        if self.profiler:
+            return self.profiler.thread_scope()
+        return nullcontext()
+
+    def _download_gallery(self):
+        """
+        下载整个画廊（实际实现）
+        """
         try:
             self._check_pause_or_cancel()
+
+            # 本地库目录显示已完整下载的画廊直接跳过，不发起任何网络请求
+            catalog = self._get_catalog()
+            entry = catalog.find_complete(self.gallery_url) if catalog and not self.output_dir else None
+            if entry:
+                self.output_dir = entry['path']
+                logger.info(f"画廊已在库目录中标记为完成，跳过: {entry['path']}")
+                self._update_status(f"画廊标题: {entry['title']}")
+                self._update_progress(entry['page_count'], entry['page_count'], "画廊已下载完成")
+                self._update_status("画廊已下载完成，跳过")
+                return True
+
             self._update_status("正在获取画廊信息...")
+
+            # 通过元数据API快速获取标题和页数，已完成的画廊无需访问画廊页面
+            if self.config.get('metadata', 'enabled', False) and not self.output_dir:
+                if self.metadata_client is None:
+                    self.metadata_client = MetadataClient(self.config)
+                self.metadata = self.metadata_client.get(self.gallery_url)
+            if self.metadata:
+                self._update_status(f"画廊标题: {self.metadata['title']}")
+                self._update_progress(0, self.metadata['filecount'], "已获取画廊元数据")
+                if self._is_gallery_complete(self.metadata['title'], self.metadata['filecount']):
+                    logger.info(f"画廊已下载完成，跳过: {self.output_dir}")
+                    self._update_progress(self.metadata['filecount'], self.metadata['filecount'], "画廊已下载完成")
+                    self._update_status("画廊已下载完成，跳过")
+                    return True
+                self.output_dir = None
+
             # 获取画廊页面
             logger.info(f"正在获取画廊信息: {self.gallery_url}")
-            gallery_html = self.session.get(self.gallery_url).text
-
-            # 检查是否遇到内容警告页面
-            if self.is_content_warning_page(gallery_html):
-                self._update_status("检测到内容警告页面，正在自动跳过...")
-                logger.info("检测到内容警告页面，正在自动跳过...")
-                actual_gallery_url = self.get_actual_gallery_url(gallery_html)
-                if actual_gallery_url:
-                    logger.info(f"获取到实际画廊URL: {actual_gallery_url}")
-                    gallery_html = self.session.get(actual_gallery_url).text
-                    # 更新URL为实际的画廊URL
-                    self.gallery_url = actual_gallery_url
-                else:
-                    raise Exception("无法从内容警告页面提取实际画廊URL")
-
-            soup = BeautifulSoup(gallery_html, 'html.parser')
+            gallery_html = self._fetch_gallery_html()
+
+            soup = bs4.BeautifulSoup(gallery_html, 'html.parser')
+
+            # 检查是否有更新版本
+            previous_url = None
+            newer_urls = self.get_newer_version_urls(soup)
+            if newer_urls:
+                self.newer_url = newer_urls[-1]
+                logger.info(f"画廊有更新版本: {self.newer_url}")
+                if self.config.get('update', 'follow_newer', False):
+                    self._update_status("检测到更新版本，正在切换到最新版本...")
+                    previous_url = self.gallery_url
+                    self.gallery_url = self.newer_url
+                    self.newer_url = None
+                    gallery_html = self._fetch_gallery_html()
+                    soup = bs4.BeautifulSoup(gallery_html, 'html.parser')
 
             # 获取画廊标题
             title = soup.title.text.split(' - E-Hentai Galleries')[0].strip()
@@ -788,16 +4119,30 @@ class EHentaiDownloader:
 
             # 设置输出目录
             base_output_dir = self.config.get('download', 'output_dir', './download')
-            if not self.output_dir or self.output_dir.endswith(title):
-                self.output_dir = os.path.join(base_output_dir, title)
-            self.output_dir = safe_path(self.output_dir)
+            self._resolve_output_dir(title)
             os.makedirs(self.output_dir, exist_ok=True)
             logger.info(f"输出目录: {self.output_dir}")
 
-            # 获取所有图片页面链接
+            # 查找本地已下载的旧版本，用于复用未变化的图片
+            self.parent_url = self.get_parent_gallery_url(soup)
+            if self.config.get('update', 'reuse_previous', True):
+                self._load_previous_versions(base_output_dir, [previous_url, self.parent_url])
+
+            # 获取所有图片页面链接，优先使用缓存的链接列表，避免重新抓取全部索引页
             self._check_pause_or_cancel()
             self._update_status("正在获取图片链接...")
-            image_page_links = self.get_all_image_pages_links(gallery_html)
+            gid, _ = parse_gallery_url(self.gallery_url)
+            page_count = self.get_page_count(soup)
+            link_cache = LinkListCache.shared(self.config) if gid and self.config.get('link_cache', 'enabled', True) else None
+            cached = link_cache.get(gid, page_count) if link_cache else None
+            if cached:
+                image_page_links = cached['links']
+                logger.info(f"使用缓存的图片链接列表（{len(image_page_links)} 张），跳过索引页抓取")
+            else:
+                image_page_links = self.get_all_image_pages_links(gallery_html)
+                # 只缓存完整的链接列表（页数未知或部分索引页抓取失败时不缓存）
+                if link_cache:
+                    link_cache.put(gid, title, image_page_links, page_count)
             total_images = len(image_page_links)
             logger.info(f"找到 {total_images} 张图片")
             self._update_status(f"找到 {total_images} 张图片")
@@ -810,50 +4155,116 @@ class EHentaiDownloader:
             failed_links = []
 
             # 使用线程池并行下载
-            max_workers = self.config.get('download', 'max_workers', 3)
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # 提交所有下载任务
+            # 只保持有限数量的任务在途（滑动窗口），避免大画廊一次性创建成千上万个future
+            # 线程池按上限创建（线程按需启动），实际并发数由worker_limiter控制，运行中可调整
+            submit_window = self.config.get('download', 'submit_window', 2)
+            pool_size = max(self.worker_limiter.limit, self.config.get('download', 'max_workers_cap', 16))
+            storage = self._get_storage()
+            link_iter = enumerate(image_page_links, 1)
+            with futures.ThreadPoolExecutor(max_workers=pool_size) as executor:
                 future_to_info = {}
-                for index, image_url in enumerate(image_page_links, 1):
-                    # 检查是否已下载
-                    padded_index = image_url.split("-")[-1]
-                    skip_ext = ['.jpg', '.png', '.webp']
-
-                    if any([os.path.exists(os.path.join(self.output_dir, padded_index) + ext) for ext in skip_ext]):
-                        logger.info(f"图片 {index}/{total_images} 已存在，跳过下载")
-                        skipped_count += 1
-                        self.image_status[image_url] = "skipped"
-                        self._update_progress(index, total_images, f"跳过已存在的图片 {index}/{total_images}")
-                        continue
-
-                    future = executor.submit(self._download_single_image, image_url, index, total_images)
-                    future_to_info[future] = (image_url, index)
 
-                # 处理完成的任务
-                for future in as_completed(future_to_info):
-                    self._check_pause_or_cancel()
-                    image_url, index = future_to_info[future]
-                    try:
-                        result = future.result()
-                        if result:
-                            downloaded_count += 1
-                            self.image_status[image_url] = "success"
-                        else:
+                def submit_next():
+                    """提交下一张需要下载的图片，已存在的图片直接跳过；没有剩余图片时返回False"""
+                    nonlocal skipped_count
+                    for index, image_url in link_iter:
+                        # 检查是否已下载
+                        padded_index = image_url.split("-")[-1]
+                        if storage.find(padded_index):
+                            logger.info(f"图片 {index}/{total_images} 已存在，跳过下载")
+                            skipped_count += 1
+                            self.image_status[image_url] = "skipped"
+                            current_total = downloaded_count + skipped_count + failed_count + self.pending_count
+                            self._update_progress(current_total, total_images, f"跳过已存在的图片 {index}/{total_images}")
+                            continue
+
+                        future = executor.submit(self._download_single_image, image_url, index, total_images)
+                        future_to_info[future] = (image_url, index)
+                        return True
+                    return False
+
+                while len(future_to_info) < max(1, self.worker_limiter.limit * submit_window) and submit_next():
+                    pass
+
+                # 处理完成的任务，每完成一个再补充一个
+                while future_to_info:
+                    done, _ = futures.wait(future_to_info, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        image_url, index = future_to_info.pop(future)
+                        try:
+                            result = future.result()
+                            if result is None:
+                                self.pending_count += 1
+                                self.image_status[image_url] = "pending"
+                            elif result:
+                                downloaded_count += 1
+                                self.image_status[image_url] = "success"
+                            else:
+                                failed_count += 1
+                                self.image_status[image_url] = "failed"
+                                failed_links.append(image_url)
+                        except Exception as e:
+                            logger.error(f"下载图片 {index} 失败: {e}")
                             failed_count += 1
-                            self.image_status[image_url] = "failed"
+                            self.image_status[image_url] = f"failed: {str(e)}"
                             failed_links.append(image_url)
-                    except Exception as e:
-                        logger.error(f"下载图片 {index} 失败: {e}")
+
+                        current_total = downloaded_count + skipped_count + failed_count + self.pending_count
+                        self._update_progress(current_total, total_images, 
+                                            f"已处理 {current_total}/{total_images} 张图片")
+
+                    # 暂停时不再提交新图片，取消时丢弃尚未开始的图片
+                    if self.is_paused:
+                        self.pause_event.wait()
+                    if self.is_cancelled:
+                        for future in future_to_info:
+                            future.cancel()
+                        break
+
+                    while len(future_to_info) < max(1, self.worker_limiter.limit * submit_window) and submit_next():
+                        pass
+
+            if self.is_cancelled:
+                # 在途图片的传输已被中断，未完成的图片记为pending，之后可从INI恢复
+                # 在取消前已经完成并失败的图片仍记为failed
+                for future, (image_url, index) in future_to_info.items():
+                    result = None if future.cancelled() else future.result()
+                    if result:
+                        downloaded_count += 1
+                        self.image_status[image_url] = "success"
+                    elif result is False:
                         failed_count += 1
-                        self.image_status[image_url] = f"failed: {str(e)}"
+                        self.image_status[image_url] = "failed"
                         failed_links.append(image_url)
-                    
-                    current_total = downloaded_count + skipped_count + failed_count
-                    self._update_progress(current_total, total_images, 
-                                        f"已处理 {current_total}/{total_images} 张图片")
+                    else:
+                        self.pending_count += 1
+                        self.image_status[image_url] = "pending"
+                for index, image_url in link_iter:
+                    self.pending_count += 1
+                    self.image_status[image_url] = "pending"
+                logger.info(f"下载已取消，{self.pending_count} 张图片未下载")
+                self.generate_task_info(title, total_images, downloaded_count, skipped_count, failed_count, failed_links)
+                raise DownloadCancelled("下载已取消")
 
             logger.info(
                 f"下载完成! 总计: {total_images}张, 新下载: {downloaded_count}张, 跳过: {skipped_count}张, 失败: {failed_count}张")
+            if self.pending_count and DISK_BUDGET.is_low():
+                logger.warning(f"因磁盘空间不足，{self.pending_count} 张图片未下载，已标记为pending")
+                self._update_status(f"磁盘空间不足，{self.pending_count} 张图片待释放空间后下载")
+            elif self.pending_count:
+                logger.warning(f"因图片配额用尽，{self.pending_count} 张图片未下载，已标记为pending")
+                self._update_status(f"图片配额已用尽，{self.pending_count} 张图片待恢复后下载")
+            if self.dedup_hits:
+                logger.info(f"其中 {self.dedup_hits} 张来自去重存储")
+            if self.reused_count:
+                logger.info(f"其中 {self.reused_count} 张复用自旧版本画廊")
+            if self.newer_url:
+                self._update_status(f"注意: 画廊有更新版本 {self.newer_url}")
+            for host, info in HOST_STATS.snapshot().items():
+                if info['state'] != HostStats.CLOSED:
+                    logger.info(f"图片服务器 {host} 状态: {info['state']}, 失败率: {info['failure_rate']:.0%}")
+            if self.hedge_policy and self.hedge_policy.hedges:
+                logger.info(f"对冲请求: {self.hedge_policy.hedges}次, 其中 {self.hedge_policy.hedge_wins} 次先于原请求返回")
             logger.info(f"输出目录: {self.output_dir}")
             self._update_status(f"下载完成! 新下载: {downloaded_count}张, 跳过: {skipped_count}张, 失败: {failed_count}张")
 
@@ -862,27 +4273,53 @@ class EHentaiDownloader:
 
             # 自动压缩
             if self.config.get('compression', 'enabled'):
+                self.close_storage()
                 self._update_status("开始压缩文件...")
-                if self.compression_manager.compress_directory(self.output_dir):
+                if self.compression_manager.compress_gallery(self.output_dir):
                     self._update_status("压缩完成!")
+                    if catalog:
+                        archive_format = self.config.get('compression', 'format', 'zip')
+                        catalog.record_archive(self.output_dir, f"{self.output_dir}.{archive_format}")
                 else:
                     self._update_status("压缩失败!")
 
             return True
+        except DownloadCancelled:
+            logger.info(f"画廊下载已取消: {self.gallery_url}")
+            self._update_status("下载已取消")
+            return False
         except Exception as e:
             logger.error(f"下载画廊失败: {e}")
             self._update_status(f"下载失败: {e}")
             return False
+        finally:
+            if self.request_executor:
+                self.request_executor.shutdown(wait=False)
+                self.request_executor = None
+            self.close_catalog()
 
     def _download_single_image(self, image_page_url, index, total):
-        """下载单张图片（用于线程池）"""
+        """
+        下载单张图片（用于线程池）
+        :return: True成功，False失败，None表示因配额用尽或磁盘空间不足未下载（pending）
+        """
         try:
             self._check_pause_or_cancel()
-            self.download_image(image_page_url, index, total)
+            if QUOTA_GUARD.is_active() or DISK_BUDGET.is_low():
+                return None
+            if not self.worker_limiter.acquire(lambda: self.is_cancelled):
+                return None
+            try:
+                with self._profile_scope():
+                    self.download_image(image_page_url, index, total)
+            finally:
+                self.worker_limiter.release()
             return True
+        except (QuotaExceededError, DiskSpaceLowError, DownloadCancelled):
+            return None
         except Exception as e:
-            if "下载已取消" in str(e):
-                return False
+            # 缓存的图片页面可能已经失效（如图片链接过期），下次重新获取
+            self.session.invalidate(image_page_url)
             logger.error(f"下载图片 {index} 失败: {e}")
             return False
 
@@ -900,8 +4337,15 @@ class EHentaiDownloader:
             'TotalImages': str(total),
             'Downloaded': str(downloaded),
             'Skipped': str(skipped),
-            'Failed': str(failed)
+            'Failed': str(failed),
+            'Deduplicated': str(self.dedup_hits),
+            'Reused': str(self.reused_count),
+            'Pending': str(self.pending_count)
         }
+        if self.parent_url:
+            config['Gallery']['Parent'] = self.parent_url
+        if self.newer_url:
+            config['Gallery']['NewerVersion'] = self.newer_url
 
         # 失败的链接
         if failed_links:
@@ -909,6 +4353,12 @@ class EHentaiDownloader:
             for i, link in enumerate(failed_links, 1):
                 config['FailedLinks'][f'Link{i}'] = link
 
+        # 校验失败记录（包含重试后成功的图片）
+        if self.hash_mismatches:
+            config['HashMismatches'] = {}
+            for url, count in self.hash_mismatches.items():
+                config['HashMismatches'][url.split("-")[-1]] = f"{url} | {count}"
+
         # 所有图片的状态
         config['ImageStatus'] = {}
         for url, status in self.image_status.items():
@@ -916,13 +4366,104 @@ class EHentaiDownloader:
             img_index = url.split("-")[-1]
             config['ImageStatus'][img_index] = f"{url} | {status}"
 
-        # 写入INI文件
+        # WebP转换后图片的哈希，保留之前下载时记录的条目
         ini_path = os.path.join(self.output_dir, 'task_info.ini')
-        with open(ini_path, 'w', encoding='utf-8') as f:
-            config.write(f)
+        converted_hashes = {}
+        if os.path.exists(ini_path):
+            old_info = configparser.ConfigParser()
+            try:
+                old_info.read(ini_path, encoding='utf-8')
+                if 'ConvertedHashes' in old_info:
+                    converted_hashes.update(old_info['ConvertedHashes'])
+            except configparser.Error:
+                pass
+        converted_hashes.update(self.converted_hashes)
+        if converted_hashes:
+            config['ConvertedHashes'] = converted_hashes
+
+        # 写入INI文件
+        write_task_info(config, ini_path)
 
         logger.info(f"任务信息已保存到: {ini_path}")
 
+        # 更新本地库目录
+        catalog = self._get_catalog()
+        if catalog:
+            catalog.record_ini(ini_path)
+
+    def get_parent_gallery_url(self, soup):
+        """
+        从画廊页面获取父画廊（旧版本）URL
+        :return: 父画廊URL，没有时返回None
+        """
+        for label in soup.find_all('td', class_='gdt1'):
+            if label.get_text(strip=True).startswith('Parent'):
+                value = label.find_next_sibling('td')
+                link = value.find('a') if value else None
+                if link and 'href' in link.attrs:
+                    return link['href']
+        return None
+
+    def get_page_count(self, soup):
+        """
+        从画廊页面获取图片数量（"Length: N pages"）
+        :return: 图片数量，无法解析时返回None
+        """
+        for label in soup.find_all('td', class_='gdt1'):
+            if label.get_text(strip=True).startswith('Length'):
+                value = label.find_next_sibling('td')
+                match = re.search(r'(\d+)', value.get_text()) if value else None
+                if match:
+                    return int(match.group(1))
+        return None
+
+    def get_newer_version_urls(self, soup):
+        """
+        从画廊页面获取更新版本的URL列表（按发布时间排序，最后一个为最新）
+        """
+        gnd = soup.find('div', id='gnd')
+        if not gnd:
+            return []
+        return [a['href'] for a in gnd.find_all('a') if 'href' in a.attrs and '/g/' in a['href']]
+
+    def _load_previous_versions(self, base_output_dir, version_urls):
+        """从本地旧版本画廊目录加载可复用的图片"""
+        for version_url in version_urls:
+            gid, _ = parse_gallery_url(version_url)
+            if not gid or gid == parse_gallery_url(self.gallery_url)[0]:
+                continue
+            previous_dir = find_local_gallery_dir(base_output_dir, gid, self._get_catalog())
+            if not previous_dir:
+                continue
+            previous_storage = open_gallery_storage(previous_dir)
+            self.previous_storages.append(previous_storage)
+            token_map = load_gallery_token_map(previous_dir, previous_storage)
+            for token, name in token_map.items():
+                self.previous_files.setdefault(token, (previous_storage, name))
+            logger.info(f"找到旧版本画廊目录: {previous_dir}，可复用 {len(token_map)} 张图片")
+
+    def _reuse_previous_file(self, token, padded_index):
+        """
+        从旧版本画廊复用哈希相同的图片（旧版本可以是任意存储方式）
+        :return: 目标路径，无法复用时返回None
+        """
+        previous_storage, name = self.previous_files[token]
+        target_name = padded_index + os.path.splitext(name)[1]
+        storage = self._get_storage()
+        if isinstance(previous_storage, LooseFileStorage):
+            source = os.path.join(previous_storage.gallery_dir, name)
+            if not os.path.exists(source):
+                return None
+            return storage.import_file(source, target_name)
+        try:
+            data = previous_storage.read(name)
+        except (KeyError, OSError, sqlite3.Error):
+            return None
+        staging_path = os.path.join(storage.staging_dir, target_name)
+        with open(staging_path, 'wb') as f:
+            f.write(data)
+        return storage.commit(staging_path)
+
     def get_all_image_page_links(self, gallery_html):
         """
         从画廊HTML中提取所有图片页面链接
@@ -942,7 +4483,7 @@ class EHentaiDownloader:
         """
         从画廊HTML中提取所有图片页面链接
         """
-        soup = BeautifulSoup(gallery_html, 'html.parser')
+        soup = bs4.BeautifulSoup(gallery_html, 'html.parser')
         image_page_links = []
 
         # 首先从第一页获取图片链接
@@ -993,7 +4534,9 @@ class EHentaiDownloader:
                                 page_links = re.findall(pattern, page_html)
                                 image_page_links.extend(page_links)
                                 logger.info(f"第 {page_num + 1} 页找到 {len(page_links)} 张图片")
-                                time.sleep(self.delay)  # 添加延迟，避免请求过快
+                                self._sleep(self.delay)  # 添加延迟，避免请求过快
+                            except DownloadCancelled:
+                                raise
                             except Exception as e:
                                 logger.error(f"获取第 {page_num + 1} 页图片链接失败: {e}")
             else:
@@ -1010,7 +4553,7 @@ class EHentaiDownloader:
         """
         从单个页面HTML中提取图片链接
         """
-        soup = BeautifulSoup(page_html, 'html.parser')
+        soup = bs4.BeautifulSoup(page_html, 'html.parser')
         links = []
 
         for div in soup.find_all('div', class_=lambda c: c and (c.startswith('gdtm') or c.startswith('gdtl'))):
@@ -1034,54 +4577,78 @@ class EHentaiDownloader:
         # 获取图片文件名前缀（用于检查是否已下载）
         padded_index = image_page_url.split("-")[-1]
 
-        # 检查是否已经下载（检查.jpg和.webp两种格式）
-        jpg_path = os.path.join(self.output_dir, f"{padded_index}.jpg")
-        webp_path = os.path.join(self.output_dir, f"{padded_index}.webp")
-
-        if os.path.exists(jpg_path) or os.path.exists(webp_path):
+        # 检查是否已经下载
+        storage = self._get_storage()
+        if storage.find(padded_index):
             logger.info(f"图片 {index}/{total} 已存在，跳过下载: {image_page_url}")
             return
 
+        # 优先从旧版本画廊复用
+        token, _, _ = parse_image_page_url(image_page_url)
+        if token and token in self.previous_files:
+            reused_path = self._reuse_previous_file(token, padded_index)
+            if reused_path:
+                with self.lock:
+                    self.reused_count += 1
+                logger.info(f"图片 {index}/{total} 与旧版本相同，已复用: {reused_path}")
+                return
+
+        # 其次从去重存储中获取
+        if self.dedup_store and token:
+            linked_path = self.dedup_store.link_into(token, storage, padded_index)
+            if linked_path:
+                with self.lock:
+                    self.dedup_hits += 1
+                logger.info(f"图片 {index}/{total} 命中去重存储: {linked_path}")
+                return
+
+        self._check_pause_or_cancel()
         logger.info(f"下载图片 {index}/{total}: {image_page_url}")
 
         # 获取图片页面
         timeout = self.config.get('download', 'timeout', 30)
-        response = self.session.get(image_page_url, timeout=timeout)
-        response.raise_for_status()
-        image_page_html = response.text
-        soup = BeautifulSoup(image_page_html, 'html.parser')
-
-        original_image_link = None
-
-        # 获取显示中的图片链接
-        img_tag = soup.find('img', id='img')
-        if img_tag and 'src' in img_tag.attrs:
-            original_image_link = img_tag['src']
-            logger.info(f"图片链接: {original_image_link}")
-
-        if not original_image_link:
-            raise Exception("无法找到图片链接")
+        while True:
+            try:
+                image_page_html, original_image_link, nl_key = self._get_image_link(image_page_url)
+                break
+            except DownloadPaused:
+                # 暂停时中断的页面请求在恢复后重新发起
+                self._check_pause_or_cancel()
+        if is_quota_placeholder_url(original_image_link):
+            self._on_quota_exceeded(image_page_url)
 
         # 获取图片文件名
         filename = os.path.basename(urlparse(original_image_link).path)
         # 确保文件名有序
         extension = os.path.splitext(filename)[1] or '.jpg'  # 使用原始扩展名，如果没有则默认为.jpg
         new_filename = f"{padded_index}{extension}"
-        output_path = os.path.join(self.output_dir, new_filename)
+        output_path = os.path.join(storage.staging_dir, new_filename)
+
+        # 页面提供"下载原图"链接时显示的是缩放图，其哈希与token不一致，不做校验
+        expected_hash = None
+        if self.config.get('download', 'verify_hash', True) and 'fullimg' not in image_page_html:
+            expected_hash, _, _ = parse_image_page_url(image_page_url)
+
+        # 当前图片服务器处于熔断状态时，先通过重载键换一个服务器
+        failover_enabled = self.config.get('download', 'server_failover', True)
+        if failover_enabled and nl_key and HOST_STATS.get_state(urlparse(original_image_link).hostname) == HostStats.OPEN:
+            original_image_link, nl_key = self._failover_image_link(image_page_url, original_image_link, nl_key)
 
         # 下载图片，添加重试机制
         max_retries = self.config.get('download', 'retry_count', 3)
         retry_count = 0
+        part_path = output_path + '.part'
         while retry_count <= max_retries:
+            host = urlparse(original_image_link).hostname
+            start_time = time.time()
             try:
-                response = self.session.get(original_image_link, stream=True, timeout=timeout)
-                response.raise_for_status()
-
-                with open(output_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-                logger.info(f"图片 {index}/{total} 下载完成: {output_path}")
+                self._check_pause_or_cancel()
+                if not HOST_STATS.allow_request(host):
+                    raise CircuitOpenError(f"图片服务器 {host} 处于熔断状态")
+                used_link = self._stream_image(original_image_link, part_path, expected_hash,
+                                               image_page_url, timeout, nl_key)
+                HOST_STATS.record_success(urlparse(used_link).hostname, time.time() - start_time)
+                os.replace(part_path, output_path)
 
                 # 如果是webp格式且配置了转换，转换为jpg
                 if (extension == '.webp' and 
@@ -1089,52 +4656,1008 @@ class EHentaiDownloader:
                     quality = self.config.get('conversion', 'jpg_quality', 95)
                     if webp_to_jpg(output_path, None, quality):
                         os.remove(output_path)
-
+                        output_path = os.path.splitext(output_path)[0] + '.jpg'
+                        # 原图已通过哈希校验时记录转换结果的哈希，之后仍可校验转换后的图片
+                        if expected_hash:
+                            converted_hash = _file_sha1(output_path)
+                            with self.lock:
+                                self.converted_hashes[padded_index] = converted_hash
+
+                # 只有通过哈希校验的图片才加入去重存储
+                if self.dedup_store and expected_hash:
+                    self.dedup_store.add(expected_hash, output_path)
+
+                output_path = storage.commit(output_path)
+                self._after_commit(storage)
+                logger.info(f"图片 {index}/{total} 下载完成: {output_path}")
                 return  # 下载成功，退出函数
+            except (QuotaExceededError, DiskSpaceLowError, DownloadCancelled):
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            except DownloadPaused:
+                # 暂停时中断的传输在恢复后重新开始，不计入重试次数
+                self._check_pause_or_cancel()
+                continue
             except (requests.RequestException, IOError) as e:
+                # 连接被暂停/取消主动关闭导致的错误不算作失败
+                if self.interrupt_event.is_set():
+                    self._check_pause_or_cancel()
+                    continue
+                if is_disk_full_error(e):
+                    # 不留下写了一半的临时文件，空间恢复后重新下载这张图片
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    self._on_disk_low(f"写入图片时磁盘已满: {e}")
+                if not isinstance(e, CircuitOpenError):
+                    HOST_STATS.record_failure(host)
+                if retry_count == 0:
+                    # 缓存的图片页面中的链接可能已过期
+                    self.session.invalidate(image_page_url)
                 retry_count += 1
-                if retry_count <= max_retries:
-                    wait_time = self.delay * (2 ** retry_count)  # 指数退避策略
-                    logger.warning(
-                        f"下载图片文件失败，正在重试 ({retry_count}/{max_retries})，等待 {wait_time:.1f} 秒: {e}")
-                    time.sleep(wait_time)
-                else:
+                if retry_count > max_retries:
+                    # 不留下未完成的临时文件
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
                     raise Exception(f"下载图片文件失败，已达到最大重试次数: {e}")
 
+                # 优先通过重载键切换到其他图片服务器，失败时再使用指数退避
+                if failover_enabled and nl_key:
+                    new_link, nl_key = self._failover_image_link(image_page_url, original_image_link, nl_key)
+                    if new_link != original_image_link:
+                        logger.warning(f"下载图片文件失败，切换图片服务器重试 ({retry_count}/{max_retries}): {e}")
+                        original_image_link = new_link
+                        self._sleep(self.delay)
+                        continue
+
+                wait_time = self.delay * (2 ** retry_count)  # 指数退避策略
+                logger.warning(
+                    f"下载图片文件失败，正在重试 ({retry_count}/{max_retries})，等待 {wait_time:.1f} 秒: {e}")
+                self._sleep(wait_time)
+            finally:
+                # 本次是熔断探测请求时，结果记录之后释放探测标记
+                HOST_STATS.release_probe(host)
+
+    def _on_quota_exceeded(self, image_page_url):
+        """检测到配额占位图：触发全局暂停并中止当前图片"""
+        self.session.invalidate(image_page_url)
+        QUOTA_GUARD.trigger(self.config.get('quota', 'backoff_seconds', 3600))
+        raise QuotaExceededError(f"图片配额已用尽: {image_page_url}")
+
+    def _on_disk_low(self, message):
+        """磁盘剩余空间不足：触发全局暂停并中止当前图片"""
+        DISK_BUDGET.trigger(self.output_dir)
+        raise DiskSpaceLowError(message)
+
+    def _get_image_link(self, image_page_url, nl_key=None):
+        """
+        获取图片页面并解析图片链接
+        :param image_page_url: 图片页面URL
+        :param nl_key: 重载键，传入时请求页面的其他图片服务器版本
+        :return: (页面HTML, 图片链接, 新的重载键)
+        """
+        page_url = image_page_url
+        if nl_key:
+            page_url = f"{image_page_url}{'&' if '?' in image_page_url else '?'}nl={nl_key}"
+
+        timeout = self.config.get('download', 'timeout', 30)
+        response = self._call_interruptible(self.session.get, page_url, timeout=timeout)
+        response.raise_for_status()
+        image_page_html = response.text
+        soup = bs4.BeautifulSoup(image_page_html, 'html.parser')
+
+        original_image_link = None
+
+        # 获取显示中的图片链接
+        img_tag = soup.find('img', id='img')
+        if img_tag and 'src' in img_tag.attrs:
+            original_image_link = img_tag['src']
+            logger.info(f"图片链接: {original_image_link}")
+
+        if not original_image_link:
+            raise Exception("无法找到图片链接")
+
+        # "Reload broken image"链接中的重载键：nl('xxxx-yyyy')
+        nl_match = re.search(r"nl\('([^']+)'\)", image_page_html)
+        return image_page_html, original_image_link, nl_match.group(1) if nl_match else None
+
+    def _failover_image_link(self, image_page_url, current_link, nl_key):
+        """
+        使用重载键获取其他图片服务器上的图片链接
+        :return: (图片链接, 重载键)，获取失败时返回原链接
+        """
+        try:
+            _, new_link, new_nl_key = self._get_image_link(image_page_url, nl_key)
+            logger.info(f"已切换图片服务器: {urlparse(current_link).hostname} -> {urlparse(new_link).hostname}")
+            return new_link, new_nl_key or nl_key
+        except (DownloadPaused, DownloadCancelled):
+            raise
+        except Exception as e:
+            logger.warning(f"切换图片服务器失败: {e}")
+            return current_link, nl_key
+
+    def _submit_request(self, func, *args, **kwargs):
+        """在请求线程池中执行网络请求"""
+        with self.lock:
+            if self.request_executor is None:
+                cap = max(self.worker_limiter.limit, self.config.get('download', 'max_workers_cap', 16))
+                self.request_executor = futures.ThreadPoolExecutor(max_workers=cap * 2)
+        return self.request_executor.submit(func, *args, **kwargs)
+
+    def _wait_requests(self, pending, timeout=None):
+        """
+        等待请求完成，暂停/取消时立即返回而不再等待
+        中断时仍未完成的请求在完成后自动关闭响应
+        :return: 已完成的请求集合（超时为空）
+        """
+        waiter = threading.Event()
+        for future in pending:
+            future.add_done_callback(lambda _: waiter.set())
+        with self.lock:
+            self.request_waiters.add(waiter)
+        try:
+            # 先登记再检查，pause()/cancel()在登记之后置位时会唤醒waiter
+            if not self.interrupt_event.is_set():
+                waiter.wait(timeout)
+        finally:
+            with self.lock:
+                self.request_waiters.discard(waiter)
+        done = {future for future in pending if future.done()}
+        if not done and self.interrupt_event.is_set():
+            for future in pending:
+                future.add_done_callback(self._close_response_future)
+            self._check_interrupted()
+        return done
+
+    def _wait_result(self, future):
+        """等待单个请求的结果，可被暂停/取消打断"""
+        while not self._wait_requests({future}):
+            pass
+        return future.result()
+
+    def _call_interruptible(self, func, *args, **kwargs):
+        """执行可被暂停/取消打断的网络请求（等待连接和响应头期间也能立即中断）"""
+        return self._wait_result(self._submit_request(func, *args, **kwargs))
+
+    def _timed_image_request(self, image_link, timeout):
+        """请求图片并记录首字节耗时，收到响应头后登记为正在传输的响应"""
+        start_time = time.time()
+        response = self.session.get(image_link, stream=True, timeout=timeout)
+        response.raise_for_status()
+        if self.hedge_policy:
+            self.hedge_policy.record_ttfb(time.time() - start_time)
+        with self.lock:
+            self.active_responses.add(response)
+        if self.interrupt_event.is_set():
+            # 登记前已经暂停/取消，_abort_active_responses()不会再关闭它
+            self._release_response(response)
+        return response, image_link
+
+    def _release_response(self, response):
+        """注销并关闭响应"""
+        with self.lock:
+            self.active_responses.discard(response)
+        response.close()
+
+    def _open_image_response(self, image_link, timeout, image_page_url, nl_key):
+        """
+        发起图片请求，启用对冲时若超过截止时间仍未响应，则向其他服务器再发一次请求，使用先返回的响应
+        :return: (响应对象, 实际使用的图片链接)
+        """
+        if not self.hedge_policy:
+            return self._call_interruptible(self._timed_image_request, image_link, timeout)
+
+        self.hedge_policy.record_request()
+        deadline = self.hedge_policy.deadline()
+        if deadline is None or not nl_key:
+            return self._call_interruptible(self._timed_image_request, image_link, timeout)
+
+        primary = self._submit_request(self._timed_image_request, image_link, timeout)
+        if self._wait_requests({primary}, timeout=deadline):
+            return primary.result()
+
+        if not self.hedge_policy.try_acquire():
+            return self._wait_result(primary)
+        try:
+            alt_link, _ = self._failover_image_link(image_page_url, image_link, nl_key)
+        except (DownloadPaused, DownloadCancelled):
+            primary.add_done_callback(self._close_response_future)
+            raise
+        if alt_link == image_link:
+            return self._wait_result(primary)
+
+        logger.info(f"图片响应超过 {deadline:.1f} 秒，发出对冲请求: {urlparse(alt_link).hostname}")
+        secondary = self._submit_request(self._timed_image_request, alt_link, timeout)
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done = self._wait_requests(pending)
+            pending -= done
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # 关闭较慢请求的响应，释放连接
+                for other in pending | (done - {future}):
+                    other.add_done_callback(self._close_response_future)
+                if future is secondary:
+                    self.hedge_policy.record_win()
+                return result
+        raise error
+
+    def _close_response_future(self, future):
+        """关闭未被使用的请求响应"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        self._release_response(result[0] if isinstance(result, tuple) else result)
+
+    def _write_body(self, response, f):
+        """
+        将响应数据写入文件，边写边计算SHA-1，每个数据块都检查暂停/取消
+        :return: (sha1对象, 字节数)
+        """
+        # 数据块越大，Python层的循环、哈希更新和写入调用越少；8KB时多MB的原图需要上千次循环
+        chunk_size = max(8192, int(self.config.get('download', 'chunk_size', 262144)))
+        sha1 = hashlib.sha1()
+        received = 0
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if self.interrupt_event.is_set():
+                self._check_interrupted()
+            sha1.update(chunk)
+            received += len(chunk)
+            f.write(chunk)
+        # 暂停/取消关闭连接时读取可能提前正常结束，不能当作完整数据
+        if self.interrupt_event.is_set():
+            self._check_interrupted()
+        return sha1, received
+
+    def _stream_image(self, image_link, part_path, expected_hash, image_page_url, timeout, nl_key=None):
+        """
+        下载图片数据到临时文件，边下载边计算哈希并校验
+        :return: 实际使用的图片链接
+        """
+        response, image_link = self._open_image_response(image_link, timeout, image_page_url, nl_key)
+        content_length = response.headers.get('Content-Length')
+        expected_size = int(content_length) if content_length and content_length.isdigit() else None
+
+        # 先写入临时文件，边下载边计算哈希，校验通过后再重命名
+        # 响应已登记在active_responses中，pause()/cancel()会直接关闭它
+        try:
+            self._check_interrupted()
+            # 写入后剩余空间会低于保留下限时不再写入
+            if not DISK_BUDGET.has_space(self.output_dir, expected_size or 0):
+                self._on_disk_low(f"磁盘剩余空间不足，无法写入图片（{format_size(expected_size or 0)}）")
+            with open(part_path, 'wb') as f:
+                if expected_size and self.config.get('download', 'preallocate', False):
+                    preallocate_file(f, expected_size)
+                sha1, received = self._write_body(response, f)
+        except (requests.RequestException, IOError):
+            if self.interrupt_event.is_set():
+                self._check_interrupted()
+            raise
+        finally:
+            self._release_response(response)
+
+        # 配额用尽时图片请求会被重定向到509占位图
+        placeholder_hashes = self.config.get('quota', 'placeholder_sha1', [])
+        if is_quota_placeholder_url(response.url) or sha1.hexdigest() in placeholder_hashes:
+            os.remove(part_path)
+            self._on_quota_exceeded(image_page_url)
+
+        if expected_size is not None and received != expected_size:
+            os.remove(part_path)
+            raise IOError(f"图片数据不完整: {received}/{expected_size} 字节")
+
+        if expected_hash:
+            actual_hash = sha1.hexdigest()
+            if not actual_hash.startswith(expected_hash):
+                os.remove(part_path)
+                with self.lock:
+                    self.hash_mismatches[image_page_url] = self.hash_mismatches.get(image_page_url, 0) + 1
+                raise IOError(f"图片校验失败: 期望 {expected_hash}, 实际 {actual_hash[:10]}")
+
+        DISK_BUDGET.record_image(received)
+        return image_link
+
+
+class SharedQueue:
+    """
+    多节点共享下载队列（SQLite，可放在共享文件系统上）
+    各节点以租约方式领取画廊，下载期间定期心跳续约；节点失联、租约过期后画廊会被其他节点重新领取。
+    无需中心协调进程，节点统计信息记录在nodes表中
+    """
+
+    def __init__(self, db_path, node_id=None, lease_seconds=120, max_attempts=3):
+        import socket
+        self.db_path = db_path
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # 手动管理事务，领取时使用BEGIN IMMEDIATE保证同一画廊只会被一个节点领取
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    url TEXT PRIMARY KEY,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    node TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    enqueued_at REAL,
+                    updated_at REAL
+                )''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS nodes (
+                    node_id TEXT PRIMARY KEY,
+                    started_at REAL,
+                    heartbeat_at REAL,
+                    claimed INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    busy_seconds REAL NOT NULL DEFAULT 0
+                )''')
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self, statements):
+        """在一个写事务中执行 [(sql, params)]，返回最后一条语句的游标"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = None
+                for sql, params in statements:
+                    cursor = self.conn.execute(sql, params)
+                self.conn.execute('COMMIT')
+                return cursor
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, entries):
+        """
+        添加画廊到队列（已存在的画廊不会重复添加）
+        :param entries: URL列表，或parse_batch_file()返回的条目
+        :return: 新添加的数量
+        """
+        now = time.time()
+        added = 0
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for entry in entries:
+                    if not isinstance(entry, dict):
+                        entry = {'url': entry}
+                    cursor = self.conn.execute(
+                        'INSERT OR IGNORE INTO jobs (url, priority, enqueued_at, updated_at) VALUES (?, ?, ?, ?)',
+                        (entry['url'], entry.get('priority') or 0, now, now))
+                    added += cursor.rowcount
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return added
+
+    def claim(self):
+        """
+        领取一个画廊：等待中的画廊，或租约已过期的画廊
+        租约过期也计入尝试次数，已达到最大尝试次数的画廊（如每次都使节点崩溃）标记为失败，不再领取
+        :return: 画廊URL，没有可领取的画廊时返回None
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                while True:
+                    row = self.conn.execute(
+                        "SELECT url, node, state, attempts FROM jobs WHERE state = 'queued' "
+                        "OR (state = 'leased' AND lease_expires < ?) "
+                        "ORDER BY priority DESC, enqueued_at LIMIT 1", (now,)).fetchone()
+                    if not row or row['state'] != 'leased' or row['attempts'] < self.max_attempts:
+                        break
+                    logger.warning(f"节点 {row['node']} 的租约已过期，已达到最大尝试次数，标记为失败: {row['url']}")
+                    self.conn.execute(
+                        "UPDATE jobs SET state = 'failed', error = ?, lease_expires = NULL, updated_at = ? WHERE url = ?",
+                        (f"租约过期 {row['attempts']} 次", now, row['url']))
+                self.conn.execute('INSERT OR IGNORE INTO nodes (node_id, started_at, heartbeat_at) VALUES (?, ?, ?)',
+                                  (self.node_id, now, now))
+                if row:
+                    if row['state'] == 'leased':
+                        logger.warning(f"节点 {row['node']} 的租约已过期，重新领取: {row['url']}")
+                    self.conn.execute(
+                        "UPDATE jobs SET state = 'leased', node = ?, lease_expires = ?, "
+                        "attempts = attempts + 1, updated_at = ? WHERE url = ?",
+                        (self.node_id, now + self.lease_seconds, now, row['url']))
+                    self.conn.execute('UPDATE nodes SET claimed = claimed + 1, heartbeat_at = ? WHERE node_id = ?',
+                                      (now, self.node_id))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return row['url'] if row else None
+
+    def heartbeat(self, url):
+        """
+        续约
+        :return: 租约是否仍属于本节点（租约过期后被其他节点领取时返回False）
+        """
+        now = time.time()
+        cursor = self._transaction([
+            ('UPDATE nodes SET heartbeat_at = ? WHERE node_id = ?', (now, self.node_id)),
+            ("UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE url = ? AND node = ? AND state = 'leased'",
+             (now + self.lease_seconds, now, url, self.node_id)),
+        ])
+        return cursor.rowcount == 1
+
+    def complete(self, url, success, error=None, busy_seconds=0, retry=False):
+        """
+        结束画廊的租约
+        :param retry: 为True时放回队列且不计入尝试次数（如配额用尽）
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT attempts FROM jobs WHERE url = ?', (url,)).fetchone()
+        if success:
+            state = 'done'
+        elif retry or (row and row['attempts'] < self.max_attempts):
+            state = 'queued'
+        else:
+            state = 'failed'
+        attempts_sql = 'attempts - 1' if retry else 'attempts'
+        self._transaction([
+            (f"UPDATE jobs SET state = ?, attempts = {attempts_sql}, error = ?, lease_expires = NULL, updated_at = ? "
+             "WHERE url = ? AND node = ?", (state, error, now, url, self.node_id)),
+            ('UPDATE nodes SET completed = completed + ?, failed = failed + ?, busy_seconds = busy_seconds + ?, '
+             'heartbeat_at = ? WHERE node_id = ?',
+             (int(success), int(not success and not retry), busy_seconds, now, self.node_id)),
+        ])
+
+    def has_unfinished(self):
+        """是否还有等待中或被领取中的画廊"""
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')").fetchone()
+        return row[0] > 0
+
+    def stats(self):
+        """
+        获取队列和节点统计
+        :return: ({状态: 数量}, [节点信息])
+        """
+        with self.lock:
+            states = {row['state']: row['count'] for row in
+                      self.conn.execute('SELECT state, COUNT(*) AS count FROM jobs GROUP BY state')}
+            nodes = [dict(row) for row in self.conn.execute('SELECT * FROM nodes ORDER BY started_at')]
+        return states, nodes
+
+
+def run_queue_worker(db_path, config=None, node_id=None, exit_when_empty=True):
+    """
+    作为一个节点从共享队列领取并下载画廊，直到队列中没有未完成的画廊
+    多台机器（或同一台机器上的多个进程）指向同一个队列文件即可分担下载
+
+    :param exit_when_empty: 为False时队列为空也继续等待新画廊
+    """
+    if not config:
+        config = Config()
+    lease_seconds = config.get('queue', 'lease_seconds', 120)
+    poll_interval = config.get('queue', 'poll_interval', 5)
+    queue = SharedQueue(db_path, node_id, lease_seconds, config.get('queue', 'max_attempts', 3))
+    logger.info(f"节点 {queue.node_id} 已加入队列: {db_path}")
+    DISK_BUDGET.configure(config)
+    output_dir = config.get('download', 'output_dir', './download')
+
+    try:
+        while True:
+            # 配额用尽或空间不足时先等待，不领取画廊，避免等待期间租约过期被其他节点重复下载
+            if QUOTA_GUARD.is_active():
+                logger.info(f"图片配额已用尽，等待 {QUOTA_GUARD.remaining():.0f} 秒后再领取画廊...")
+                time.sleep(QUOTA_GUARD.remaining())
+            DISK_BUDGET.wait_for_space(output_dir, config.get('disk', 'check_interval', 60))
+            url = queue.claim()
+            if not url:
+                if exit_when_empty and not queue.has_unfinished():
+                    break
+                # 其他节点持有的租约可能过期，稍后再次尝试
+                time.sleep(poll_interval)
+                continue
+
+            logger.info(f"节点 {queue.node_id} 领取画廊: {url}")
+            last_status = ['']
+            downloader = EHentaiDownloader(url, config, status_callback=lambda status: last_status.__setitem__(0, status))
+            finished = threading.Event()
+
+            def keep_alive():
+                # 心跳续约；租约被其他节点接管时停止下载，避免重复下载
+                while not finished.wait(lease_seconds / 3):
+                    try:
+                        if not queue.heartbeat(url):
+                            logger.warning(f"租约已失效，停止下载: {url}")
+                            downloader.cancel()
+                            return
+                    except sqlite3.Error as e:
+                        logger.warning(f"续约失败: {e}")
+
+            heartbeat_thread = threading.Thread(target=keep_alive, daemon=True)
+            heartbeat_thread.start()
+            start_time = time.time()
+            try:
+                success = downloader.download_gallery()
+                error = None if success else last_status[0]
+            except Exception as e:
+                success, error = False, str(e)
+            finally:
+                finished.set()
+                heartbeat_thread.join()
+
+            if downloader.is_cancelled:
+                continue  # 租约已被其他节点接管
+            queue.complete(url, success and not downloader.pending_count, error,
+                           time.time() - start_time, retry=bool(downloader.pending_count))
+    finally:
+        states, _ = queue.stats()
+        logger.info(f"节点 {queue.node_id} 退出，队列状态: {states}")
+        queue.close()
+
+
+def is_local_origin(origin):
+    """请求的Origin头是否为空或指向本机（命令行和GUI客户端不发送Origin）"""
+    if not origin:
+        return True
+    return urlparse(origin).hostname in ('localhost', '127.0.0.1', '::1')
+
+
+class DaemonServer:
+    """
+    守护进程：常驻的DownloadManager加本地HTTP控制接口
+    HTTP会话的连接池、元数据和库目录缓存在任务之间保持，命令行和GUI通过RemoteDownloadManager提交和控制任务
+    """
+
+    def __init__(self, config=None, host=None, port=None):
+        self.config = config or Config()
+        self.host = host or self.config.get('daemon', 'host', '127.0.0.1')
+        self.port = port if port is not None else self.config.get('daemon', 'port', 8765)
+        self.token = self.config.get('daemon', 'token', '')
+        self.manager = DownloadManager(self.config)
+        self.manager.enable_shared_session()
+        self.started_at = time.time()
+        self.server = None
+
+    def serve_forever(self):
+        """启动控制接口，直到收到shutdown请求"""
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self.server.daemon_threads = True
+        logger.info(f"守护进程已启动，控制接口: http://{self.host}:{self.server.server_port}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.manager.close()
+            logger.info("守护进程已退出")
+
+    def shutdown(self):
+        """停止控制接口（在请求处理线程中调用，不能直接等待serve_forever结束）"""
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self, method):
+                import hmac
+                if daemon.token and not hmac.compare_digest(self.headers.get('X-Auth-Token', '').encode('utf-8'),
+                                                            daemon.token.encode('utf-8')):
+                    self._reply(401, {'error': '认证失败'})
+                    return
+                # 浏览器中的网页可以向本机端口发请求：拒绝来自其他站点的请求，
+                # 并要求修改类请求使用JSON（跨站表单无法不经预检就发送application/json）
+                if not is_local_origin(self.headers.get('Origin')):
+                    self._reply(403, {'error': '拒绝来自其他站点的请求'})
+                    return
+                content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if method != 'GET' and content_type != 'application/json':
+                    self._reply(415, {'error': '请求需使用application/json'})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length)) if length else {}
+                    status, result = daemon.dispatch(method, urlparse(self.path).path, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {'error': f"请求无效: {e}"}
+                except Exception as e:
+                    logger.error(f"处理控制请求失败 {method} {self.path}: {e}")
+                    status, result = 500, {'error': str(e)}
+                self._reply(status, result)
+
+            def _reply(self, status, result):
+                data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def log_message(self, format, *args):
+                logger.debug(f"控制请求 {self.address_string()}: {format % args}")
+
+        return Handler
+
+    def dispatch(self, method, path, body):
+        """
+        处理一个控制请求
+        :return: (HTTP状态码, 可序列化为JSON的结果)
+        """
+        manager = self.manager
+        parts = [part for part in path.split('/') if part]
+
+        if parts == ['tasks']:
+            if method == 'GET':
+                return 200, manager.get_all_tasks()
+            if method == 'POST':
+                return 200, {'task_ids': manager.add_tasks(body['entries'])}
+        elif parts == ['tasks', 'clear'] and method == 'POST':
+            manager.clear_finished_tasks()
+            return 200, {'ok': True}
+        elif len(parts) == 2 and parts[0] == 'tasks':
+            task_id = parts[1]
+            if method == 'GET':
+                info = manager.get_task_info(task_id)
+                return (200, info) if info else (404, {'error': f"任务不存在: {task_id}"})
+            if method == 'DELETE':
+                return 200, {'ok': manager.remove_task(task_id)}
+        elif len(parts) == 3 and parts[0] == 'tasks' and method == 'POST':
+            task_id, action = parts[1], parts[2]
+            actions = {'start': manager.start_task, 'pause': manager.pause_task, 'cancel': manager.cancel_task}
+            if action in actions:
+                return 200, {'ok': actions[action](task_id)}
+            if action == 'priority':
+                return 200, {'ok': manager.set_task_priority(task_id, int(body['priority']))}
+        elif parts == ['stats'] and method == 'GET':
+            return 200, self.stats()
+        elif parts == ['settings'] and method == 'POST':
+            if 'max_concurrent' in body:
+                manager.set_max_concurrent(int(body['max_concurrent']))
+            if 'max_workers' in body:
+                manager.set_max_workers(int(body['max_workers']))
+            if 'policy' in body:
+                manager.set_policy(body['policy'])
+            return 200, {'ok': True}
+        elif parts == ['reload'] and method == 'POST':
+            return 200, {'ok': manager.reload_config()}
+        elif parts == ['sync'] and method == 'POST':
+            # 抓取列表页可能较慢，在后台进行，新画廊随后出现在任务列表中
+            threading.Thread(target=self._run_sync, args=(body['url'], body.get('max_pages')), daemon=True).start()
+            return 202, {'ok': True}
+        elif parts == ['resume'] and method == 'POST':
+            threading.Thread(target=manager.resume_download, args=(body['ini_path'], body.get('delay', 1)),
+                             daemon=True).start()
+            return 202, {'ok': True}
+        elif parts == ['shutdown'] and method == 'POST':
+            self.shutdown()
+            return 200, {'ok': True}
+        return 404, {'error': f"未知的请求: {method} {path}"}
+
+    def _run_sync(self, listing_url, max_pages):
+        try:
+            self.manager.sync_listing(listing_url, max_pages)
+        except Exception as e:
+            logger.error(f"同步列表失败 {listing_url}: {e}")
+
+    def stats(self):
+        """守护进程的运行统计"""
+        manager = self.manager
+        counts = {}
+        for task in manager.get_all_tasks():
+            counts[task['status']] = counts.get(task['status'], 0) + 1
+        http_cache = manager.shared_session.http_cache
+        return {
+            'uptime': time.time() - self.started_at,
+            'tasks': counts,
+            'active': manager.get_active_count(),
+            'max_concurrent': manager.max_concurrent,
+            'max_workers': self.config.get('download', 'max_workers', 3),
+            'policy': manager.policy,
+            'quota_wait': QUOTA_GUARD.remaining() if QUOTA_GUARD.is_active() else 0,
+            'disk': manager.get_disk_status(),
+            'http_cache': {'hits': http_cache.hits, 'revalidated': http_cache.revalidated} if http_cache else None,
+            'hosts': manager.get_host_stats()
+        }
+
+
+class RemoteDownloadManager:
+    """
+    守护进程的客户端，提供与DownloadManager相同的任务管理接口
+    任务在守护进程中运行，不会调用本地回调，需要定期调用get_all_tasks()获取进度
+    """
+
+    def __init__(self, config=None, url=None):
+        import urllib.request
+        self.config = config or Config()
+        if not url:
+            url = f"http://{self.config.get('daemon', 'host', '127.0.0.1')}:{self.config.get('daemon', 'port', 8765)}"
+        self.base_url = url.rstrip('/')
+        self.token = self.config.get('daemon', 'token', '')
+        # 控制接口在本机，不经过环境变量中的代理
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def _call(self, method, path, body=None, timeout=30):
+        """发送控制请求；任务不存在时返回None，其他错误抛出RuntimeError"""
+        import urllib.request
+        import urllib.error
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        if self.token:
+            request.add_header('X-Auth-Token', self.token)
+        try:
+            with self.opener.open(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise RuntimeError(f"守护进程返回错误 {e.code}: {e.read().decode('utf-8', 'replace')}")
+
+    def is_available(self):
+        """检查守护进程是否在运行"""
+        try:
+            self._call('GET', '/stats', timeout=2)
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def set_callbacks(self, task_added=None, task_updated=None, task_removed=None):
+        """任务在守护进程中运行，本地回调不会被调用"""
+
+    def add_task(self, url, progress_callback=None, status_callback=None, priority=None, deadline=None, group=None):
+        return self.add_tasks([{'url': url, 'priority': priority, 'deadline': deadline, 'group': group}])[0]
+
+    def add_tasks(self, entries, progress_callback=None, status_callback=None):
+        entries = [entry if isinstance(entry, dict) else {'url': entry} for entry in entries]
+        return self._call('POST', '/tasks', {'entries': entries})['task_ids']
+
+    def get_all_tasks(self):
+        return self._call('GET', '/tasks')
+
+    def get_task_info(self, task_id):
+        return self._call('GET', f'/tasks/{task_id}')
+
+    def _task_action(self, task_id, action, body=None):
+        result = self._call('POST', f'/tasks/{task_id}/{action}', body or {})
+        return bool(result and result['ok'])
+
+    def start_task(self, task_id):
+        return self._task_action(task_id, 'start')
+
+    def pause_task(self, task_id):
+        return self._task_action(task_id, 'pause')
+
+    def cancel_task(self, task_id):
+        return self._task_action(task_id, 'cancel')
+
+    def set_task_priority(self, task_id, priority):
+        return self._task_action(task_id, 'priority', {'priority': priority})
+
+    def remove_task(self, task_id):
+        result = self._call('DELETE', f'/tasks/{task_id}')
+        return bool(result and result['ok'])
+
+    def clear_finished_tasks(self):
+        self._call('POST', '/tasks/clear', {})
+
+    def set_max_concurrent(self, max_concurrent):
+        self._call('POST', '/settings', {'max_concurrent': max_concurrent})
+
+    def set_max_workers(self, max_workers):
+        self._call('POST', '/settings', {'max_workers': max_workers})
+
+    def set_policy(self, policy):
+        self._call('POST', '/settings', {'policy': policy})
+
+    def reload_config(self):
+        return self._call('POST', '/reload', {})['ok']
+
+    def sync_listing(self, listing_url, max_pages=None):
+        """在守护进程中后台同步列表，新画廊稍后出现在任务列表中"""
+        self._call('POST', '/sync', {'url': listing_url, 'max_pages': max_pages})
+
+    def resume_download(self, ini_path, delay=1):
+        self._call('POST', '/resume', {'ini_path': os.path.abspath(ini_path), 'delay': delay})
+
+    def stats(self):
+        return self._call('GET', '/stats')
+
+    def get_host_stats(self):
+        return self.stats()['hosts']
+
+    def get_active_count(self):
+        return self.stats()['active']
+
+    def shutdown(self):
+        self._call('POST', '/shutdown', {})
+
+
+def parse_listing_page(html, base_url=None):
+    """
+    解析搜索结果、收藏夹、标签等画廊列表页
+    :return: (画廊URL列表（按页面顺序、按gid去重）, 下一页URL或None)
+    """
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    gallery_urls = []
+    seen = set()
+    for a_tag in soup.find_all('a', href=True):
+        href = a_tag['href']
+        match = GALLERY_URL_PATTERN.search(href)
+        if match and match.group(1) not in seen:
+            seen.add(match.group(1))
+            gallery_urls.append(href)
+
+    # 新版列表使用"Next >"链接（?next=游标），旧版使用页码表格中的">"
+    next_url = None
+    next_tag = soup.find('a', id='unext')
+    if next_tag and next_tag.get('href'):
+        next_url = next_tag['href']
+    else:
+        pagination = soup.find('table', class_='ptt')
+        if pagination:
+            links = pagination.find_all('a', href=True)
+            if links and links[-1].get_text(strip=True) == '>':
+                next_url = links[-1]['href']
+    if next_url and base_url:
+        next_url = urljoin(base_url, next_url)
+    return gallery_urls, next_url
+
+
+def crawl_new_galleries(listing_url, config, is_known, max_pages=None):
+    """
+    逐页抓取画廊列表，连续遇到sync.stop_after_known个已知画廊时停止翻页
+    列表按发布时间从新到旧排列，因此同步的开销只与新增内容成正比
+
+    :param is_known: 判断画廊URL是否已在本地的函数
+    :return: 新画廊URL列表（从旧到新，先下载较早的画廊）
+    """
+    stop_after_known = config.get('sync', 'stop_after_known', 5)
+    max_pages = max_pages or config.get('sync', 'max_pages', 50)
+    delay = config.get('download', 'delay', 1)
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Referer': 'https://e-hentai.org/'
+    })
+    session.cookies.update(config.get('sync', 'cookies', {}))
+
+    new_urls = []
+    known_streak = 0
+    page_url = listing_url
+    for page_num in range(1, max_pages + 1):
+        response = session.get(page_url, timeout=config.get('download', 'timeout', 30))
+        response.raise_for_status()
+        gallery_urls, next_url = parse_listing_page(response.text, page_url)
+        logger.info(f"列表第 {page_num} 页: {len(gallery_urls)} 个画廊")
+
+        for url in gallery_urls:
+            if is_known(url):
+                known_streak += 1
+                if known_streak >= stop_after_known:
+                    logger.info(f"已连续遇到 {known_streak} 个已下载的画廊，停止翻页")
+                    return new_urls[::-1]
+            else:
+                known_streak = 0
+                new_urls.append(url)
+
+        if not next_url:
+            break
+        page_url = next_url
+        time.sleep(delay)
+    return new_urls[::-1]
+
 
 def batch_download(file_path, config=None):
     """
-    从文件中读取多个画廊URL并依次下载
+    从文件中读取多个画廊URL，按调度策略排序后依次下载
 
-    :param file_path: 包含画廊URL的文件路径，每行一个URL
+    :param file_path: 包含画廊URL的文件路径（或路径列表），每行一个URL，可附加调度注解
     :param config: 配置对象
     """
     if not config:
         config = Config()
     
+    catalog = None
     try:
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            logger.error(f"文件不存在: {file_path}")
-            return
-
-        # 读取文件中的URL
-        with open(file_path, 'r', encoding='utf-8') as f:
-            urls = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
-
-        if not urls:
+        file_paths = [file_path] if isinstance(file_path, str) else list(file_path)
+        entries = []
+        for path in file_paths:
+            # 检查文件是否存在
+            if not os.path.exists(path):
+                logger.error(f"文件不存在: {path}")
+                return
+
+            # 读取文件中的URL
+            file_entries = parse_batch_file(path)
+            logger.info(f"从文件 {path} 中读取到 {len(file_entries)} 个画廊URL")
+            entries.extend(file_entries)
+
+        if not entries:
             logger.warning("文件中没有找到有效的URL")
             return
 
-        logger.info(f"从文件 {file_path} 中读取到 {len(urls)} 个画廊URL")
+        # 先用本地库目录过滤已完整下载的画廊，这些画廊不发起任何网络请求
+        if config.get('catalog', 'enabled', False):
+            catalog = LibraryCatalog(config)
+            catalog.scan(config.get('download', 'output_dir', './download'))
+            remaining = [entry for entry in entries if not catalog.find_complete(entry['url'])]
+            if len(remaining) < len(entries):
+                logger.info(f"库目录中已有 {len(entries) - len(remaining)} 个画廊下载完成，跳过")
+            entries = remaining
+            if not entries:
+                logger.info("所有画廊均已下载完成")
+                return
+
+        # 批量预取元数据，减少逐个访问画廊页面
+        metadata_client = None
+        if config.get('metadata', 'enabled', False):
+            metadata_client = MetadataClient(config)
+            metadata_client.fetch_many([entry['url'] for entry in entries])
+
+        # 按调度策略排序
+        policy = config.get('scheduler', 'policy', 'fifo')
+        default_priority = config.get('scheduler', 'default_priority', 0)
+        group_counts = {}
+        keys = []
+        for order, entry in enumerate(entries):
+            group_rank = group_counts.get(entry['group'], 0)
+            group_counts[entry['group']] = group_rank + 1
+            metadata = metadata_client.get_cached(entry['url']) if metadata_client else None
+            priority = entry['priority'] if entry['priority'] is not None else default_priority
+            keys.append(schedule_key(policy, priority, metadata['filecount'] if metadata else 0,
+                                     entry['deadline'], group_rank) + (order,))
+        urls = [entry['url'] for _, entry in sorted(zip(keys, entries), key=lambda item: item[0])]
+        if policy == 'shortest' and not metadata_client:
+            logger.warning("shortest策略需要启用元数据API才能获取页数，将按添加顺序下载")
+        logger.info(f"调度策略: {policy}")
 
         # 依次下载每个画廊
+        requeued = set()
+        DISK_BUDGET.configure(config)
+        output_dir = config.get('download', 'output_dir', './download')
         for i, url in enumerate(urls, 1):
+            # 配额暂停期间等待恢复
+            if QUOTA_GUARD.is_active():
+                logger.info(f"图片配额已用尽，等待 {QUOTA_GUARD.remaining():.0f} 秒后继续...")
+                time.sleep(QUOTA_GUARD.remaining())
+            # 剩余空间不够下载这个画廊时等待释放空间
+            metadata = metadata_client.get_cached(url) if metadata_client else None
+            needed = DISK_BUDGET.estimate(metadata['filecount'], total_size=metadata.get('filesize')) if metadata else 0
+            DISK_BUDGET.wait_for_space(output_dir, config.get('disk', 'check_interval', 60), needed)
+
             logger.info(f"开始下载第 {i}/{len(urls)} 个画廊: {url}")
             try:
-                downloader = EHentaiDownloader(url, config)
+                downloader = EHentaiDownloader(url, config, metadata_client=metadata_client, catalog=catalog)
                 downloader.download_gallery()
                 logger.info(f"第 {i}/{len(urls)} 个画廊下载完成")
+                # 因配额未下载完的画廊在队列末尾重新下载一次
+                if downloader.pending_count and url not in requeued:
+                    requeued.add(url)
+                    urls.append(url)
             except Exception as e:
                 logger.error(f"下载第 {i}/{len(urls)} 个画廊时出错: {e}")
 
@@ -1147,24 +5670,181 @@ def batch_download(file_path, config=None):
         logger.info(f"所有画廊下载完成，共 {len(urls)} 个")
     except Exception as e:
         logger.error(f"批量下载过程中出错: {e}")
+    finally:
+        if catalog:
+            catalog.close()
 
 
 def main():
-    if _PARSER:
+    if _PARSER or len(sys.argv) > 1:
+        import argparse
         parser = argparse.ArgumentParser(description='E-Hentai画廊下载器')
         parser.add_argument('-u', '--url', help='画廊URL')
         parser.add_argument('-o', '--output', help='输出目录', default=None)
         parser.add_argument('-d', '--delay', type=float, default=1, help='请求间隔时间（秒）')
-        parser.add_argument('-f', '--file', help='包含多个画廊URL的文件路径，每行一个URL')
+        parser.add_argument('-f', '--file', nargs='+', help='包含多个画廊URL的文件路径，每行一个URL，可指定多个文件')
+        parser.add_argument('--policy', choices=SCHEDULING_POLICIES,
+                            help='批量下载的调度策略: fifo按顺序, shortest页数少的优先, fair多个文件轮流, deadline截止时间早的优先')
         parser.add_argument('-i', '--ini', help='任务信息INI文件路径，用于继续下载失败项')
+        parser.add_argument('--verify', help='校验已下载的画廊目录（包含task_info.ini）')
+        parser.add_argument('--storage', choices=list(STORAGE_BACKENDS),
+                            help='新画廊的图片存储方式: loose每张图片一个文件, pack追加写入单个打包文件, sqlite保存在SQLite数据库')
+        parser.add_argument('--export', nargs='+', metavar='GALLERY_DIR', help='将画廊（任意存储方式）导出为CBZ或图片文件夹')
+        parser.add_argument('--export-format', choices=['cbz', 'folder'], default='cbz', help='导出格式')
+        parser.add_argument('--export-to', help='导出到指定目录（默认在画廊目录旁）')
+        parser.add_argument('--scan-library', nargs='?', const='', default=None,
+                            help='增量扫描输出目录（或指定目录）中的task_info.ini，更新本地库目录')
+        parser.add_argument('--verify-workers', type=int, default=8, help='校验时的并行线程数')
+        parser.add_argument('--metadata-api', action='store_true', help='使用gdata API获取画廊标题和页数，并跳过已完成的画廊')
+        parser.add_argument('--sync', nargs='+', metavar='LISTING_URL',
+                            help='增量同步搜索结果/收藏夹/标签列表，只下载本地库目录中没有的新画廊')
+        parser.add_argument('--sync-pages', type=int, default=None, help='每次同步最多抓取的列表页数')
+        parser.add_argument('--sync-interval', type=float, default=None, help='定期同步的间隔（秒），不指定时只同步一次')
+        parser.add_argument('--queue', help='多节点共享队列文件（SQLite），配合--enqueue/--worker/--queue-status使用')
+        parser.add_argument('--enqueue', nargs='+', metavar='FILE', help='将批量文件中的画廊添加到共享队列')
+        parser.add_argument('--worker', action='store_true', help='作为节点从共享队列领取并下载画廊')
+        parser.add_argument('--node-id', help='节点名称（默认为主机名-进程号）')
+        parser.add_argument('--queue-status', action='store_true', help='显示共享队列和各节点的统计')
+        parser.add_argument('--daemon', action='store_true', help='以守护进程运行，通过本地HTTP接口接收和控制任务')
+        parser.add_argument('--port', type=int, default=None, help='守护进程控制接口端口（默认使用配置文件中的daemon.port）')
+        parser.add_argument('--remote', nargs='?', const='', default=None, metavar='DAEMON_URL',
+                            help='将-u/-f/-i/--sync的任务提交给运行中的守护进程，而不是在本进程中下载')
+        parser.add_argument('--ctl', nargs='+', metavar='COMMAND',
+                            help='控制守护进程: list, stats, start/pause/cancel/remove 任务ID..., clear, shutdown')
+        parser.add_argument('--http-cache', action='store_true', help='启用磁盘HTTP缓存，重复运行时复用未变化的画廊页面和图片页面')
+        parser.add_argument('--follow-newer', action='store_true', help='画廊有更新版本时下载最新版本，并复用旧版本中未变化的图片')
+        parser.add_argument('--dedup-store', help='启用跨画廊去重，并指定内容寻址存储目录')
+        parser.add_argument('--profile', nargs='?', const='sampling', choices=['sampling', 'cprofile'],
+                            help='启用性能分析（默认采样模式），结果保存在画廊目录中')
+        parser.add_argument('--startup-benchmark', type=int, nargs='?', const=5, default=None, metavar='RUNS',
+                            help='用python -X importtime测量命令行和GUI模块的启动导入耗时，超出预算时返回非零退出码')
+        parser.add_argument('--profile-top', type=int, default=None, help='日志中输出的热点函数数量')
         args = parser.parse_args()
 
         config = Config()
         if args.output:
             config.set('download', 'output_dir', args.output)
         config.set('download', 'delay', args.delay)
-
-        if args.ini:
+        if args.metadata_api:
+            config.set('metadata', 'enabled', True)
+        if args.policy:
+            config.set('scheduler', 'policy', args.policy)
+        if args.http_cache:
+            config.set('http_cache', 'enabled', True)
+        if args.follow_newer:
+            config.set('update', 'follow_newer', True)
+        if args.dedup_store:
+            config.set('dedup', 'enabled', True)
+            config.set('dedup', 'store_dir', args.dedup_store)
+        if args.profile:
+            config.set('profiling', 'enabled', True)
+            config.set('profiling', 'mode', args.profile)
+        if args.profile_top:
+            config.set('profiling', 'top_n', args.profile_top)
+        if args.storage:
+            config.set('storage', 'backend', args.storage)
+
+        if args.startup_benchmark:
+            # 启动导入耗时基准
+            budgets = config.get('profiling', 'import_budget_ms', {})
+            over_budget = False
+            for module_name, budget in budgets.items():
+                try:
+                    total, slowest = measure_import_time(module_name, args.startup_benchmark)
+                except RuntimeError as e:
+                    print(f"{module_name}: 无法导入，跳过（{e}）")
+                    continue
+                over_budget = over_budget or total > budget
+                print(f"{module_name}: {total:.1f}ms（预算 {budget}ms）{'超出预算' if total > budget else ''}")
+                for name, elapsed in slowest:
+                    print(f"    {name}: {elapsed:.1f}ms")
+            sys.exit(1 if over_budget else 0)
+        elif args.daemon:
+            # 守护进程模式
+            DaemonServer(config, port=args.port).serve_forever()
+        elif args.remote is not None or args.ctl:
+            # 作为客户端提交或控制守护进程中的任务
+            remote = RemoteDownloadManager(config, args.remote or None)
+            if args.port:
+                remote.base_url = f"http://{config.get('daemon', 'host', '127.0.0.1')}:{args.port}"
+            try:
+                if args.ctl:
+                    remote_control(remote, args.ctl[0], args.ctl[1:])
+                elif args.file:
+                    entries = [entry for path in args.file for entry in parse_batch_file(path)]
+                    print(f"已提交 {len(remote.add_tasks(entries))} 个任务")
+                elif args.url:
+                    print(f"已提交任务: {remote.add_task(args.url)}")
+                elif args.sync:
+                    for listing_url in args.sync:
+                        remote.sync_listing(listing_url, args.sync_pages)
+                    print(f"已提交 {len(args.sync)} 个列表的同步")
+                elif args.ini:
+                    remote.resume_download(args.ini, args.delay)
+                    print(f"已提交继续下载: {args.ini}")
+                else:
+                    remote_control(remote, 'stats', [])
+            except (OSError, RuntimeError) as e:
+                logger.error(f"无法连接守护进程 {remote.base_url}: {e}")
+        elif args.scan_library is not None:
+            # 更新本地库目录
+            catalog = LibraryCatalog(config)
+            try:
+                scanned, updated = catalog.scan(args.scan_library or config.get('download', 'output_dir', './download'))
+                complete = catalog.conn.execute('SELECT COUNT(*) FROM galleries WHERE complete').fetchone()[0]
+                logger.info(f"扫描 {scanned} 个画廊，更新 {updated} 个，库目录中已完成 {complete} 个")
+            finally:
+                catalog.close()
+        elif args.queue:
+            # 多节点共享队列
+            if args.enqueue:
+                queue = SharedQueue(args.queue, args.node_id)
+                entries = [entry for path in args.enqueue for entry in parse_batch_file(path)]
+                print(f"已添加 {queue.enqueue(entries)} 个画廊到队列（共读取 {len(entries)} 个）")
+                queue.close()
+            if args.worker:
+                run_queue_worker(args.queue, config, args.node_id)
+            if args.queue_status or not (args.enqueue or args.worker):
+                queue = SharedQueue(args.queue, args.node_id)
+                states, nodes = queue.stats()
+                print("队列: " + ", ".join(f"{state}={count}" for state, count in states.items()))
+                for node in nodes:
+                    print(f"节点 {node['node_id']}: 领取 {node['claimed']}, 完成 {node['completed']}, "
+                          f"失败 {node['failed']}, 下载耗时 {node['busy_seconds']:.0f}秒, "
+                          f"最近心跳 {datetime.fromtimestamp(node['heartbeat_at']).strftime('%Y-%m-%d %H:%M:%S')}")
+                queue.close()
+        elif args.sync:
+            # 增量同步画廊列表
+            manager = DownloadManager(config)
+            while True:
+                for listing_url in args.sync:
+                    try:
+                        manager.sync_listing(listing_url, args.sync_pages)
+                    except Exception as e:
+                        logger.error(f"同步列表失败 {listing_url}: {e}")
+                manager.wait_all()
+                manager.clear_finished_tasks()
+                if not args.sync_interval:
+                    break
+                logger.info(f"{args.sync_interval:.0f} 秒后再次同步...")
+                time.sleep(args.sync_interval)
+            manager.close()
+        elif args.export:
+            # 导出画廊
+            suffix = '.cbz' if args.export_format == 'cbz' else ''
+            for gallery_dir in args.export:
+                target = None
+                if args.export_to:
+                    os.makedirs(args.export_to, exist_ok=True)
+                    target = os.path.join(args.export_to, os.path.basename(os.path.normpath(gallery_dir)) + suffix)
+                try:
+                    print(f"已导出: {export_gallery(gallery_dir, target, args.export_format)}")
+                except (OSError, ValueError, sqlite3.Error) as e:
+                    logger.error(f"导出画廊失败 {gallery_dir}: {e}")
+        elif args.verify:
+            # 校验已下载的画廊
+            verify_gallery(args.verify, args.verify_workers)
+        elif args.ini:
             # 从INI文件继续下载失败项
             resume_download_from_ini(args.ini, args.delay)
         elif args.file:
@@ -1178,7 +5858,7 @@ def main():
             parser.print_help()
     else:
         # 交互模式
-        mode = input("选择模式 (1: 单个画廊下载, 2: 批量下载, 3: 从INI文件继续下载, 4: GUI模式): ")
+        mode = input("选择模式 (1: 单个画廊下载, 2: 批量下载, 3: 从INI文件继续下载, 4: GUI模式, 5: 校验已下载画廊): ")
         if mode == "1":
             url = input("请输入画廊URL: ").replace('"', '')
             config = Config()
@@ -1196,10 +5876,90 @@ def main():
             # 启动GUI
             from ehentai_downloader_gui import main as gui_main
             gui_main()
+        elif mode == "5":
+            gallery_dir = input("请输入画廊目录: ").replace('"', '')
+            verify_gallery(gallery_dir)
         else:
             print("无效的选择，退出程序")
 
 
+def measure_import_time(module_name, runs=5, top_n=8):
+    """
+    在新进程中用python -X importtime测量导入模块的耗时
+    :return: (多次运行的中位数毫秒, [(直接依赖, 累计毫秒)] 按耗时从大到小)
+    """
+    import subprocess
+    import statistics
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # 与正常启动一致，使用字节码缓存
+    command = [sys.executable, '-X', 'importtime', '-c', f'import {module_name}']
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    totals = []
+    dependencies = {}
+    for run in range(runs + 1):
+        result = subprocess.run(command, capture_output=True, text=True, cwd=cwd, env=env)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        if run == 0:
+            continue  # 第一次运行用于生成字节码缓存
+        # 子模块先于父模块输出，缩进表示层级；只统计被测模块的直接依赖
+        children = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            if depth == 1:
+                children.append((name.strip(), int(cumulative) / 1000))
+            elif depth == 0:
+                if name.strip() == module_name:
+                    totals.append(int(cumulative) / 1000)
+                    for child, elapsed in children:
+                        dependencies.setdefault(child, []).append(elapsed)
+                children = []
+    slowest = sorted(((name, statistics.median(values)) for name, values in dependencies.items()),
+                     key=lambda item: item[1], reverse=True)
+    return statistics.median(totals), slowest[:top_n]
+
+
+def remote_control(remote, command, task_ids):
+    """执行--ctl命令"""
+    if command == 'list':
+        for task in remote.get_all_tasks():
+            print(f"{task['task_id']}  {task['status']}  {task['progress']}/{task['total']}  "
+                  f"优先级{task['priority']}  {task['title'] or task['url']}")
+    elif command == 'stats':
+        stats = remote.stats()
+        print(f"运行 {stats['uptime']:.0f} 秒，活跃 {stats['active']}/{stats['max_concurrent']}，"
+              f"每画廊线程 {stats['max_workers']}，调度策略 {stats['policy']}")
+        print("任务: " + (", ".join(f"{status}={count}" for status, count in stats['tasks'].items()) or "无"))
+        if stats['quota_wait']:
+            print(f"配额用尽，{stats['quota_wait']:.0f} 秒后恢复")
+        disk = stats.get('disk')
+        if disk:
+            print(f"磁盘: 剩余 {format_size(disk['free'])}，已预留 {format_size(disk['reserved'])}，"
+                  f"保留 {format_size(disk['min_free'])}"
+                  + (f"，空间不足暂停中（挂起 {disk['suspended']} 个任务）" if disk['low'] else "")
+                  + (f"，{len(disk['waiting'])} 个任务等待空间" if disk['waiting'] else ""))
+        if stats['http_cache']:
+            print(f"HTTP缓存: 命中 {stats['http_cache']['hits']}, 重新验证 {stats['http_cache']['revalidated']}")
+        for host, info in sorted(stats['hosts'].items()):
+            print(f"{host}: {info['state']}, 成功 {info['success']}, 失败 {info['failure']}, 平均 {info['avg_time']:.2f}秒")
+    elif command in ('start', 'pause', 'cancel', 'remove'):
+        action = {'start': remote.start_task, 'pause': remote.pause_task,
+                  'cancel': remote.cancel_task, 'remove': remote.remove_task}[command]
+        for task_id in task_ids:
+            print(f"{task_id}: {'成功' if action(task_id) else '失败'}")
+    elif command == 'clear':
+        remote.clear_finished_tasks()
+        print("已清理完成的任务")
+    elif command == 'shutdown':
+        remote.shutdown()
+        print("守护进程正在退出")
+    else:
+        print(f"未知的命令: {command}")
+
+
 def resume_download_from_ini(ini_path, delay=1):
     """
     从INI文件中读取失败的下载项并重新下载
@@ -1266,16 +6026,15 @@ def resume_download_from_ini(ini_path, delay=1):
 
         logger.info(f"找到 {len(to_download)} 个需要下载的项目")
 
-        # 创建配置和下载器
-        config = Config()
-        config.set('download', 'delay', delay)
-        downloader = EHentaiDownloader(gallery_url, config)
+        # 创建配置和下载器（不能覆盖上面的INI解析器）
+        download_config = Config()
+        download_config.set('download', 'delay', delay)
+        downloader = EHentaiDownloader(gallery_url, download_config)
         downloader.output_dir = output_dir
 
         # 下载每个失败的项目
         downloaded_count = 0
         failed_count = 0
-        new_failed_links = []
 
         for i, url in enumerate(to_download, 1):
             logger.info(f"正在下载第 {i}/{len(to_download)} 个项目: {url}")
@@ -1283,12 +6042,11 @@ def resume_download_from_ini(ini_path, delay=1):
                 # 从URL中提取索引
                 padded_index = url.split("-")[-1]
 
-                # 检查是否已经下载
-                jpg_path = os.path.join(output_dir, f"{padded_index}.jpg")
-                webp_path = os.path.join(output_dir, f"{padded_index}.webp")
-
-                if os.path.exists(jpg_path) or os.path.exists(webp_path):
+                # 检查是否已经下载（文件已存在时按下载成功记录，使统计与文件一致）
+                if downloader._get_storage().find(padded_index):
                     logger.info(f"图片 {i}/{len(to_download)} 已存在，跳过下载")
+                    downloaded_count += 1
+                    downloader.image_status[url] = "success"
                     continue
 
                 # 下载图片
@@ -1299,49 +6057,74 @@ def resume_download_from_ini(ini_path, delay=1):
                 downloader.image_status[url] = "success"
 
                 time.sleep(delay)  # 添加延迟，避免请求过快
+            except QuotaExceededError:
+                logger.warning("图片配额已用尽，停止继续下载，剩余项目保持原状态")
+                downloader.image_status[url] = "pending"
+                break
+            except DiskSpaceLowError:
+                logger.warning("磁盘剩余空间不足，停止继续下载，剩余项目保持原状态")
+                downloader.image_status[url] = "pending"
+                break
             except Exception as e:
                 logger.error(f"下载项目 {i} 失败: {e}")
                 failed_count += 1
                 downloader.image_status[url] = f"failed: {str(e)}"
-                new_failed_links.append(url)
 
+        downloader.close_storage()
         logger.info(f"继续下载完成! 成功: {downloaded_count}张, 失败: {failed_count}张")
 
         # 更新INI文件
         if downloaded_count > 0 or failed_count > 0:
-            # 更新Gallery部分的统计信息
-            total = int(config['Gallery'].get('TotalImages', '0'))
-            old_downloaded = int(config['Gallery'].get('Downloaded', '0'))
-            old_failed = int(config['Gallery'].get('Failed', '0'))
+            # 更新ImageStatus部分
+            if 'ImageStatus' not in config:
+                config['ImageStatus'] = {}
+            for url, status in downloader.image_status.items():
+                img_index = url.split("-")[-1]
+                config['ImageStatus'][img_index] = f"{url} | {status}"
+                image_status[url] = status
 
+            # 失败和未下载的数量按最终的图片状态重新统计，而不是在旧值上增减
+            old_downloaded = int(config['Gallery'].get('Downloaded', '0'))
+            failed_urls = [url for url in to_download if image_status.get(url, 'failed').startswith('failed')]
+            pending = sum(1 for status in image_status.values() if status == 'pending')
             config['Gallery']['Downloaded'] = str(old_downloaded + downloaded_count)
-            config['Gallery']['Failed'] = str(old_failed - downloaded_count + failed_count)
+            config['Gallery']['Failed'] = str(len(failed_urls))
+            config['Gallery']['Pending'] = str(pending)
             config['Gallery']['DownloadTime'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            # 更新FailedLinks部分
+            # 更新FailedLinks部分（包括因配额用尽等原因本次没有重试的失败项）
             if 'FailedLinks' in config:
                 config.remove_section('FailedLinks')
-            if new_failed_links:
+            if failed_urls:
                 config['FailedLinks'] = {}
-                for i, link in enumerate(new_failed_links, 1):
+                for i, link in enumerate(failed_urls, 1):
                     config['FailedLinks'][f'Link{i}'] = link
 
-            # 更新ImageStatus部分
-            for url, status in downloader.image_status.items():
-                img_index = url.split("-")[-1]
-                config['ImageStatus'][img_index] = f"{url} | {status}"
+            if downloader.converted_hashes:
+                if 'ConvertedHashes' not in config:
+                    config['ConvertedHashes'] = {}
+                config['ConvertedHashes'].update(downloader.converted_hashes)
 
             # 写入更新后的INI文件
-            with open(ini_path, 'w', encoding='utf-8') as f:
-                config.write(f)
+            write_task_info(config, ini_path)
 
             logger.info(f"已更新任务信息文件: {ini_path}")
 
+            if download_config.get('catalog', 'enabled', False):
+                catalog = LibraryCatalog(download_config)
+                try:
+                    catalog.record_ini(ini_path)
+                finally:
+                    catalog.close()
+
     except Exception as e:
         logger.error(f"从INI文件继续下载时出错: {e}")
 
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+
     # 设置日志格式
     logger.add("ehentai_downloader.log", rotation="10 MB", level="INFO")
 
@@ -16,7 +16,8 @@ from PyQt5.QtGui import QFont
 from loguru import logger
 import json
 
-from ehentai_downloader import DownloadManager, Config, EHentaiDownloader
+from ehentai_downloader import (DownloadManager, RemoteDownloadManager, Config, EHentaiDownloader,
+                                SCHEDULING_POLICIES, parse_batch_file, preload_modules)
 
 
 class TaskSignals(QObject):
@@ -24,6 +25,7 @@ class TaskSignals(QObject):
     task_added = pyqtSignal(str, str)  # task_id, url
     task_updated = pyqtSignal(str, object, object, str)  # task_id, current, total, message
     task_removed = pyqtSignal(str)  # task_id
+    remote_polled = pyqtSignal(object)  # 后台线程获取的守护进程状态
 
 
 class EHentaiDownloaderGUI(QMainWindow):
@@ -37,7 +39,17 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.signals.task_updated.connect(self.on_task_updated_async)
         self.signals.task_removed.connect(self.on_task_removed_async)
         
-        self.download_manager = DownloadManager(self.config)
+        # 配置为连接守护进程时，任务在守护进程中运行，窗口关闭后继续下载
+        self.remote_mode = False
+        if self.config.get('daemon', 'gui_remote', False):
+            remote = RemoteDownloadManager(self.config)
+            if remote.is_available():
+                self.remote_mode = True
+                self.download_manager = remote
+            else:
+                logger.warning(f"无法连接守护进程 {remote.base_url}，在本进程中下载")
+        if not self.remote_mode:
+            self.download_manager = DownloadManager(self.config)
         self.download_manager.set_callbacks(
             task_added=self.on_task_added,
             task_updated=self.on_task_updated,
@@ -46,8 +58,16 @@ class EHentaiDownloaderGUI(QMainWindow):
         
         # 定时器用于更新任务列表
         self.update_timer = QTimer()
-        self.update_timer.timeout.connect(self.update_task_table)
-        self.update_timer.start(3000)  # 每3秒更新一次，减少频率
+        self.remote_poll_stop = threading.Event()
+        if self.remote_mode:
+            # 守护进程的HTTP请求在后台线程中进行，结果通过信号交给界面线程，不阻塞界面
+            self.signals.remote_polled.connect(self.on_remote_polled)
+            threading.Thread(target=self._poll_remote, daemon=True).start()
+        else:
+            self.update_timer.timeout.connect(self.update_task_table)
+            self.update_timer.timeout.connect(self.update_host_table)
+            self.update_timer.timeout.connect(self.check_config_reload)
+            self.update_timer.start(3000)  # 每3秒更新一次，减少频率
         
         # 添加更新标记，避免无意义的更新
         self.need_update = False
@@ -57,6 +77,8 @@ class EHentaiDownloaderGUI(QMainWindow):
         
         self.init_ui()
         self.load_settings()
+        if self.remote_mode:
+            self.log_message(f"已连接守护进程: {self.download_manager.base_url}")
     
     def init_ui(self):
         self.setWindowTitle('E-Hentai 下载器 v2.0')
@@ -132,6 +154,19 @@ class EHentaiDownloaderGUI(QMainWindow):
         
         url_layout.addLayout(batch_layout)
         
+        # 列表增量同步
+        sync_layout = QHBoxLayout()
+        sync_layout.addWidget(QLabel("同步列表:"))
+        self.sync_url_input = QLineEdit()
+        self.sync_url_input.setPlaceholderText("输入搜索结果、收藏夹或标签页URL，只添加本地没有的新画廊...")
+        sync_layout.addWidget(self.sync_url_input, 1)
+        
+        self.sync_btn = QPushButton("同步")
+        self.sync_btn.clicked.connect(self.sync_listing)
+        sync_layout.addWidget(self.sync_btn)
+        
+        url_layout.addLayout(sync_layout)
+        
         # INI文件续传
         ini_layout = QHBoxLayout()
         ini_layout.addWidget(QLabel("任务文件:"))
@@ -157,6 +192,19 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.max_concurrent_spin.setValue(3)
         self.max_concurrent_spin.valueChanged.connect(self.on_max_concurrent_changed)
         concurrent_layout.addWidget(self.max_concurrent_spin)
+        
+        # 调度设置
+        concurrent_layout.addWidget(QLabel("调度策略:"))
+        self.policy_combo = QComboBox()
+        for policy, label in zip(SCHEDULING_POLICIES, ['按添加顺序', '页数少的优先', '各批量文件轮流', '截止时间早的优先']):
+            self.policy_combo.addItem(label, policy)
+        self.policy_combo.currentIndexChanged.connect(self.on_policy_changed)
+        concurrent_layout.addWidget(self.policy_combo)
+        concurrent_layout.addWidget(QLabel("新任务优先级:"))
+        self.priority_spin = QSpinBox()
+        self.priority_spin.setRange(-10, 10)
+        self.priority_spin.setValue(0)
+        concurrent_layout.addWidget(self.priority_spin)
         concurrent_layout.addStretch()
         url_layout.addLayout(concurrent_layout)
         
@@ -178,7 +226,7 @@ class EHentaiDownloaderGUI(QMainWindow):
         header.resizeSection(1, 80)   # 状态列
         header.resizeSection(2, 100)  # 进度列
         header.resizeSection(3, 200)  # 消息列
-        header.resizeSection(4, 180)  # 操作列
+        header.resizeSection(4, 240)  # 操作列
         header.resizeSection(5, 80)   # ID列
         
         # 隐藏ID列（仅用于内部标识）
@@ -254,6 +302,7 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.workers_spin = QSpinBox()
         self.workers_spin.setRange(1, 10)
         self.workers_spin.setValue(3)
+        self.workers_spin.valueChanged.connect(self.on_max_workers_changed)
         download_layout.addWidget(self.workers_spin, 2, 1)
         
         download_layout.addWidget(QLabel("超时时间(秒):"), 3, 0)
@@ -268,6 +317,31 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.retry_spin.setValue(3)
         download_layout.addWidget(self.retry_spin, 4, 1)
         
+        self.metadata_enabled = QCheckBox("使用元数据API获取标题和页数（跳过已完成的画廊）")
+        download_layout.addWidget(self.metadata_enabled, 5, 0, 1, 3)
+        
+        self.http_cache_enabled = QCheckBox("启用HTTP缓存（重复下载时复用未变化的页面）")
+        download_layout.addWidget(self.http_cache_enabled, 6, 0, 1, 3)
+        
+        self.process_mode = QCheckBox("每个画廊在独立进程中下载（利用多核，对新开始的任务生效）")
+        download_layout.addWidget(self.process_mode, 7, 0, 1, 3)
+        
+        download_layout.addWidget(QLabel("图片存储方式:"), 8, 0)
+        self.storage_combo = QComboBox()
+        self.storage_combo.addItem("每张图片一个文件", 'loose')
+        self.storage_combo.addItem("单个打包文件（pack）", 'pack')
+        self.storage_combo.addItem("SQLite数据库", 'sqlite')
+        self.storage_combo.setToolTip("只对新画廊生效，已有画廊保持原来的存储方式")
+        download_layout.addWidget(self.storage_combo, 8, 1)
+        
+        download_layout.addWidget(QLabel("保留磁盘空间(MB):"), 9, 0)
+        self.min_free_spin = QSpinBox()
+        self.min_free_spin.setRange(0, 1048576)
+        self.min_free_spin.setSingleStep(256)
+        self.min_free_spin.setValue(1024)
+        self.min_free_spin.setToolTip("剩余空间不够下载下一个画廊或低于此值时暂停队列，释放空间后自动继续")
+        download_layout.addWidget(self.min_free_spin, 9, 1)
+        
         scroll_layout.addWidget(download_group)
         
         # 压缩设置
@@ -322,6 +396,44 @@ class EHentaiDownloaderGUI(QMainWindow):
         
         scroll_layout.addWidget(conversion_group)
         
+        # 去重存储设置
+        dedup_group = QGroupBox("跨画廊去重")
+        dedup_layout = QGridLayout(dedup_group)
+        dedup_layout.setSpacing(10)
+        
+        self.dedup_enabled = QCheckBox("启用去重存储（相同图片硬链接到画廊目录，不再重复下载）")
+        dedup_layout.addWidget(self.dedup_enabled, 0, 0, 1, 3)
+        
+        dedup_layout.addWidget(QLabel("存储目录:"), 1, 0)
+        self.dedup_dir_input = QLineEdit()
+        dedup_layout.addWidget(self.dedup_dir_input, 1, 1)
+        self.browse_dedup_btn = QPushButton("浏览")
+        self.browse_dedup_btn.clicked.connect(self.browse_dedup_dir)
+        dedup_layout.addWidget(self.browse_dedup_btn, 1, 2)
+        
+        scroll_layout.addWidget(dedup_group)
+        
+        # 性能分析设置
+        profiling_group = QGroupBox("性能分析")
+        profiling_layout = QGridLayout(profiling_group)
+        profiling_layout.setSpacing(10)
+        
+        self.profiling_enabled = QCheckBox("下载时启用性能分析（结果保存在画廊目录）")
+        profiling_layout.addWidget(self.profiling_enabled, 0, 0, 1, 3)
+        
+        profiling_layout.addWidget(QLabel("分析模式:"), 1, 0)
+        self.profiling_mode_combo = QComboBox()
+        self.profiling_mode_combo.addItems(['sampling', 'cprofile'])
+        profiling_layout.addWidget(self.profiling_mode_combo, 1, 1)
+        
+        profiling_layout.addWidget(QLabel("热点函数数量:"), 2, 0)
+        self.profiling_top_spin = QSpinBox()
+        self.profiling_top_spin.setRange(5, 100)
+        self.profiling_top_spin.setValue(20)
+        profiling_layout.addWidget(self.profiling_top_spin, 2, 1)
+        
+        scroll_layout.addWidget(profiling_group)
+        
         # 按钮区域
         buttons_layout = QHBoxLayout()
         self.save_settings_btn = QPushButton("保存设置")
@@ -369,6 +481,21 @@ class EHentaiDownloaderGUI(QMainWindow):
         log_layout.addLayout(log_buttons_layout)
         
         layout.addWidget(log_group)
+        
+        # 图片服务器健康表
+        host_group = QGroupBox("图片服务器状态")
+        host_layout = QVBoxLayout(host_group)
+        
+        self.host_table = QTableWidget()
+        self.host_table.setColumnCount(6)
+        self.host_table.setHorizontalHeaderLabels(['主机', '状态', '成功', '失败', '失败率', '平均耗时'])
+        self.host_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.host_table.verticalHeader().setVisible(False)
+        self.host_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.host_table.setMaximumHeight(180)
+        host_layout.addWidget(self.host_table)
+        
+        layout.addWidget(host_group)
         return widget
 
     # 任务管理方法
@@ -380,7 +507,7 @@ class EHentaiDownloaderGUI(QMainWindow):
             return
         
         self.update_config_from_ui()
-        task_id = self.download_manager.add_task(url)
+        task_id = self.download_manager.add_task(url, priority=self.priority_spin.value())
         self.url_input.clear()
         # 日志记录将在异步回调中处理
     
@@ -392,21 +519,19 @@ class EHentaiDownloaderGUI(QMainWindow):
             return
         
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                urls = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+            entries = parse_batch_file(file_path)
             
-            if not urls:
+            if not entries:
                 QMessageBox.warning(self, "警告", "文件中没有找到有效的URL!")
                 return
             
+            # 没有priority注解的条目使用界面上的优先级
+            for entry in entries:
+                if entry['priority'] is None:
+                    entry['priority'] = self.priority_spin.value()
+            
             self.update_config_from_ui()
-            added_count = 0
-            for url in urls:
-                try:
-                    self.download_manager.add_task(url)
-                    added_count += 1
-                except Exception as e:
-                    logger.error(f"添加任务失败: {url} - {e}")
+            added_count = len(self.download_manager.add_tasks(entries))
             
             self.log_message(f"批量添加完成，成功添加 {added_count} 个任务")
             QMessageBox.information(self, "完成", f"已添加 {added_count} 个下载任务!")
@@ -420,6 +545,58 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.download_manager.set_max_concurrent(max_concurrent)
         self.log_message(f"最大并行数已设置为: {max_concurrent}")
     
+    def on_max_workers_changed(self):
+        """并行下载数改变，正在下载的画廊立即生效"""
+        max_workers = self.workers_spin.value()
+        self.download_manager.set_max_workers(max_workers)
+        self.log_message(f"每个画廊的并行下载数已设置为: {max_workers}")
+    
+    def _poll_remote(self):
+        """后台线程：每3秒获取守护进程的任务列表和图片服务器状态，并让守护进程检查配置文件"""
+        while not self.remote_poll_stop.is_set():
+            try:
+                state = {
+                    'tasks': self.download_manager.get_all_tasks(),
+                    'host_stats': self.download_manager.get_host_stats(),
+                    'reloaded': self.download_manager.reload_config()
+                }
+            except Exception as e:
+                state = {'error': str(e)}
+            if self.remote_poll_stop.is_set():
+                break
+            self.signals.remote_polled.emit(state)
+            self.remote_poll_stop.wait(3)
+    
+    def on_remote_polled(self, state):
+        """守护进程状态回调（在主线程中执行）"""
+        if 'error' in state:
+            logger.error(f"获取守护进程状态失败: {state['error']}")
+            return
+        self.update_task_table(state['tasks'])
+        self.update_host_table(state['host_stats'])
+        self.check_config_reload(state['reloaded'])
+    
+    def check_config_reload(self, remote_reloaded=False):
+        """
+        配置文件被外部修改时重新加载并刷新界面
+        :param remote_reloaded: 守护进程是否已重新加载它自己的配置（由后台线程检查）
+        """
+        if self.config.file_changed():
+            # 界面上尚未保存的修改记为覆盖值，重新加载后保留
+            self.update_config_from_ui()
+        if self.remote_mode:
+            reloaded = self.config.reload_if_changed() or remote_reloaded
+        else:
+            reloaded = self.download_manager.reload_config()
+        if reloaded:
+            self.load_settings()
+            self.log_message("配置文件已变化，已重新加载设置")
+    
+    def on_policy_changed(self):
+        """调度策略改变"""
+        self.download_manager.set_policy(self.policy_combo.currentData())
+        self.log_message(f"调度策略已设置为: {self.policy_combo.currentText()}")
+    
     def on_task_added(self, task_id, url):
         """任务添加回调（异步触发信号）"""
         self.signals.task_added.emit(task_id, url)
@@ -454,15 +631,19 @@ class EHentaiDownloaderGUI(QMainWindow):
         # 立即更新一次，因为这是重要的状态变化
         self.update_task_table()
     
-    def update_task_table(self):
-        """更新任务表格（优化版本，增量更新）"""
-        # 如果不需要更新，直接返回
-        if not self.need_update:
+    def update_task_table(self, tasks=None):
+        """
+        更新任务表格（优化版本，增量更新）
+        :param tasks: 已获取的任务列表（守护进程模式由后台线程获取），为None时从下载管理器获取
+        """
+        # 如果不需要更新，直接返回（守护进程中的任务没有回调，每次获取到状态都刷新）
+        if tasks is None and not self.need_update:
             return
             
         try:
             self.need_update = False
-            tasks = self.download_manager.get_all_tasks()
+            if tasks is None:
+                tasks = self.download_manager.get_all_tasks()
             
             # 获取当前表格中的任务ID
             current_task_ids = set()
@@ -512,6 +693,32 @@ class EHentaiDownloaderGUI(QMainWindow):
         except Exception as e:
             logger.error(f"更新任务表格失败: {e}")
     
+    def update_host_table(self, host_stats=None):
+        """更新图片服务器健康表"""
+        state_names = {'closed': '正常', 'open': '熔断', 'half_open': '探测中'}
+        try:
+            if host_stats is None:
+                host_stats = self.download_manager.get_host_stats()
+            self.host_table.setRowCount(len(host_stats))
+            for row, (host, info) in enumerate(sorted(host_stats.items())):
+                values = [
+                    host,
+                    state_names.get(info['state'], info['state']),
+                    str(info['success']),
+                    str(info['failure']),
+                    f"{info['failure_rate']:.0%}",
+                    f"{info['avg_time']:.2f}秒"
+                ]
+                for column, value in enumerate(values):
+                    item = self.host_table.item(row, column)
+                    if item:
+                        if item.text() != value:
+                            item.setText(value)
+                    else:
+                        self.host_table.setItem(row, column, QTableWidgetItem(value))
+        except Exception as e:
+            logger.error(f"更新图片服务器状态失败: {e}")
+    
     def _create_task_row(self, row, task):
         """创建新的任务行"""
         task_id = task.get('task_id')
@@ -607,6 +814,16 @@ class EHentaiDownloaderGUI(QMainWindow):
             resume_btn.clicked.connect(lambda checked, tid=task_id: self.start_task(tid))
             button_layout.addWidget(resume_btn)
         
+        if status == "等待中":
+            up_btn = QPushButton("↑")
+            up_btn.setToolTip("提高优先级")
+            up_btn.clicked.connect(lambda checked, t=task: self.change_task_priority(t, 1))
+            button_layout.addWidget(up_btn)
+            down_btn = QPushButton("↓")
+            down_btn.setToolTip("降低优先级")
+            down_btn.clicked.connect(lambda checked, t=task: self.change_task_priority(t, -1))
+            button_layout.addWidget(down_btn)
+        
         if status not in ["已完成"]:
             cancel_btn = QPushButton("取消")
             cancel_btn.clicked.connect(lambda checked, tid=task_id: self.cancel_task(tid))
@@ -625,6 +842,13 @@ class EHentaiDownloaderGUI(QMainWindow):
         else:
             self.log_message(f"任务 {task_id} 开始失败")
     
+    def change_task_priority(self, task, delta):
+        """调整等待中任务的优先级"""
+        task_id = task.get('task_id')
+        info = self.download_manager.get_task_info(task_id)
+        if info and self.download_manager.set_task_priority(task_id, info['priority'] + delta):
+            self.log_message(f"任务 {task_id} 优先级已调整为 {info['priority'] + delta}")
+    
     def pause_task(self, task_id):
         """暂停任务"""
         if self.download_manager.pause_task(task_id):
@@ -708,6 +932,11 @@ class EHentaiDownloaderGUI(QMainWindow):
         if dir_path:
             self.output_dir_input.setText(dir_path)
     
+    def browse_dedup_dir(self):
+        dir_path = QFileDialog.getExistingDirectory(self, "选择去重存储目录")
+        if dir_path:
+            self.dedup_dir_input.setText(dir_path)
+    
     def browse_zip_path(self):
         file_path, _ = QFileDialog.getOpenFileName(
             self, "选择7-Zip可执行文件", "", "可执行文件 (*.exe);;所有文件 (*)")
@@ -728,14 +957,53 @@ class EHentaiDownloaderGUI(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, "错误", f"继续下载失败: {e}")
 
+    def sync_listing(self):
+        """增量同步画廊列表（在后台线程中抓取列表页）"""
+        listing_url = self.sync_url_input.text().strip()
+        if not listing_url:
+            QMessageBox.warning(self, "警告", "请输入列表URL!")
+            return
+        
+        self.update_config_from_ui()
+        
+        def _sync():
+            try:
+                self.download_manager.sync_listing(listing_url)
+            except Exception as e:
+                logger.error(f"同步列表失败: {e}")
+        
+        threading.Thread(target=_sync, daemon=True).start()
+        self.log_message(f"开始同步列表: {listing_url}")
+
     # 设置管理方法
     def load_settings(self):
-        """从配置文件加载设置到界面"""
+        """从配置文件加载设置到界面，加载期间不触发控件的修改处理"""
+        widgets = [self.workers_spin, self.max_concurrent_spin, self.policy_combo]
+        for widget in widgets:
+            widget.blockSignals(True)
+        try:
+            self._apply_settings_to_ui()
+        finally:
+            for widget in widgets:
+                widget.blockSignals(False)
+        
+        # 设置最大并行数
+        self.download_manager.set_max_concurrent(self.config.get('download', 'max_concurrent', 3))
+    
+    def _apply_settings_to_ui(self):
+        """将配置中的值填入界面控件"""
         self.output_dir_input.setText(self.config.get('download', 'output_dir', './download'))
         self.delay_spin.setValue(int(self.config.get('download', 'delay', 1)))
         self.workers_spin.setValue(self.config.get('download', 'max_workers', 3))
         self.timeout_spin.setValue(self.config.get('download', 'timeout', 30))
         self.retry_spin.setValue(self.config.get('download', 'retry_count', 3))
+        self.metadata_enabled.setChecked(self.config.get('metadata', 'enabled', False))
+        self.http_cache_enabled.setChecked(self.config.get('http_cache', 'enabled', False))
+        self.process_mode.setChecked(self.config.get('download', 'execution_mode', 'thread') == 'process')
+        storage_index = self.storage_combo.findData(self.config.get('storage', 'backend', 'loose'))
+        if storage_index >= 0:
+            self.storage_combo.setCurrentIndex(storage_index)
+        self.min_free_spin.setValue(self.config.get('disk', 'min_free_mb', 1024))
         
         self.compression_enabled.setChecked(self.config.get('compression', 'enabled', False))
         self.zip_path_input.setText(self.config.get('compression', 'tool_path', ''))
@@ -749,10 +1017,21 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.webp_to_jpg.setChecked(self.config.get('conversion', 'webp_to_jpg', True))
         self.jpg_quality_spin.setValue(self.config.get('conversion', 'jpg_quality', 95))
         
-        # 设置最大并行数
-        max_concurrent = self.config.get('download', 'max_concurrent', 3)
-        self.max_concurrent_spin.setValue(max_concurrent)
-        self.download_manager.set_max_concurrent(max_concurrent)
+        self.dedup_enabled.setChecked(self.config.get('dedup', 'enabled', False))
+        self.dedup_dir_input.setText(self.config.get('dedup', 'store_dir', './download/.store'))
+        
+        self.profiling_enabled.setChecked(self.config.get('profiling', 'enabled', False))
+        mode_index = self.profiling_mode_combo.findText(self.config.get('profiling', 'mode', 'sampling'))
+        if mode_index >= 0:
+            self.profiling_mode_combo.setCurrentIndex(mode_index)
+        self.profiling_top_spin.setValue(self.config.get('profiling', 'top_n', 20))
+        
+        policy_index = self.policy_combo.findData(self.config.get('scheduler', 'policy', 'fifo'))
+        if policy_index >= 0:
+            self.policy_combo.setCurrentIndex(policy_index)
+        self.priority_spin.setValue(self.config.get('scheduler', 'default_priority', 0))
+        
+        self.max_concurrent_spin.setValue(self.config.get('download', 'max_concurrent', 3))
     
     def update_config_from_ui(self):
         """从界面更新配置"""
@@ -762,6 +1041,13 @@ class EHentaiDownloaderGUI(QMainWindow):
         self.config.set('download', 'timeout', self.timeout_spin.value())
         self.config.set('download', 'retry_count', self.retry_spin.value())
         self.config.set('download', 'max_concurrent', self.max_concurrent_spin.value())
+        self.config.set('metadata', 'enabled', self.metadata_enabled.isChecked())
+        self.config.set('http_cache', 'enabled', self.http_cache_enabled.isChecked())
+        self.config.set('download', 'execution_mode', 'process' if self.process_mode.isChecked() else 'thread')
+        self.config.set('storage', 'backend', self.storage_combo.currentData())
+        self.config.set('disk', 'min_free_mb', self.min_free_spin.value())
+        self.config.set('scheduler', 'policy', self.policy_combo.currentData())
+        self.config.set('scheduler', 'default_priority', self.priority_spin.value())
         
         self.config.set('compression', 'enabled', self.compression_enabled.isChecked())
         self.config.set('compression', 'tool_path', self.zip_path_input.text())
@@ -772,6 +1058,13 @@ class EHentaiDownloaderGUI(QMainWindow):
         
         self.config.set('conversion', 'webp_to_jpg', self.webp_to_jpg.isChecked())
         self.config.set('conversion', 'jpg_quality', self.jpg_quality_spin.value())
+        
+        self.config.set('dedup', 'enabled', self.dedup_enabled.isChecked())
+        self.config.set('dedup', 'store_dir', self.dedup_dir_input.text())
+        
+        self.config.set('profiling', 'enabled', self.profiling_enabled.isChecked())
+        self.config.set('profiling', 'mode', self.profiling_mode_combo.currentText())
+        self.config.set('profiling', 'top_n', self.profiling_top_spin.value())
     
     def save_settings(self):
         """保存设置"""
@@ -814,19 +1107,22 @@ class EHentaiDownloaderGUI(QMainWindow):
     
     def closeEvent(self, event):
         """关闭事件处理"""
+        if self.remote_mode:
+            # 任务由守护进程继续下载
+            self.remote_poll_stop.set()
+            event.accept()
+            return
         active_count = self.download_manager.get_active_count()
         if active_count > 0:
             reply = QMessageBox.question(self, "确认", f"有 {active_count} 个下载任务正在进行，确定要退出吗？")
             if reply == QMessageBox.Yes:
-                # 取消所有任务
-                tasks = self.download_manager.get_all_tasks()
-                for task in tasks:
-                    if task and task.get('status') in ['下载中', '等待中', '已暂停']:
-                        self.download_manager.cancel_task(task.get('task_id'))
+                # 取消所有任务并释放管理器
+                self.download_manager.close()
                 event.accept()
             else:
                 event.ignore()
         else:
+            self.download_manager.close()
             event.accept()
 
 
@@ -842,8 +1138,13 @@ def main():
     window = EHentaiDownloaderGUI()
     window.show()
     
+    # 窗口显示后再在后台导入requests、BeautifulSoup等下载用到的模块
+    QTimer.singleShot(0, preload_modules)
+    
     sys.exit(app.exec_())
 
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
     main()
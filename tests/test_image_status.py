@@ -0,0 +1,47 @@
+"""图片状态表：写入的URL和状态原样读出（task_info.ini依赖这一点）"""
+from ehentai_downloader import ImageStatusTable
+
+
+def test_round_trip_keeps_urls_and_statuses():
+    table = ImageStatusTable()
+    statuses = {
+        'http://g.e-hentai.org/s/0123456789/42-1': 'success',
+        'http://g.e-hentai.org/s/abcdef0123/42-2': 'failed: 下载图片文件失败，已达到最大重试次数: timeout',
+        'http://g.e-hentai.org/s/fedcba9876/42-3': 'pending',
+        'http://g.e-hentai.org/s/1111111111/42-5': 'skipped',
+    }
+    for url, status in statuses.items():
+        table[url] = status
+
+    assert dict(table.items()) == statuses
+    assert len(table) == 4
+    assert table.get_page(1) == 'success'
+    assert table.get_page(2) == 'failed: 下载图片文件失败，已达到最大重试次数: timeout'
+    assert table.get_page(3) == 'pending'
+    assert table.get_page(4) is None
+    assert table.get_page(5) == 'skipped'
+    assert table.get_page(100) is None
+
+
+def test_overwrite_clears_failure_message():
+    table = ImageStatusTable()
+    url = 'https://e-hentai.org/s/0123456789/42-1'
+    table[url] = 'failed: 图片校验失败'
+    table[url] = 'success'
+    assert list(table.items()) == [(url, 'success')]
+    assert table.get_page(1) == 'success'
+
+
+def test_urls_that_cannot_be_rebuilt_are_kept_verbatim():
+    table = ImageStatusTable()
+    first = 'https://e-hentai.org/s/0123456789/42-1'
+    other_host = 'https://exhentai.org/s/abcdef0123/42-2'
+    other_gallery = 'https://e-hentai.org/s/abcdef0123/43-1'
+    padded = 'https://e-hentai.org/s/fedcba9876/42-03'
+    unparsed = 'https://e-hentai.org/unknown'
+    for url in (first, other_host, other_gallery, padded, unparsed):
+        table[url] = 'failed: x'
+
+    assert dict(table.items()) == {url: 'failed: x' for url in
+                                   (first, other_host, other_gallery, padded, unparsed)}
+    assert len(table) == 5
@@ -0,0 +1,63 @@
+"""单文件存储（images.pack）写入中断后重新打开：截掉不完整的尾部，之后追加的图片不会丢失"""
+import os
+
+from ehentai_downloader import PackFileStorage
+
+
+def commit(storage, tmp_path, name, data):
+    source = tmp_path / name
+    source.write_bytes(data)
+    storage.commit(str(source))
+
+
+def test_reopen_after_interrupted_index_write(tmp_path):
+    gallery_dir = tmp_path / 'gallery'
+    gallery_dir.mkdir()
+    storage = PackFileStorage(str(gallery_dir))
+    commit(storage, tmp_path, 'a.jpg', b'a' * 100)
+    storage.close()
+
+    # 模拟写入b.jpg时中断：数据已写入，索引只写了半行
+    with open(gallery_dir / PackFileStorage.PACK_NAME, 'ab') as f:
+        f.write(b'b' * 50)
+    with open(gallery_dir / PackFileStorage.INDEX_NAME, 'ab') as f:
+        f.write(b'{"name": "b.jpg", "offs')
+
+    storage = PackFileStorage(str(gallery_dir))
+    assert storage.names() == ['a.jpg']
+    assert os.path.getsize(gallery_dir / PackFileStorage.PACK_NAME) == 100
+    commit(storage, tmp_path, 'c.jpg', b'c' * 30)
+    storage.close()
+
+    storage = PackFileStorage(str(gallery_dir))
+    try:
+        assert storage.names() == ['a.jpg', 'c.jpg']
+        assert storage.read('a.jpg') == b'a' * 100
+        assert storage.read('c.jpg') == b'c' * 30
+    finally:
+        storage.close()
+
+
+def test_reopen_drops_index_records_without_data(tmp_path):
+    gallery_dir = tmp_path / 'gallery'
+    gallery_dir.mkdir()
+    storage = PackFileStorage(str(gallery_dir))
+    commit(storage, tmp_path, 'a.jpg', b'a' * 100)
+    commit(storage, tmp_path, 'b.jpg', b'b' * 50)
+    storage.close()
+
+    # 数据文件在b.jpg的数据落盘前被截断
+    with open(gallery_dir / PackFileStorage.PACK_NAME, 'r+b') as f:
+        f.truncate(120)
+
+    storage = PackFileStorage(str(gallery_dir))
+    assert storage.names() == ['a.jpg']
+    commit(storage, tmp_path, 'c.jpg', b'c' * 30)
+    storage.close()
+
+    storage = PackFileStorage(str(gallery_dir))
+    try:
+        assert storage.names() == ['a.jpg', 'c.jpg']
+        assert storage.read('c.jpg') == b'c' * 30
+    finally:
+        storage.close()
@@ -0,0 +1,77 @@
+"""从INI继续下载后的统计：失败和未下载的数量按最终图片状态重新计算"""
+import configparser
+
+import pytest
+
+import ehentai_downloader
+from ehentai_downloader import resume_download_from_ini
+
+GALLERY_URL = 'https://e-hentai.org/g/1/aaaaaaaaaa/'
+
+
+def image_url(page):
+    return f'https://e-hentai.org/s/{page:010d}/1-{page}'
+
+
+def write_ini(path, statuses, **counts):
+    task_info = configparser.ConfigParser()
+    task_info['Gallery'] = {'Title': 'test', 'URL': GALLERY_URL, 'TotalImages': str(len(statuses)),
+                            'Downloaded': '0', 'Skipped': '0', 'Failed': '0', 'Pending': '0'}
+    for key, value in counts.items():
+        task_info['Gallery'][key.capitalize()] = str(value)
+    task_info['ImageStatus'] = {str(page): f'{image_url(page)} | {status}'
+                                for page, status in enumerate(statuses, 1)}
+    failed = [image_url(page) for page, status in enumerate(statuses, 1) if status.startswith('failed')]
+    if failed:
+        task_info['FailedLinks'] = {f'Link{i}': url for i, url in enumerate(failed, 1)}
+    with open(path, 'w', encoding='utf-8') as f:
+        task_info.write(f)
+
+
+def read_gallery(path):
+    task_info = configparser.ConfigParser()
+    task_info.read(path, encoding='utf-8')
+    return task_info
+
+
+@pytest.fixture
+def gallery_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ehentai_downloader.time, 'sleep', lambda seconds: None)
+    path = tmp_path / 'gallery'
+    path.mkdir()
+    return path
+
+
+def test_resume_pending_images_completes_gallery(gallery_dir, monkeypatch):
+    ini_path = str(gallery_dir / 'task_info.ini')
+    write_ini(ini_path, ['success', 'pending', 'pending'], downloaded=1, pending=2)
+    monkeypatch.setattr(ehentai_downloader.EHentaiDownloader, 'download_image',
+                        lambda self, url, index, total: None)
+
+    resume_download_from_ini(ini_path, delay=0)
+
+    task_info = read_gallery(ini_path)
+    gallery = task_info['Gallery']
+    assert (gallery['Downloaded'], gallery['Failed'], gallery['Pending']) == ('3', '0', '0')
+    assert 'FailedLinks' not in task_info
+    assert all(value.endswith('| success') for value in task_info['ImageStatus'].values())
+
+
+def test_resume_mixed_failed_and_pending(gallery_dir, monkeypatch):
+    ini_path = str(gallery_dir / 'task_info.ini')
+    write_ini(ini_path, ['success', 'failed: timeout', 'pending', 'pending'], downloaded=1, failed=1, pending=2)
+
+    def download_image(self, url, index, total):
+        if url.endswith('-3'):
+            raise Exception('still broken')
+
+    monkeypatch.setattr(ehentai_downloader.EHentaiDownloader, 'download_image', download_image)
+
+    resume_download_from_ini(ini_path, delay=0)
+
+    task_info = read_gallery(ini_path)
+    gallery = task_info['Gallery']
+    assert (gallery['Downloaded'], gallery['Failed'], gallery['Pending']) == ('3', '1', '0')
+    assert list(task_info['FailedLinks'].values()) == [image_url(3)]
+    assert task_info['ImageStatus']['3'] == f'{image_url(3)} | failed: still broken'
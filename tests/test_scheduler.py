@@ -0,0 +1,131 @@
+"""调度策略的排序键、批量文件的调度注解，以及就绪队列中失效条目的处理"""
+from datetime import datetime
+
+import pytest
+
+from ehentai_downloader import Config, DownloadManager, TaskStatus, parse_batch_file, schedule_key
+
+
+def order(policy, tasks):
+    """按调度键排序，tasks为 名称 -> schedule_key的关键字参数"""
+    return sorted(tasks, key=lambda name: schedule_key(policy, **tasks[name]))
+
+
+def test_fifo_keeps_only_priority():
+    tasks = {'a': {'total': 50}, 'b': {'total': 5, 'deadline': 100}, 'c': {'priority': 1, 'total': 500}}
+    assert order('fifo', tasks) == ['c', 'a', 'b']
+    assert schedule_key('fifo', total=50) == schedule_key('fifo', total=5)
+
+
+def test_shortest_puts_unknown_page_count_last():
+    tasks = {'big': {'total': 300}, 'unknown': {'total': 0}, 'small': {'total': 12}}
+    assert order('shortest', tasks) == ['small', 'big', 'unknown']
+
+
+def test_fair_alternates_groups():
+    tasks = {'a1': {'group_rank': 0}, 'a2': {'group_rank': 1}, 'a3': {'group_rank': 2},
+             'b1': {'group_rank': 0}, 'b2': {'group_rank': 1}}
+    assert [name[1] for name in order('fair', tasks)] == ['1', '1', '2', '2', '3']
+
+
+def test_deadline_puts_missing_deadline_last():
+    tasks = {'none': {}, 'late': {'deadline': 2000.0}, 'early': {'deadline': 1000.0}}
+    assert order('deadline', tasks) == ['early', 'late', 'none']
+
+
+@pytest.mark.parametrize('policy', ['fifo', 'shortest', 'fair', 'deadline'])
+def test_priority_beats_policy(policy):
+    tasks = {'low': {'total': 1, 'deadline': 1.0, 'group_rank': 0},
+             'high': {'priority': 5, 'total': 900, 'deadline': None, 'group_rank': 9}}
+    assert order(policy, tasks) == ['high', 'low']
+
+
+def test_parse_batch_file_annotations(tmp_path):
+    batch = tmp_path / 'batch.txt'
+    batch.write_text(
+        '# 注释行\n'
+        '\n'
+        'https://e-hentai.org/g/1/aaaaaaaaaa/ priority=5 deadline=2026-10-20T18:00\n'
+        'https://e-hentai.org/g/2/bbbbbbbbbb/  # 行尾注释\n'
+        'https://e-hentai.org/g/3/cccccccccc/ priority=high deadline=tomorrow\n'
+        'https://e-hentai.org/g/4/dddddddddd/ colour=red priority=-2 deadline=2026-10-21\n',
+        encoding='utf-8')
+
+    entries = parse_batch_file(str(batch))
+
+    assert [entry['url'].split('/')[4] for entry in entries] == ['1', '2', '3', '4']
+    assert all(entry['group'] == 'batch.txt' for entry in entries)
+    assert entries[0]['priority'] == 5
+    assert entries[0]['deadline'] == datetime(2026, 10, 20, 18, 0).timestamp()
+    assert (entries[1]['priority'], entries[1]['deadline']) == (None, None)
+    # 无效的注解被忽略，条目本身保留
+    assert (entries[2]['priority'], entries[2]['deadline']) == (None, None)
+    assert entries[3]['priority'] == -2
+    assert entries[3]['deadline'] == datetime(2026, 10, 21).timestamp()
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = Config(str(tmp_path / 'config.json'))
+    config.set('download', 'output_dir', str(tmp_path / 'download'))
+    config.set('download', 'max_concurrent', 0)  # 添加任务时不启动
+    manager = DownloadManager(config)
+    yield manager
+    manager.close()
+
+
+def add(manager, gid, total=0, **kwargs):
+    task_id = manager.add_task(f'https://e-hentai.org/g/{gid}/abcdef1234/', **kwargs)
+    manager.tasks[task_id].total_progress = total
+    return task_id
+
+
+def claim_all(manager):
+    """取出就绪队列中的全部任务（只占用槽位，不真正启动）"""
+    with manager.lock:
+        manager.max_concurrent = len(manager.tasks) + 1
+        return [task_id for task_id, _ in manager._claim_ready_tasks_unlocked()]
+
+
+def test_ready_queue_follows_policy(manager):
+    a = add(manager, 1, total=300)
+    b = add(manager, 2, total=10)
+    c = add(manager, 3, total=0)
+    manager.set_policy('shortest')
+    assert claim_all(manager) == [b, a, c]
+
+
+def test_priority_change_invalidates_old_entry(manager):
+    a = add(manager, 1)
+    b = add(manager, 2)
+    c = add(manager, 3)
+    assert manager.set_task_priority(c, 10)
+    assert manager.set_task_priority(a, -1)
+    assert manager.set_task_priority(a, -2)
+
+    claimed = claim_all(manager)
+    assert claimed == [c, b, a]
+    # 每个任务只取出一次，旧条目全部失效
+    assert not manager.ready_queue or all(manager.queue_entries.get(entry[2]) != entry[1]
+                                          for entry in manager.ready_queue)
+    assert claim_all(manager) == []
+
+
+def test_cancelled_task_is_never_started(manager):
+    a = add(manager, 1)
+    b = add(manager, 2)
+    assert manager.cancel_task(a)
+    assert manager.tasks[a].status == TaskStatus.CANCELLED
+    assert claim_all(manager) == [b]
+
+
+def test_set_policy_rebuilds_queue(manager):
+    late = add(manager, 1, deadline=2000.0)
+    none = add(manager, 2)
+    early = add(manager, 3, deadline=1000.0)
+    manager.cancel_task(none)
+    manager.set_policy('deadline')
+    manager.set_policy('fifo')
+    manager.set_policy('deadline')
+    assert claim_all(manager) == [early, late]
@@ -0,0 +1,99 @@
+"""共享队列的租约、续约和过期重新领取（两个节点共用一个临时队列文件）"""
+import time
+
+import pytest
+
+from ehentai_downloader import SharedQueue
+
+URL_A = 'https://e-hentai.org/g/1/aaaaaaaaaa/'
+URL_B = 'https://e-hentai.org/g/2/bbbbbbbbbb/'
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    db_path = str(tmp_path / 'queue.db')
+    node1 = SharedQueue(db_path, 'node1', lease_seconds=0.3, max_attempts=2)
+    node2 = SharedQueue(db_path, 'node2', lease_seconds=0.3, max_attempts=2)
+    yield node1, node2
+    node1.close()
+    node2.close()
+
+
+def job(queue, url):
+    return dict(queue.conn.execute('SELECT * FROM jobs WHERE url = ?', (url,)).fetchone())
+
+
+def test_each_gallery_is_leased_to_one_node(nodes):
+    node1, node2 = nodes
+    assert node1.enqueue([URL_A, URL_B]) == 2
+    assert node2.enqueue([URL_A]) == 0
+
+    claimed = {node1.claim(), node2.claim()}
+    assert claimed == {URL_A, URL_B}
+    assert node1.claim() is None
+    assert node2.claim() is None
+
+
+def test_heartbeat_keeps_lease(nodes):
+    node1, node2 = nodes
+    node1.enqueue([URL_A])
+    assert node1.claim() == URL_A
+    for _ in range(3):
+        time.sleep(0.15)
+        assert node1.heartbeat(URL_A)
+    assert node2.claim() is None
+
+
+def test_expired_lease_is_reclaimed_and_old_node_loses_it(nodes):
+    node1, node2 = nodes
+    node1.enqueue([URL_A])
+    assert node1.claim() == URL_A
+    time.sleep(0.4)
+
+    assert node2.claim() == URL_A
+    assert not node1.heartbeat(URL_A)
+    # 失去租约的节点结束时不会覆盖新节点的状态
+    node1.complete(URL_A, True)
+    assert job(node2, URL_A)['state'] == 'leased'
+
+    node2.complete(URL_A, True)
+    assert job(node2, URL_A)['state'] == 'done'
+    assert not node2.has_unfinished()
+
+
+def test_repeatedly_expired_lease_counts_as_attempts(nodes):
+    node1, node2 = nodes
+    node1.enqueue([URL_A])
+    assert node1.claim() == URL_A
+    time.sleep(0.4)
+    assert node2.claim() == URL_A
+    time.sleep(0.4)
+
+    # 两次领取后租约都过期，达到max_attempts后不再被领取
+    assert node1.claim() is None
+    row = job(node1, URL_A)
+    assert row['state'] == 'failed'
+    assert row['attempts'] == 2
+    assert not node1.has_unfinished()
+
+
+def test_failed_download_is_retried_until_max_attempts(nodes):
+    node1, node2 = nodes
+    node1.enqueue([URL_A])
+    assert node1.claim() == URL_A
+    node1.complete(URL_A, False, 'error')
+    assert job(node1, URL_A)['state'] == 'queued'
+
+    assert node2.claim() == URL_A
+    node2.complete(URL_A, False, 'error')
+    assert job(node2, URL_A)['state'] == 'failed'
+
+
+def test_retry_does_not_count_as_attempt(nodes):
+    node1, _ = nodes
+    node1.enqueue([URL_A])
+    for _ in range(3):
+        assert node1.claim() == URL_A
+        node1.complete(URL_A, False, retry=True)
+    assert job(node1, URL_A)['attempts'] == 0
+    assert job(node1, URL_A)['state'] == 'queued'
@@ -14,6 +14,7 @@ def webp_to_jpg(input_path, output_path=None, quality=95):
     """
     if output_path is None:
         output_path = os.path.splitext(input_path)[0] + '.jpg'
+    output_existed = os.path.exists(output_path)
 
     try:
         img = Image.open(input_path)
@@ -22,6 +23,9 @@ def webp_to_jpg(input_path, output_path=None, quality=95):
         return True
     except Exception as e:
         logger.warning(f"转换失败: {e}")
+        # 写入中途失败（如磁盘已满）时删除不完整的输出文件，避免被当作已下载的图片
+        if not output_existed and os.path.exists(output_path):
+            os.remove(output_path)
         return False
 
 